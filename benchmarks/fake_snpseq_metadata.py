@@ -0,0 +1,83 @@
+"""
+A stand-in for the snpseq_metadata executable that accepts the same command lines as used by the
+service, sleeps for a configurable time and writes outputs of a configurable size. The runtime (in
+seconds) and the output size (in bytes) are taken from the environment variables
+FAKE_METADATA_RUNTIME and FAKE_METADATA_OUTPUT_SIZE.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+
+def _sleep_and_pad(outfile, data):
+    time.sleep(float(os.environ.get("FAKE_METADATA_RUNTIME", 0.5)))
+    size = int(os.environ.get("FAKE_METADATA_OUTPUT_SIZE", 0))
+    padding = max(size - len(json.dumps(data)), 0)
+    data["padding"] = "x" * padding
+    with open(outfile, "w") as fh:
+        json.dump(data, fh)
+
+
+def _projects(path):
+    with open(path) as fh:
+        return sorted(set(re.findall(r'"project(?:_id)?": "(\w{2}-\d{4})"', fh.read())))
+
+
+def extract_runfolder(args):
+    name = os.path.basename(os.path.normpath(args.input))
+    _sleep_and_pad(
+        os.path.join(args.outdir, f"{name}.ngi.json"),
+        {"runfolder_name": name, "runfolder_path": args.input})
+
+
+def extract_snpseq_data(args):
+    name = ".".join(os.path.basename(args.input).split(".")[0:-1])
+    _sleep_and_pad(
+        os.path.join(args.outdir, f"{name}.ngi.json"),
+        {"experiments": [
+            {"project": {"project_id": project}} for project in _projects(args.input)]})
+
+
+def export(args):
+    time.sleep(float(os.environ.get("FAKE_METADATA_RUNTIME", 0.5)))
+    size = int(os.environ.get("FAKE_METADATA_OUTPUT_SIZE", 0))
+    for project in _projects(args.snpseq_data_extract) or ["AB-1234"]:
+        for name in (
+                f"{project}-experiment.xml",
+                f"{project}-run.xml",
+                f"{project}.metadata.ena.tsv"):
+            with open(os.path.join(args.outdir, name), "w") as fh:
+                fh.write("x" * size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    extract = commands.add_parser("extract")
+    sources = extract.add_subparsers(dest="source", required=True)
+    for source, func in (("runfolder", extract_runfolder), ("snpseq-data", extract_snpseq_data)):
+        sub = sources.add_parser(source)
+        sub.add_argument("--outdir", required=True)
+        sub.add_argument("input")
+        sub.add_argument("formats", nargs="+")
+        sub.set_defaults(func=func)
+
+    exp = commands.add_parser("export")
+    exp.add_argument("--outdir", required=True)
+    exp.add_argument("runfolder_extract")
+    exp.add_argument("snpseq_data_extract")
+    exp.add_argument("formats", nargs="+")
+    exp.set_defaults(func=export)
+
+    args = parser.parse_args()
+    os.makedirs(args.outdir, exist_ok=True)
+    args.func(args)
+    print(f"{' '.join(sys.argv[1:3])} finished")
+
+
+if __name__ == "__main__":
+    main()
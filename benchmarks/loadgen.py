@@ -0,0 +1,282 @@
+"""
+Load test for the metadata service. Starts the service with a stand-in for the snpseq-data service
+and a fake snpseq_metadata executable, drives the export endpoint at each of the given concurrency
+levels and reports the throughput, the latency percentiles, the event-loop lag of the service
+(measured as the latency of the version endpoint while under load) and its peak memory use.
+"""
+import argparse
+import asyncio
+import json
+import os
+import pathlib
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+import yaml
+
+
+REPO_ROOT = pathlib.Path(__file__).parent.parent
+TEST_RUNFOLDER = REPO_ROOT / "tests" / "test_data" / "runfolders" / "210415_A00001_0123_BXYZ321XY"
+HOST = "benchmark-host"
+BASE_URL = "/api/1.0"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--concurrency", type=int, nargs="+", default=[1, 4, 16],
+        help="the concurrency levels to test")
+    parser.add_argument(
+        "--requests", type=int, default=32,
+        help="the number of export requests to make at each concurrency level")
+    parser.add_argument(
+        "--runfolders", type=int, default=8,
+        help="the number of distinct runfolders to export")
+    parser.add_argument(
+        "--refresh", action="store_true",
+        help="add refresh=true to the export requests to bypass caches and manifests")
+    parser.add_argument(
+        "--lims-latency", type=float, default=0.1,
+        help="the latency of the snpseq-data stand-in, in seconds")
+    parser.add_argument(
+        "--lims-payload-size", type=int, default=100000,
+        help="the size of the snpseq-data responses, in bytes")
+    parser.add_argument(
+        "--metadata-runtime", type=float, default=0.5,
+        help="the runtime of each snpseq_metadata command, in seconds")
+    parser.add_argument(
+        "--metadata-output-size", type=int, default=10000,
+        help="the size of each file written by snpseq_metadata, in bytes")
+    parser.add_argument(
+        "--set", dest="overrides", action="append", default=[], metavar="KEY=VALUE",
+        help="override a setting in the service app.yaml, e.g. --set max_processes=4")
+    parser.add_argument(
+        "--output", type=pathlib.Path,
+        help="write the results as json to this file")
+    return parser.parse_args()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def runfolder_names(n):
+    return [f"210415_A00001_0123_BBENCH{i:03d}XX" for i in range(n)]
+
+
+def make_datadir(workdir, n):
+    datadir = workdir / "data"
+    for name in runfolder_names(n):
+        shutil.copytree(
+            TEST_RUNFOLDER,
+            datadir / HOST / "runfolders" / name,
+            ignore=shutil.ignore_patterns("metadata"))
+    return datadir
+
+
+def write_config(workdir, datadir, port, lims_port, overrides):
+    configdir = workdir / "config"
+    configdir.mkdir()
+    fake_executable = f"{sys.executable} {REPO_ROOT / 'benchmarks' / 'fake_snpseq_metadata.py'}"
+    app_config = {
+        "port": port,
+        "base_url": BASE_URL,
+        "datadir": str(datadir / "{host}" / "runfolders" / "{runfolder}"),
+        "snpseq_data_url": f"http://127.0.0.1:{lims_port}",
+        "snpseq_metadata_executable": fake_executable
+    }
+    for override in overrides:
+        key, value = override.split("=", 1)
+        app_config[key] = yaml.safe_load(value)
+
+    logger_config = {
+        "version": 1,
+        "disable_existing_loggers": False,
+        "handlers": {
+            "console": {
+                "class": "logging.StreamHandler",
+                "level": "WARNING",
+                "stream": "ext://sys.stderr"}},
+        "root": {
+            "level": "WARNING",
+            "handlers": ["console"]}
+    }
+    with open(configdir / "app.yaml", "w") as fh:
+        yaml.safe_dump(app_config, fh)
+    with open(configdir / "logger.yaml", "w") as fh:
+        yaml.safe_dump(logger_config, fh)
+    return configdir
+
+
+def start_process(args, env=None):
+    return subprocess.Popen(
+        args,
+        cwd=REPO_ROOT,
+        env=dict(os.environ, **(env or {})))
+
+
+async def wait_for(session, url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with session.get(url) as resp:
+                if resp.status < 500:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.1)
+    raise Exception(f"{url} did not respond within {timeout} seconds")
+
+
+def peak_memory(pid):
+    """
+    The peak resident set size of the process in bytes, read from /proc
+    """
+    try:
+        with open(f"/proc/{pid}/status") as fh:
+            for line in fh:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(int(round(pct / 100.0 * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+async def probe_lag(session, url, stop, interval=0.1):
+    lags = []
+    while not stop.is_set():
+        start = time.perf_counter()
+        async with session.get(url) as resp:
+            await resp.read()
+        lags.append(time.perf_counter() - start)
+        await asyncio.sleep(interval)
+    return lags
+
+
+async def run_level(session, service_url, concurrency, n_requests, runfolders, refresh):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def _export(i):
+        nonlocal errors
+        url = f"{service_url}{BASE_URL}/export/{HOST}/{runfolders[i % len(runfolders)]}"
+        if refresh:
+            url = f"{url}?refresh=true"
+        async with semaphore:
+            start = time.perf_counter()
+            async with session.get(url) as resp:
+                await resp.read()
+                if resp.status != 200:
+                    errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    stop = asyncio.Event()
+    lag_probe = asyncio.ensure_future(
+        probe_lag(session, f"{service_url}{BASE_URL}/version", stop))
+    start = time.perf_counter()
+    await asyncio.gather(*[_export(i) for i in range(n_requests)])
+    elapsed = time.perf_counter() - start
+    stop.set()
+    lags = await lag_probe
+
+    return {
+        "concurrency": concurrency,
+        "requests": n_requests,
+        "errors": errors,
+        "elapsed": elapsed,
+        "throughput": n_requests / elapsed,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+        "loop_lag_p50": percentile(lags, 50),
+        "loop_lag_max": max(lags) if lags else None
+    }
+
+
+def print_results(results):
+    header = (
+        f"{'conc':>5} {'reqs':>5} {'errs':>5} {'req/s':>8} {'p50 s':>8} {'p95 s':>8} "
+        f"{'p99 s':>8} {'lag p50':>8} {'lag max':>8} {'peak MB':>8}")
+    print(header)
+    for r in results:
+        peak = r["peak_memory"] / 1024 ** 2 if r["peak_memory"] else float("nan")
+        print(
+            f"{r['concurrency']:>5} {r['requests']:>5} {r['errors']:>5} "
+            f"{r['throughput']:>8.2f} {r['latency_p50']:>8.3f} {r['latency_p95']:>8.3f} "
+            f"{r['latency_p99']:>8.3f} {r['loop_lag_p50']:>8.3f} {r['loop_lag_max']:>8.3f} "
+            f"{peak:>8.1f}")
+
+
+async def run(args):
+    with tempfile.TemporaryDirectory(prefix="metadata-service-benchmark") as workdir:
+        workdir = pathlib.Path(workdir)
+        port, lims_port = free_port(), free_port()
+        datadir = make_datadir(workdir, args.runfolders)
+        configdir = write_config(workdir, datadir, port, lims_port, args.overrides)
+
+        stub = start_process([
+            sys.executable, "-m", "benchmarks.stub_snpseq_data",
+            "--port", str(lims_port),
+            "--latency", str(args.lims_latency),
+            "--payload-size", str(args.lims_payload_size)])
+        service = start_process(
+            [
+                sys.executable, "-c",
+                "import sys; from metadata_service.app import start; "
+                f"sys.argv = ['metadata-service', '-c', '{configdir}']; start()"],
+            env={
+                "FAKE_METADATA_RUNTIME": str(args.metadata_runtime),
+                "FAKE_METADATA_OUTPUT_SIZE": str(args.metadata_output_size)})
+
+        service_url = f"http://127.0.0.1:{port}"
+        results = []
+        try:
+            connector = aiohttp.TCPConnector(limit=0)
+            timeout = aiohttp.ClientTimeout(total=None)
+            async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+                await wait_for(session, f"http://127.0.0.1:{lims_port}/api/containers")
+                await wait_for(session, f"{service_url}{BASE_URL}/version")
+                for concurrency in args.concurrency:
+                    result = await run_level(
+                        session,
+                        service_url,
+                        concurrency,
+                        args.requests,
+                        runfolder_names(args.runfolders),
+                        args.refresh)
+                    result["peak_memory"] = peak_memory(service.pid)
+                    results.append(result)
+        finally:
+            for proc in (service, stub):
+                proc.terminate()
+                proc.wait()
+
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(results, fh, indent=2)
+    return results
+
+
+def main():
+    asyncio.run(run(parse_args()))
+
+
+if __name__ == "__main__":
+    main()
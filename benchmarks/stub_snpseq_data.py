@@ -0,0 +1,65 @@
+"""
+A stand-in for the snpseq-data service that responds to container requests for any flowcell with
+a configurable latency and payload size. The payload is built by repeating the samples in the
+LIMS test data until the requested size is reached.
+"""
+import argparse
+import asyncio
+import copy
+import json
+import pathlib
+
+import aiohttp.web
+
+
+TEMPLATE = pathlib.Path(__file__).parent.parent / "tests" / "test_data" / "XYZ321XY.lims.json"
+
+
+def make_payload(flowcell_id, size):
+    with open(TEMPLATE) as fh:
+        template = json.load(fh)
+
+    payload = copy.deepcopy(template)
+    payload["result"]["name"] = flowcell_id
+    samples = template["result"]["samples"]
+    i = 0
+    while len(json.dumps(payload)) < size:
+        sample = copy.deepcopy(samples[i % len(samples)])
+        sample["name"] = f"{sample['name']}-{i}"
+        payload["result"]["samples"].append(sample)
+        i += 1
+    return json.dumps(payload).encode()
+
+
+def setup_app(latency=0.0, payload_size=0):
+    payloads = {}
+
+    async def containers(request):
+        flowcell_id = request.query.get("name", "")
+        if flowcell_id not in payloads:
+            payloads[flowcell_id] = make_payload(flowcell_id, payload_size)
+        await asyncio.sleep(latency)
+        return aiohttp.web.Response(
+            body=payloads[flowcell_id],
+            content_type="application/json")
+
+    app = aiohttp.web.Application()
+    app.router.add_get("/api/containers", containers)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=9191)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds to wait before responding")
+    parser.add_argument(
+        "--payload-size", type=int, default=0, help="approximate size of the response in bytes")
+    args = parser.parse_args()
+    aiohttp.web.run_app(
+        setup_app(latency=args.latency, payload_size=args.payload_size),
+        port=args.port)
+
+
+if __name__ == "__main__":
+    main()
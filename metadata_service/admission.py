@@ -0,0 +1,157 @@
+import asyncio
+import bisect
+import contextlib
+import itertools
+import logging
+import math
+import time
+
+from metadata_service.metrics import ADMISSION_QUEUED, ADMISSION_REJECTED
+
+
+log = logging.getLogger(__name__)
+
+
+class AdmissionRejected(Exception):
+
+    def __init__(self, message, status, retry_after):
+        super(AdmissionRejected, self).__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Limits the number of exports running at the same time, to `max_active` in total and to
+    `max_active_per_host` for each host. Requests that cannot start right away wait in a queue,
+    ordered by priority class and then by arrival, where a request is admitted as soon as its host
+    has capacity, so that a busy host does not hold up the others. When `max_queued` requests are
+    already waiting, new requests are rejected with status 429, and requests that have waited for
+    `max_wait` seconds without being admitted are rejected with status 503. Rejections carry an
+    estimate, based on the recent export durations, of when to retry. Requests that are admitted
+    without these bounds, e.g. export jobs that run in the background, wait for as long as it
+    takes and do not count towards `max_queued`.
+    """
+
+    priorities = ("high", "normal", "low")
+
+    def __init__(
+            self,
+            max_active=None,
+            max_active_per_host=None,
+            max_queued=None,
+            max_wait=None):
+        self.max_active = max_active
+        self.max_active_per_host = max_active_per_host
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self.active = 0
+        self.active_per_host = {}
+        self.waiters = []
+        self.mean_duration = None
+        self._counter = itertools.count()
+
+    def has_capacity(self, host):
+        if self.max_active and self.active >= self.max_active:
+            return False
+        if self.max_active_per_host and \
+                self.active_per_host.get(host, 0) >= self.max_active_per_host:
+            return False
+        return True
+
+    def retry_after(self):
+        """
+        The number of seconds until a slot is likely to become available for a new request
+        """
+        duration = self.mean_duration or 1.0
+        slots = self.max_active or max(self.active, 1)
+        return max(1, math.ceil(duration * (len(self.waiters) + 1) / slots))
+
+    def _start(self, host):
+        self.active += 1
+        self.active_per_host[host] = self.active_per_host.get(host, 0) + 1
+
+    def _finish(self, host, duration=None):
+        self.active -= 1
+        self.active_per_host[host] -= 1
+        if not self.active_per_host[host]:
+            del self.active_per_host[host]
+        if duration is not None:
+            # an exponentially weighted mean of the time that the exports hold their slot
+            self.mean_duration = duration if self.mean_duration is None else \
+                0.8 * self.mean_duration + 0.2 * duration
+        self._dispatch()
+
+    def _dispatch(self):
+        for waiter in list(self.waiters):
+            _, _, host, future, _ = waiter
+            if future.done():
+                self.waiters.remove(waiter)
+            elif self.has_capacity(host):
+                self.waiters.remove(waiter)
+                self._start(host)
+                future.set_result(None)
+        ADMISSION_QUEUED.set(len(self.waiters))
+
+    def _reject(self, reason, message, status):
+        ADMISSION_REJECTED.labels(reason=reason).inc()
+        log.warning(message)
+        raise AdmissionRejected(message, status, self.retry_after())
+
+    async def _wait(self, host, priority, bounded):
+        if bounded and self.max_queued is not None and \
+                sum(1 for waiter in self.waiters if waiter[4]) >= self.max_queued:
+            self._reject(
+                "queue_full",
+                f"too many export requests are waiting, rejecting the request for {host}",
+                429)
+
+        future = asyncio.get_running_loop().create_future()
+        waiter = (self.priorities.index(priority), next(self._counter), host, future, bounded)
+        bisect.insort(self.waiters, waiter)
+        ADMISSION_QUEUED.set(len(self.waiters))
+        try:
+            await asyncio.wait_for(
+                asyncio.shield(future),
+                timeout=self.max_wait if bounded else None)
+        except asyncio.TimeoutError:
+            # unless the slot was handed over just as the wait timed out
+            if not future.done():
+                self._reject(
+                    "timeout",
+                    f"the export request for {host} was not admitted within {self.max_wait} "
+                    f"seconds",
+                    503)
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # the slot was handed over just as the request was cancelled
+                self._finish(host)
+            raise
+        finally:
+            if not future.done():
+                future.cancel()
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+            ADMISSION_QUEUED.set(len(self.waiters))
+
+    @contextlib.asynccontextmanager
+    async def admit(self, host, priority="normal", bounded=True):
+        """
+        Async context manager that waits until the request may start, or raises
+        AdmissionRejected. Unless `bounded`, the request is never rejected but waits for a slot.
+        """
+        if priority not in self.priorities:
+            raise ValueError(
+                f"unknown priority '{priority}', use one of {', '.join(self.priorities)}")
+        # the waiting requests are admitted as soon as there is capacity for them, so a request
+        # that has capacity now is not overtaking anyone
+        if self.has_capacity(host):
+            self._start(host)
+        else:
+            await self._wait(host, priority, bounded)
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self._finish(host, time.monotonic() - start)
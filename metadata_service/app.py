@@ -8,30 +8,105 @@ import yaml
 
 import aiohttp.web
 
+from metadata_service.admission import AdmissionController
+from metadata_service.archives import ArchiveWriter
+from metadata_service.cache import ExtractCache
+from metadata_service.checksums import ChecksumRunner
 from metadata_service.clients import SnpseqDataRequest
-from metadata_service.handlers import ExportHandler, VersionHandler
-from metadata_service.process import MetadataProcessRunner
+from metadata_service.handlers import \
+    ChecksumHandler, DownloadHandler, ExportHandler, ExportIndexHandler, InventoryHandler, \
+    JobHandler, MetricsHandler, ProfileHandler, VersionHandler
+from metadata_service.index import ExportIndex
+from metadata_service.inventory import InventoryIndex
+from metadata_service.jobs import ExportScheduler
+from metadata_service.process import MetadataLibraryRunner, MetadataProcessRunner
+from metadata_service.profiling import Profiler
+from metadata_service.tracing import request_id_middleware
+from metadata_service.watcher import RunfolderWatcher
+from metadata_service.workers import WorkerSupervisor, serve
+from metadata_service.workspace import Workspace
 
 
 log = logging.getLogger(__name__)
 
+PROCESS_RUNNERS = {
+    "cli": MetadataProcessRunner,
+    "library": MetadataLibraryRunner
+}
 
-def setup_routes(app, version_handler, export_handler):
+
+def setup_routes(
+        app,
+        version_handler,
+        export_handler,
+        job_handler,
+        metrics_handler,
+        profile_handler=None,
+        export_index_handler=None,
+        inventory_handler=None,
+        checksum_handler=None,
+        download_handler=None):
     app.router.add_get(
         app["config"]["base_url"] + "/version",
         version_handler.version)
+    app.router.add_get(
+        app["config"]["base_url"] + "/metrics",
+        metrics_handler.metrics)
     app.router.add_get(
         app["config"]["base_url"] + "/export/{host}/{runfolder}",
         export_handler.export)
+    app.router.add_post(
+        app["config"]["base_url"] + "/export",
+        export_handler.batch_export)
+    if job_handler is not None:
+        app.router.add_post(
+            app["config"]["base_url"] + "/export/{host}/{runfolder}",
+            job_handler.submit)
+        app.router.add_get(
+            app["config"]["base_url"] + "/jobs",
+            job_handler.list)
+        app.router.add_get(
+            app["config"]["base_url"] + "/jobs/{job_id}",
+            job_handler.status)
+    if export_index_handler is not None:
+        app.router.add_get(
+            app["config"]["base_url"] + "/exports",
+            export_index_handler.list)
+        app.router.add_get(
+            app["config"]["base_url"] + "/exports/{host}/{runfolder}",
+            export_index_handler.latest)
+    if inventory_handler is not None:
+        app.router.add_get(
+            app["config"]["base_url"] + "/inventory/{host}/{runfolder}",
+            inventory_handler.inventory)
+    if checksum_handler is not None:
+        app.router.add_post(
+            app["config"]["base_url"] + "/checksums/{host}/{runfolder}",
+            checksum_handler.checksums)
+    if download_handler is not None:
+        app.router.add_get(
+            app["config"]["base_url"] + "/download/{host}/{runfolder}",
+            download_handler.files)
+        app.router.add_get(
+            app["config"]["base_url"] + "/download/{host}/{runfolder}/{filename}",
+            download_handler.file)
+    if profile_handler is not None:
+        app.router.add_post(
+            app["config"]["base_url"] + "/admin/profile",
+            profile_handler.start)
+        app.router.add_get(
+            app["config"]["base_url"] + "/admin/profile",
+            profile_handler.report)
 
 
 def setup_log(config):
-    try:
-        filename = config["handlers"]["file_handler"]["filename"]
-        logdir = os.path.dirname(filename)
-        os.makedirs(logdir, exist_ok=True)
-    except KeyError:
-        pass
+    for handler in config.get("handlers", {}).values():
+        try:
+            filename = handler["filename"]
+            logdir = os.path.dirname(filename)
+            os.makedirs(logdir, exist_ok=True)
+        except KeyError:
+            pass
 
 
 def parse_args():
@@ -42,6 +117,12 @@ def parse_args():
         help="Path to config root dir",
         type=pathlib.Path,
         default="config")
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="Number of worker processes serving requests, overrides the workers setting in "
+             "app.yaml",
+        type=int)
 
     args = parser.parse_args()
     cfgroot = args.configroot
@@ -74,38 +155,162 @@ def load_config(cfgroot):
 def setup_app(
         cfgroot,
         metadata_executable_path=None,
-        process_runner_cls=MetadataProcessRunner,
+        process_runner_cls=None,
         data_session_cls=SnpseqDataRequest,
         version_handler_cls=VersionHandler,
-        export_handler_cls=ExportHandler):
+        export_handler_cls=ExportHandler,
+        job_handler_cls=JobHandler,
+        metrics_handler_cls=MetricsHandler,
+        runfolder_watcher_cls=RunfolderWatcher,
+        profile_handler_cls=ProfileHandler,
+        export_index_handler_cls=ExportIndexHandler,
+        inventory_handler_cls=InventoryHandler,
+        checksum_handler_cls=ChecksumHandler,
+        download_handler_cls=DownloadHandler,
+        workers=1):
 
     conf = load_config(cfgroot)
-    app = aiohttp.web.Application()
+    profiler = Profiler(exclude_prefix=conf.get("base_url", "") + "/admin")
+    app = aiohttp.web.Application(middlewares=[request_id_middleware, profiler.middleware])
 
-    session = data_session_cls(conf.get("snpseq_data_url"))
+    session = data_session_cls(
+        conf.get("snpseq_data_url"),
+        cache_ttl=conf.get("snpseq_data_cache_ttl"),
+        cache_max_entries=conf.get("snpseq_data_cache_max_entries", 128),
+        client_config=conf.get("snpseq_data_client"),
+        stream=conf.get("snpseq_data_stream", False))
 
     metadata_exec = metadata_executable_path or conf.get(
         "snpseq_metadata_executable",
         "snpseq_metadata")
+    process_runner_cls = process_runner_cls or PROCESS_RUNNERS[
+        conf.get("metadata_runner", "cli")]
     proc_run = process_runner_cls(
-        metadata_executable=metadata_exec)
+        metadata_executable=metadata_exec,
+        max_processes=conf.get("max_processes"))
+
+    extract_cache = None
+    if conf.get("extract_cache_dir"):
+        extract_cache = ExtractCache(
+            conf["extract_cache_dir"],
+            max_size=conf.get("extract_cache_max_size"),
+            max_entries=conf.get("extract_cache_max_entries"))
+
+    workspace = Workspace(
+        root=conf.get("scratch_dir"),
+        max_size=conf.get("scratch_max_size"))
 
-    export_handler_obj = export_handler_cls(process_runner=proc_run)
+    admission_conf = conf.get("admission") or {}
+    admission = AdmissionController(
+        max_active=admission_conf.get("max_active"),
+        max_active_per_host=admission_conf.get("max_active_per_host"),
+        max_queued=admission_conf.get("max_queued"),
+        max_wait=admission_conf.get("max_wait"))
+
+    inventory_index = InventoryIndex(max_entries=conf.get("inventory_max_entries", 128))
+
+    export_index = None
+    if conf.get("export_index"):
+        export_index = ExportIndex(conf["export_index"])
+
+    export_handler_obj = export_handler_cls(
+        process_runner=proc_run,
+        extract_cache=extract_cache,
+        workspace=workspace,
+        admission=admission,
+        export_index=export_index,
+        shard_workers=conf.get("export_shard_workers"),
+        inventory_index=inventory_index)
     version_handler_obj = version_handler_cls()
+    metrics_handler_obj = metrics_handler_cls()
+    profile_handler_obj = profile_handler_cls(profiler) if conf.get("admin_endpoints") else None
+    export_index_handler_obj = export_index_handler_cls(export_index) \
+        if export_index is not None else None
+    inventory_handler_obj = inventory_handler_cls(inventory_index)
+    checksum_conf = conf.get("checksums") or {}
+    checksum_runner = ChecksumRunner(
+        inventory_index,
+        workers=checksum_conf.get("workers", 4),
+        buffer_size=checksum_conf.get("buffer_size", 8 * 1024 * 1024))
+    checksum_handler_obj = checksum_handler_cls(checksum_runner)
+    archive_conf = conf.get("archives") or {}
+    archive_writer = ArchiveWriter(
+        workers=archive_conf.get("workers", 4),
+        retry_after=archive_conf.get("retry_after", 10))
+    download_handler_obj = download_handler_cls(archive_writer)
+
+    # the export jobs are kept in the memory of the worker process that accepted them, so their
+    # status could not be looked up through the other workers
+    scheduler = None
+    job_handler_obj = None
+    if workers > 1:
+        log.info(f"the export job endpoints are disabled when running {workers} workers")
+    else:
+        scheduler = ExportScheduler(
+            max_exports=conf.get("max_exports"),
+            max_exports_per_host=conf.get("max_exports_per_host"),
+            retention=conf.get("job_retention", 3600),
+            drain_timeout=conf.get("shutdown_timeout", 60))
+        job_handler_obj = job_handler_cls(
+            export_handler=export_handler_obj,
+            scheduler=scheduler)
 
     app['config'] = conf
     app['session'] = session
     app.cleanup_ctx.append(session.external_session)
+    app.cleanup_ctx.append(proc_run.process_context)
+    app.cleanup_ctx.append(workspace.workspace_context)
+    app.cleanup_ctx.append(checksum_runner.checksum_context)
+    app.cleanup_ctx.append(archive_writer.archive_context)
+    if export_index is not None:
+        app.cleanup_ctx.append(export_index.index_context)
+    watcher_conf = conf.get("runfolder_watcher") or {}
+    if watcher_conf.get("enabled"):
+        watcher = runfolder_watcher_cls(
+            datadir=conf.get("datadir", "."),
+            export_handler=export_handler_obj,
+            session=session,
+            interval=watcher_conf.get("interval", 300),
+            max_age=watcher_conf.get("max_age", 86400),
+            lockfile=os.path.join(workspace.root, "watcher.lock"))
+        app.cleanup_ctx.append(watcher.watcher_context)
+    if scheduler is not None:
+        app.cleanup_ctx.append(scheduler.scheduler_context)
+        app.on_shutdown.append(scheduler.drain)
     setup_routes(
         app,
         version_handler=version_handler_obj,
-        export_handler=export_handler_obj)
+        export_handler=export_handler_obj,
+        job_handler=job_handler_obj,
+        metrics_handler=metrics_handler_obj,
+        profile_handler=profile_handler_obj,
+        export_index_handler=export_index_handler_obj,
+        inventory_handler=inventory_handler_obj,
+        checksum_handler=checksum_handler_obj,
+        download_handler=download_handler_obj)
     return app
 
 
 def start():
     args = parse_args()
-    app = setup_app(args.configroot)
-    port = int(app['config'].get("port", 8080))
+    conf = load_config(args.configroot)
+    port = int(conf.get("port", 8080))
+    workers = args.workers or int(conf.get("workers") or 1)
+    shutdown_timeout = float(conf.get("shutdown_timeout", 60))
+    if workers > 1 and any(
+            value is not None for value in (conf.get("admission") or {}).values()):
+        # each worker would admit up to the limits on its own
+        log.error(
+            "the admission limits can not be enforced with more than one worker, remove the "
+            "admission settings from app.yaml or run a single worker")
+        sys.exit(1)
     log.info(f"starting metadata-service on port {port}...")
-    aiohttp.web.run_app(app, port=port)
+    if workers > 1:
+        supervisor = WorkerSupervisor(
+            app_factory=lambda: setup_app(args.configroot, workers=workers),
+            port=port,
+            workers=workers,
+            shutdown_timeout=shutdown_timeout)
+        supervisor.run()
+    else:
+        serve(setup_app(args.configroot), port=port, shutdown_timeout=shutdown_timeout)
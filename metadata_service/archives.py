@@ -0,0 +1,148 @@
+import asyncio
+import concurrent.futures
+import io
+import os
+import tarfile
+import zipfile
+
+
+ARCHIVE_FORMATS = {
+    "zip": ("application/zip", ".zip"),
+    "tar.gz": ("application/gzip", ".tar.gz")
+}
+
+
+class ArchiveWritersBusy(Exception):
+
+    def __init__(self, message, retry_after):
+        super(ArchiveWritersBusy, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class ResponseWriter(io.RawIOBase):
+    """
+    A write-only, non-seekable file object, for use from a worker thread, that passes what is
+    written on to a StreamResponse in chunks of `chunk_size` bytes. Each chunk is written on the
+    event loop and the thread waits for the write to complete, so that a slow client slows down
+    the writer rather than letting the data pile up in memory.
+    """
+
+    def __init__(self, response, loop, chunk_size=256 * 1024):
+        super(ResponseWriter, self).__init__()
+        self.response = response
+        self.loop = loop
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.aborted = False
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer.extend(data)
+        if len(self.buffer) >= self.chunk_size:
+            self._send()
+        return len(data)
+
+    def _send(self):
+        if self.aborted:
+            raise ConnectionResetError("the download was aborted")
+        if self.buffer:
+            chunk, self.buffer = bytes(self.buffer), bytearray()
+            asyncio.run_coroutine_threadsafe(self.response.write(chunk), self.loop).result()
+
+    def flush(self):
+        self._send()
+
+
+def write_archive(fileobj, archive_format, files):
+    """
+    Write the files, given as a list of (path, name in the archive) pairs, to the file object as a
+    zip or tar.gz archive. The file object does not have to be seekable.
+    """
+    if archive_format == "zip":
+        with zipfile.ZipFile(fileobj, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            for path, arcname in files:
+                archive.write(path, arcname)
+    elif archive_format == "tar.gz":
+        with tarfile.open(fileobj=fileobj, mode="w|gz") as archive:
+            for path, arcname in files:
+                archive.add(path, arcname)
+    else:
+        raise ValueError(
+            f"unknown archive format '{archive_format}', use one of "
+            f"{', '.join(ARCHIVE_FORMATS)}")
+    fileobj.flush()
+
+
+class ArchiveWriter:
+    """
+    Builds archives in a pool of `workers` threads while they are being sent. A thread is held
+    for as long as the client takes to download the archive, so at most `workers` archives are
+    built at a time and further requests are turned away, to be retried after `retry_after`
+    seconds, rather than queued behind them.
+    """
+
+    def __init__(self, workers=4, retry_after=10):
+        self.workers = workers
+        self.retry_after = retry_after
+        self.active = 0
+        self._executor = None
+
+    @property
+    def executor(self):
+        # create the pool lazily, so that each worker process has its own
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers,
+                thread_name_prefix="archive")
+        return self._executor
+
+    async def archive_context(self, app):
+        yield
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _release(self, future):
+        self.active -= 1
+
+    async def stream(self, request, response, archive_format, files):
+        """
+        Prepare the response and build the archive in a worker thread while it is being written
+        to the response, or raise ArchiveWritersBusy if all the threads are taken
+        """
+        if self.active >= self.workers:
+            raise ArchiveWritersBusy(
+                f"all {self.workers} archive writers are busy, try again later",
+                self.retry_after)
+        self.active += 1
+        loop = asyncio.get_running_loop()
+        writer = ResponseWriter(response, loop)
+        try:
+            await response.prepare(request)
+            future = loop.run_in_executor(
+                self.executor,
+                write_archive,
+                writer,
+                archive_format,
+                files)
+        except BaseException:
+            self.active -= 1
+            raise
+        # the slot is given back when the thread is done, which may be after the request has gone
+        future.add_done_callback(self._release)
+        try:
+            await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # have the thread stop at its next write
+            writer.aborted = True
+            raise
+
+
+def archive_name(runfolder, archive_format):
+    return f"{runfolder}.metadata{ARCHIVE_FORMATS[archive_format][1]}"
+
+
+def archive_members(runfolder, paths):
+    return [(path, os.path.join(runfolder, os.path.basename(path))) for path in sorted(paths)]
@@ -0,0 +1,165 @@
+import functools
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+
+log = logging.getLogger(__name__)
+
+
+def runfolder_fingerprint(runfolder_path, inventory_index=None):
+    """
+    Compute a cheap fingerprint of the runfolder inputs that the runfolder extraction depends on,
+    based on the paths, sizes and modification times of the files rather than their contents. If
+    an inventory index is given, the files under Unaligned are listed from the inventory of the
+    runfolder, which only lists the directories that have changed again, instead of walking the
+    directory tree. Each file is stat'ed either way, so that files modified in place are noticed.
+    """
+    entries = ["runfolder", str(runfolder_path)]
+    for relpath in (
+            "RunParameters.xml",
+            "fc_SampleSheet.csv",
+            os.path.join("MD5", "checksums.md5")):
+        path = os.path.join(runfolder_path, relpath)
+        try:
+            st = os.stat(path)
+            entries.append((relpath, st.st_size, st.st_mtime_ns))
+        except FileNotFoundError:
+            entries.append((relpath, None, None))
+
+    if inventory_index is not None:
+        relpaths = inventory_index.get(runfolder_path).walk_paths()
+    else:
+        relpaths = []
+        unaligned = os.path.join(runfolder_path, "Unaligned")
+        for root, dirs, files in os.walk(unaligned):
+            dirs.sort()
+            relpaths.extend(
+                os.path.relpath(os.path.join(root, name), runfolder_path)
+                for name in sorted(files))
+
+    for relpath in relpaths:
+        try:
+            st = os.stat(os.path.join(runfolder_path, relpath))
+            entries.append((relpath, st.st_size, st.st_mtime_ns))
+        except FileNotFoundError:
+            # removed since it was listed
+            entries.append((relpath, None, None))
+
+    return hashlib.sha256(json.dumps(entries).encode()).hexdigest()
+
+
+def snpseq_data_fingerprint(snpseq_data_path, chunk_size=1024 * 1024):
+    """
+    Compute a fingerprint of a LIMS export from its contents, so that identical exports share the
+    same cached extract wherever they are stored
+    """
+    st = os.stat(snpseq_data_path)
+    return _snpseq_data_fingerprint(
+        os.path.abspath(snpseq_data_path),
+        st.st_dev,
+        st.st_ino,
+        st.st_size,
+        st.st_mtime_ns,
+        chunk_size)
+
+
+@functools.lru_cache(maxsize=1024)
+def _snpseq_data_fingerprint(path, st_dev, st_ino, st_size, st_mtime_ns, chunk_size):
+    # memoized on the identity, size and modification time of the file, so that a file that is
+    # exported repeatedly is only read once
+    digest = hashlib.sha256(b"snpseq_data\0")
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ExtractCache:
+    """
+    A persistent, content-addressed cache of extracted metadata files on disk. Entries are
+    evicted in least-recently-used order when the cache grows beyond `max_size` bytes or
+    `max_entries` entries.
+    """
+
+    suffix = ".ngi.json"
+
+    def __init__(self, cachedir, max_size=None, max_entries=None):
+        self.cachedir = cachedir
+        self.max_size = max_size
+        self.max_entries = max_entries
+        os.makedirs(self.cachedir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.cachedir, key[0:2], f"{key}{self.suffix}")
+
+    def get(self, key, dest):
+        """
+        Copy the cached entry for the key to `dest` and return `dest`, or return None if there is
+        no such entry. Errors writing to `dest` are raised.
+        """
+        path = self.path(key)
+        try:
+            src = open(path, "rb")
+        except FileNotFoundError:
+            return None
+        with src, open(dest, "wb") as fh:
+            shutil.copyfileobj(src, fh)
+        try:
+            # mark the entry as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            # evicted while it was being copied, which the copy is not affected by
+            pass
+        log.debug(f"cache hit for {key}, copied to {dest}")
+        return dest
+
+    def put(self, key, src):
+        """
+        Add a copy of the file `src` to the cache under the key
+        """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        os.close(fd)
+        try:
+            shutil.copyfile(src, tmppath)
+            os.replace(tmppath, path)
+        except BaseException:
+            os.unlink(tmppath)
+            raise
+        log.debug(f"added {src} to cache as {key}")
+        self.evict()
+        return path
+
+    def invalidate(self, key):
+        try:
+            os.unlink(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def entries(self):
+        entries = []
+        for root, dirs, files in os.walk(self.cachedir):
+            for name in files:
+                if name.endswith(self.suffix):
+                    st = os.stat(os.path.join(root, name))
+                    entries.append((st.st_mtime, st.st_size, os.path.join(root, name)))
+        return sorted(entries)
+
+    def evict(self):
+        entries = self.entries()
+        total_size = sum(entry[1] for entry in entries)
+        while entries and (
+                (self.max_entries and len(entries) > self.max_entries) or
+                (self.max_size and total_size > self.max_size)):
+            _, size, path = entries.pop(0)
+            log.debug(f"evicting {path} from cache")
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
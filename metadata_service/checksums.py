@@ -0,0 +1,292 @@
+import asyncio
+import concurrent.futures
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+from metadata_service.inventory import checksum_relpath, read_checksums
+from metadata_service.metrics import CHECKSUM_BYTES
+from metadata_service.utils import gather_or_cancel
+
+
+log = logging.getLogger(__name__)
+
+
+class ChecksumRunInProgress(Exception):
+    pass
+
+
+def md5_file(path, buffer_size=8 * 1024 * 1024):
+    """
+    Return the md5 digest of the file, read into a re-used buffer of `buffer_size` bytes. The
+    digest is updated without holding the GIL, so several files can be hashed in parallel threads.
+    """
+    digest = hashlib.md5()
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as fh:
+        for size in iter(lambda: fh.readinto(buffer), 0):
+            digest.update(view[:size])
+    return digest.hexdigest()
+
+
+def write_atomically(path, text):
+    """
+    Write the text to a temporary file next to `path` and rename it to `path`, so that readers
+    see either the previous or the new contents
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmppath = tempfile.mkstemp(
+        dir=os.path.dirname(path),
+        prefix=f".{os.path.basename(path)}",
+        suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as fh:
+            fh.write(text)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmppath, path)
+    except BaseException:
+        os.unlink(tmppath)
+        raise
+    return path
+
+
+class ChecksumRunner:
+    """
+    Generates the missing entries in, or verifies the entries of, the MD5/checksums.md5 file of a
+    runfolder for the fastq files under Unaligned. The files are hashed in a pool of `workers`
+    threads, which also caps the number of files that are read at the same time. The size,
+    modification time and digest of each file are kept in a state file next to the checksum file,
+    so that a later run does not hash the files that have not changed again. A run holds a lock
+    on a lock file next to the checksum file, so that only one run at a time, in any process,
+    writes to the checksum and state files of a runfolder.
+    """
+
+    modes = ("generate", "verify")
+    checksum_file = os.path.join("MD5", "checksums.md5")
+    state_file = os.path.join("MD5", "checksums.state.json")
+    lock_file = os.path.join("MD5", "checksums.lock")
+
+    def __init__(
+            self,
+            inventory_index,
+            workers=4,
+            buffer_size=8 * 1024 * 1024,
+            progress_interval=1.0):
+        self.inventory_index = inventory_index
+        self.workers = workers
+        self.buffer_size = buffer_size
+        self.progress_interval = progress_interval
+        self.running = set()
+        self.pending = set()
+        self._executor = None
+
+    @property
+    def executor(self):
+        # create the pool lazily, so that each worker process has its own
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers,
+                thread_name_prefix="checksum")
+        return self._executor
+
+    async def checksum_context(self, app):
+        yield
+        if self._executor is not None:
+            # drop the files that are still waiting for a thread, the ones being hashed are left
+            # to finish in the background
+            for future in self.pending:
+                future.cancel()
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def acquire_lock(self, runfolder_path):
+        """
+        Lock the checksum files of the runfolder and return the file descriptor holding the lock,
+        or raise ChecksumRunInProgress if another run holds it
+        """
+        lockfile = os.path.join(runfolder_path, self.lock_file)
+        os.makedirs(os.path.dirname(lockfile), exist_ok=True)
+        fd = os.open(lockfile, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            raise ChecksumRunInProgress(
+                f"the checksums of {runfolder_path} are already being computed")
+        return fd
+
+    def load_state(self, runfolder_path):
+        try:
+            with open(os.path.join(runfolder_path, self.state_file)) as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            log.warning(f"ignoring unreadable checksum state in {runfolder_path}")
+            return {}
+
+    def write_state(self, runfolder_path, state):
+        return write_atomically(
+            os.path.join(runfolder_path, self.state_file),
+            json.dumps(state, indent=2, sort_keys=True))
+
+    def write_checksums(self, runfolder_path, checksums):
+        """
+        Write the checksums to the checksum file. The entries that are already listed keep the
+        path and mode that they are listed with, and new entries are listed relative to the
+        parent of the runfolder, as md5sum run from there would, unless the existing entries are
+        listed relative to the runfolder.
+        """
+        runfolder = os.path.basename(runfolder_path)
+        path = os.path.join(runfolder_path, self.checksum_file)
+        listed = {}
+        try:
+            for _, listed_path, binary in read_checksums(path):
+                listed[checksum_relpath(listed_path, runfolder)] = (listed_path, binary)
+        except FileNotFoundError:
+            pass
+        prefixed = not listed or any(
+            os.path.normpath(listed_path).startswith(runfolder + os.sep)
+            for listed_path, _ in listed.values())
+
+        lines = []
+        for relpath, digest in sorted(checksums.items()):
+            listed_path, binary = listed.get(
+                relpath,
+                (os.path.join(runfolder, relpath) if prefixed else relpath, False))
+            lines.append(f"{digest} {'*' if binary else ' '}{listed_path}\n")
+        return write_atomically(path, "".join(lines))
+
+    @staticmethod
+    def stat_files(runfolder_path, files):
+        stated = []
+        for f in files:
+            st = os.stat(os.path.join(runfolder_path, f["path"]))
+            stated.append(dict(f, size=st.st_size, mtime_ns=st.st_mtime_ns))
+        return stated
+
+    async def run(self, runfolder_path, mode="verify", progress=None):
+        """
+        Generate or verify the checksums of the fastq files in the runfolder, calling `progress`
+        with an event as files are hashed, and return a summary of the outcome
+        """
+        if mode not in self.modes:
+            raise ValueError(f"unknown checksum mode '{mode}', use one of {', '.join(self.modes)}")
+        runfolder_path = str(runfolder_path)
+        if runfolder_path in self.running:
+            raise ChecksumRunInProgress(
+                f"the checksums of {runfolder_path} are already being computed")
+        self.running.add(runfolder_path)
+        try:
+            loop = asyncio.get_running_loop()
+            lock_fd = await loop.run_in_executor(None, self.acquire_lock, runfolder_path)
+            try:
+                return await self._run(runfolder_path, mode, progress)
+            finally:
+                os.close(lock_fd)
+        finally:
+            self.running.discard(runfolder_path)
+
+    async def _run(self, runfolder_path, mode, progress):
+        loop = asyncio.get_running_loop()
+        inventory = await loop.run_in_executor(None, self.inventory_index.get, runfolder_path)
+        state = await loop.run_in_executor(None, self.load_state, runfolder_path)
+        checksums = dict(inventory.checksums)
+        fastqs = {
+            f["path"]: f for f in inventory.files() if f["path"].endswith(".fastq.gz")}
+        if mode == "generate":
+            targets = [fastqs[path] for path in sorted(fastqs) if path not in checksums]
+        else:
+            targets = [fastqs[path] for path in sorted(fastqs) if path in checksums]
+
+        # the inventory lists the files, but they are stat'ed again since a file may have been
+        # modified in place since its directory was listed
+        targets = await loop.run_in_executor(None, self.stat_files, runfolder_path, targets)
+        fastqs.update((f["path"], f) for f in targets)
+
+        digests, new_state = {}, {}
+        to_hash = []
+        for f in targets:
+            entry = state.get(f["path"])
+            if entry is not None and entry[0:2] == [f["size"], f["mtime_ns"]]:
+                digests[f["path"]] = entry[2]
+                new_state[f["path"]] = entry
+            else:
+                to_hash.append(f)
+
+        total_bytes = sum(f["size"] for f in to_hash)
+        counts = {"files": 0, "bytes": 0}
+        last_report = [time.monotonic()]
+
+        def _report(force=False):
+            if progress is None:
+                return
+            now = time.monotonic()
+            if force or now - last_report[0] >= self.progress_interval:
+                last_report[0] = now
+                progress({
+                    "event": "progress",
+                    "hashed": counts["files"],
+                    "total": len(to_hash),
+                    "bytes": counts["bytes"],
+                    "total_bytes": total_bytes})
+
+        semaphore = asyncio.Semaphore(self.workers)
+
+        async def _hash(f):
+            # hand the files to the pool a few at a time rather than queueing them all at once
+            async with semaphore:
+                future = self.executor.submit(
+                    md5_file,
+                    os.path.join(runfolder_path, f["path"]),
+                    self.buffer_size)
+                self.pending.add(future)
+                try:
+                    digest = await asyncio.wrap_future(future)
+                finally:
+                    self.pending.discard(future)
+            digests[f["path"]] = digest
+            new_state[f["path"]] = [f["size"], f["mtime_ns"], digest]
+            counts["files"] += 1
+            counts["bytes"] += f["size"]
+            CHECKSUM_BYTES.inc(f["size"])
+            _report()
+
+        _report(force=True)
+        try:
+            await gather_or_cancel(*[_hash(f) for f in to_hash])
+        finally:
+            # keep what has been hashed so far, also if the run is interrupted
+            for path, entry in state.items():
+                if path in fastqs and path not in new_state and \
+                        entry[0:2] == [fastqs[path]["size"], fastqs[path]["mtime_ns"]]:
+                    new_state[path] = entry
+            await loop.run_in_executor(None, self.write_state, runfolder_path, new_state)
+        _report(force=True)
+
+        result = {
+            "mode": mode,
+            "files": len(fastqs),
+            "hashed": len(to_hash),
+            "unchanged": len(targets) - len(to_hash)
+        }
+        if mode == "generate":
+            checksums.update(digests)
+            await loop.run_in_executor(None, self.write_checksums, runfolder_path, checksums)
+            result["generated"] = sorted(digests)
+        else:
+            result["verified"] = len(targets)
+            result["mismatched"] = sorted(
+                path for path, digest in digests.items() if digest != checksums[path])
+            result["unlisted"] = sorted(path for path in fastqs if path not in checksums)
+            result["missing"] = sorted(
+                path for path in checksums
+                if path.endswith(".fastq.gz") and path not in fastqs)
+            result["ok"] = not (result["mismatched"] or result["unlisted"] or result["missing"])
+        return result
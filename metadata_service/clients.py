@@ -1,28 +1,246 @@
 
 import aiohttp
+import asyncio
+import collections
 import json
 import logging
 import os
+import random
+import shutil
+import tempfile
+import time
+import weakref
 
+from metadata_service.metrics import UPSTREAM_RESPONSE_SIZE, UPSTREAM_RETRIES, track_stage
+from metadata_service.tracing import REQUEST_ID, REQUEST_ID_HEADER
 from metadata_service.utils import safe_outdir
 
 
 log = logging.getLogger(__name__)
 
 
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Keeps track of consecutive failed requests to an upstream service. After `threshold`
+    consecutive failures the circuit opens and requests fail fast for `reset_timeout` seconds,
+    after which a single trial request is let through. If it succeeds the circuit closes again,
+    otherwise it stays open for another `reset_timeout` seconds.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+
+    @property
+    def state(self):
+        if self.opened is None:
+            return "closed"
+        if time.monotonic() - self.opened >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        state = self.state
+        if state == "closed" or not self.threshold:
+            return True
+        if state == "half-open" and not self.trial:
+            self.trial = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial = False
+        if self.threshold and (self.failures >= self.threshold or self.opened is not None):
+            if self.opened is None:
+                log.warning(
+                    f"opening circuit after {self.failures} consecutive failed requests")
+            self.opened = time.monotonic()
+
+
 class ExternalRequest:
+    """
+    Base class for requests to an external service. The connection pool, the timeouts, the retries
+    of failed GET requests and the circuit breaker are configured with the keys in `client_config`:
 
-    def __init__(self, external_url):
+    connection_limit: the maximum number of connections in the pool
+    connection_limit_per_host: the maximum number of connections to the same host
+    keepalive_timeout: the number of seconds that idle connections are kept open
+    dns_cache_ttl: the number of seconds that DNS lookups are cached
+    timeout: the total number of seconds that a request may take
+    connect_timeout: the number of seconds that establishing a connection may take
+    retries: the number of times that a failed GET request is retried
+    retry_backoff: the base delay in seconds before a retry, doubled for each attempt and jittered
+    retry_backoff_max: the maximum delay in seconds before a retry
+    circuit_breaker_threshold: the number of consecutive failures that opens the circuit
+    circuit_breaker_reset: the number of seconds that the circuit stays open
+    """
+
+    upstream = "external"
+    retry_statuses = (502, 503, 504)
+
+    def __init__(self, external_url, client_config=None):
         self.external_url = external_url
         self.session = None
+        self.client_config = client_config or {}
+        self.circuit_breaker = CircuitBreaker(
+            threshold=self.client_config.get("circuit_breaker_threshold", 5),
+            reset_timeout=self.client_config.get("circuit_breaker_reset", 30))
+
+    def client_session(self):
+        cfg = self.client_config
+        connector = aiohttp.TCPConnector(
+            limit=cfg.get("connection_limit", 100),
+            limit_per_host=cfg.get("connection_limit_per_host", 0),
+            keepalive_timeout=cfg.get("keepalive_timeout", 30),
+            ttl_dns_cache=cfg.get("dns_cache_ttl", 300))
+        timeout = aiohttp.ClientTimeout(
+            total=cfg.get("timeout"),
+            connect=cfg.get("connect_timeout"))
+        return aiohttp.ClientSession(
+            self.external_url,
+            connector=connector,
+            timeout=timeout)
 
     async def external_session(self, app):
-        self.session = aiohttp.ClientSession(self.external_url)
+        self.session = self.client_session()
         yield
+        await self.close()
+
+    async def close(self):
         await self.session.close()
 
+    def backoff(self, attempt):
+        base = self.client_config.get("retry_backoff", 0.5)
+        cap = self.client_config.get("retry_backoff_max", 10)
+        return random.uniform(0, min(cap, base * 2 ** attempt))
+
+    async def get(self, url, **kwargs):
+        """
+        Make a GET request, retrying on connection errors, timeouts and gateway errors with a
+        jittered exponential backoff. Fails fast while the circuit breaker is open.
+        """
+        retries = self.client_config.get("retries", 3)
+        request_id = REQUEST_ID.get()
+        if request_id is not None:
+            # pass the request id on, so that the upstream logs can be matched to the request
+            kwargs["headers"] = dict(
+                kwargs.get("headers") or {},
+                **{REQUEST_ID_HEADER: request_id})
+        attempt = 0
+        while True:
+            if not self.circuit_breaker.allow():
+                raise CircuitOpenError(
+                    f"{self.__class__.__name__} is not making requests to {self.external_url} "
+                    f"since it has failed repeatedly, retry later")
+            try:
+                resp = await self.session.get(url, **kwargs)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as ex:
+                self.circuit_breaker.record_failure()
+                if attempt >= retries:
+                    raise
+                log.warning(f"GET {url} failed ({ex!r}), retrying")
+            else:
+                if resp.status < 500:
+                    self.circuit_breaker.record_success()
+                    return resp
+                self.circuit_breaker.record_failure()
+                if resp.status not in self.retry_statuses or attempt >= retries:
+                    return resp
+                log.warning(f"GET {url} returned status {resp.status}, retrying")
+                resp.release()
+
+            UPSTREAM_RETRIES.labels(upstream=self.upstream).inc()
+            await asyncio.sleep(self.backoff(attempt))
+            attempt += 1
+
+
+def _remove_spoolfile(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+class SnpseqDataResponse:
+    """
+    A response from snpseq-data, either held in memory as `body` or, if it was streamed to disk,
+    stored in the file `path`. The file is removed when the response is no longer referenced.
+    """
+
+    def __init__(self, body=None, etag=None, last_modified=None, path=None):
+        self.body = body
+        self.path = path
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched = time.monotonic()
+        if path is not None:
+            weakref.finalize(self, _remove_spoolfile, path)
+
+    def age(self):
+        return time.monotonic() - self.fetched
+
+    def write(self, dest):
+        if self.path is not None:
+            shutil.copyfile(self.path, dest)
+        else:
+            with open(dest, "wb") as fh:
+                fh.write(self.body)
+
 
 class SnpseqDataRequest(ExternalRequest):
+    """
+    Requests LIMS metadata for a flowcell from snpseq-data. Concurrent requests for the same
+    flowcell share a single upstream request. If `cache_ttl` is set, the responses are kept in an
+    in-memory cache keyed by flowcell id. Entries younger than `cache_ttl` seconds are used as they
+    are, older entries are revalidated with the upstream service using their ETag and Last-Modified
+    headers. At most `cache_max_entries` entries are kept, evicting the least recently used first.
+    If `stream` is set, successful responses are written to disk in chunks as they arrive instead
+    of being held in memory.
+    """
+
+    upstream = "snpseq_data"
+    chunk_size = 65536
+
+    def __init__(
+            self,
+            external_url,
+            cache_ttl=None,
+            cache_max_entries=128,
+            client_config=None,
+            stream=False):
+        super(SnpseqDataRequest, self).__init__(external_url, client_config=client_config)
+        self.cache_ttl = cache_ttl
+        self.cache_max_entries = cache_max_entries
+        self.cache = collections.OrderedDict()
+        self.inflight = {}
+        self.stream = stream
+        self._spooldir = None
+
+    @property
+    def spooldir(self):
+        if self._spooldir is None:
+            self._spooldir = tempfile.mkdtemp(prefix="snpseq_data")
+        return self._spooldir
+
+    async def close(self):
+        self.cache.clear()
+        if self._spooldir is not None:
+            shutil.rmtree(self._spooldir, ignore_errors=True)
+            self._spooldir = None
+        await super(SnpseqDataRequest, self).close()
 
     @staticmethod
     def flowcellid_from_runfolder(runfolder):
@@ -35,15 +253,71 @@ class SnpseqDataRequest(ExternalRequest):
         return '/api/containers', {
             'name': flowcell_id}
 
-    @safe_outdir
-    async def request_snpseq_data_metadata(self, runfolder_path, outdir):
-        flowcell_id = self.flowcellid_from_runfolder(runfolder_path)
-        lims_json = os.path.join(outdir, f"{flowcell_id}.lims.json")
+    def cache_put(self, flowcell_id, entry):
+        if self.cache_ttl is None:
+            return
+        self.cache[flowcell_id] = entry
+        self.cache.move_to_end(flowcell_id)
+        while self.cache_max_entries and len(self.cache) > self.cache_max_entries:
+            self.cache.popitem(last=False)
+
+    async def snpseq_data(self, flowcell_id):
+        entry = self.cache.get(flowcell_id)
+        if entry is not None and entry.age() < self.cache_ttl:
+            self.cache.move_to_end(flowcell_id)
+            log.debug(f"using cached snpseq-data response for {flowcell_id}")
+            return entry
+
+        if flowcell_id not in self.inflight:
+            task = asyncio.ensure_future(
+                self._revalidate(flowcell_id, entry))
+            self.inflight[flowcell_id] = task
+            task.add_done_callback(
+                lambda _: self.inflight.pop(flowcell_id, None))
+        else:
+            log.debug(f"joining in-flight snpseq-data request for {flowcell_id}")
+
+        # shield the shared request so that a cancelled caller does not cancel it for the others
+        return await asyncio.shield(self.inflight[flowcell_id])
+
+    async def _revalidate(self, flowcell_id, entry):
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+        entry = await self.fetch_snpseq_data(
+            flowcell_id,
+            headers=headers,
+            cached_entry=entry)
+        self.cache_put(flowcell_id, entry)
+        return entry
+
+    async def fetch_snpseq_data(self, flowcell_id, headers=None, cached_entry=None):
+        with track_stage("lims_fetch"):
+            return await self._fetch_snpseq_data(
+                flowcell_id,
+                headers=headers,
+                cached_entry=cached_entry)
+
+    async def _fetch_snpseq_data(self, flowcell_id, headers=None, cached_entry=None):
         url, params = self.data_request_url(flowcell_id)
-        resp = await self.session.get(
+        resp = await self.get(
             url,
-            params=params)
+            params=params,
+            headers=headers)
+
+        if resp.status == 304 and cached_entry is not None:
+            resp.release()
+            log.debug(f"snpseq-data response for {flowcell_id} has not been modified")
+            cached_entry.fetched = time.monotonic()
+            return cached_entry
 
+        if self.stream and resp.ok:
+            return await self._stream_response(resp)
+
+        UPSTREAM_RESPONSE_SIZE.labels(upstream=self.upstream).observe(len(await resp.read()))
         data = {}
         try:
             if resp.content_type == 'application/json':
@@ -57,7 +331,60 @@ class SnpseqDataRequest(ExternalRequest):
                 f"{self.__class__.__name__} received response status {resp.status} from "
                 f"{resp.url}: {data.get('error_message', resp.reason)}")
 
-        with open(lims_json, "w") as fh:
-            json.dump(data, fh, indent=2)
+        return SnpseqDataResponse(
+            json.dumps(data, indent=2).encode(),
+            etag=resp.headers.get("ETag"),
+            last_modified=resp.headers.get("Last-Modified"))
+
+    async def _stream_response(self, resp):
+        """
+        Write the response body to a spool file in chunks as it arrives. A body that was cut
+        short, or that does not look like a json document, is treated as an error, so that it is
+        never cached. The body is not parsed, so that it is never held in memory as a whole.
+        """
+        fd, path = tempfile.mkstemp(dir=self.spooldir, suffix=".lims.json")
+        entry = SnpseqDataResponse(
+            path=path,
+            etag=resp.headers.get("ETag"),
+            last_modified=resp.headers.get("Last-Modified"))
+        size = 0
+        start = None
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                try:
+                    async for chunk in resp.content.iter_chunked(self.chunk_size):
+                        if start is None and chunk.strip():
+                            start = chunk.lstrip()[0:1]
+                        fh.write(chunk)
+                        size += len(chunk)
+                except aiohttp.ClientPayloadError as ex:
+                    # aiohttp detects bodies that end before their length or final chunk
+                    raise Exception(
+                        f"{self.__class__.__name__} received response status {resp.status} "
+                        f"from {resp.url}: the response was cut short ({ex})")
+            UPSTREAM_RESPONSE_SIZE.labels(upstream=self.upstream).observe(size)
 
+            # the length of a compressed body is that of the compressed bytes
+            if resp.content_length is not None and "Content-Encoding" not in resp.headers \
+                    and size != resp.content_length:
+                raise Exception(
+                    f"{self.__class__.__name__} received response status {resp.status} from "
+                    f"{resp.url}: the response was cut short ({size} of {resp.content_length} "
+                    f"bytes)")
+            if start not in (b"{", b"["):
+                raise Exception(
+                    f"{self.__class__.__name__} received response status {resp.status} from "
+                    f"{resp.url}: the response is not a json document")
+        except BaseException:
+            os.unlink(path)
+            raise
+        return entry
+
+    @safe_outdir
+    async def request_snpseq_data_metadata(self, runfolder_path, outdir):
+        flowcell_id = self.flowcellid_from_runfolder(runfolder_path)
+        lims_json = os.path.join(outdir, f"{flowcell_id}.lims.json")
+        entry = await self.snpseq_data(flowcell_id)
+        # the response may be large, so copy it without blocking the event loop
+        await asyncio.get_running_loop().run_in_executor(None, entry.write, lims_json)
         return lims_json
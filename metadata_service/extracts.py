@@ -0,0 +1,79 @@
+import json
+import os
+
+
+class UnknownProjectsError(Exception):
+    """
+    Raised when projects are requested that are not in the runfolder
+    """
+
+    def __init__(self, projects, runfolder):
+        self.projects = sorted(projects)
+        self.runfolder = runfolder
+        super(UnknownProjectsError, self).__init__(
+            f"the project(s) {', '.join(self.projects)} were not sequenced in {runfolder}")
+
+
+def _load(extract_path):
+    with open(extract_path) as fh:
+        return json.load(fh)
+
+
+def _entries(extract):
+    """
+    The key under which an extract lists its entries and a function returning the project id of
+    an entry, for runfolder extracts (sequencing runs) and snpseq-data extracts (experiments)
+    """
+    if "sequencing_runs" in extract:
+        return "sequencing_runs", lambda run: run.get("experiment", {}).get(
+            "project", {}).get("project_id")
+    return "experiments", lambda experiment: experiment.get("project", {}).get("project_id")
+
+
+def extract_projects(extract_path):
+    """
+    Return the sorted ids of the projects in a runfolder extract or a snpseq-data extract
+    """
+    extract = _load(extract_path)
+    key, project_id = _entries(extract)
+    return sorted({
+        project_id(entry) for entry in extract.get(key, []) if project_id(entry)})
+
+
+def filter_extract(extract_path, projects, outdir):
+    """
+    Write a copy of a runfolder extract or a snpseq-data extract, with the same name, to `outdir`
+    with only the entries that belong to the given projects and return its path
+    """
+    extract = _load(extract_path)
+    key, project_id = _entries(extract)
+    extract[key] = [entry for entry in extract.get(key, []) if project_id(entry) in projects]
+    os.makedirs(outdir, exist_ok=True)
+    dest = os.path.join(outdir, os.path.basename(extract_path))
+    with open(dest, "w") as fh:
+        json.dump(extract, fh, indent=2)
+    return dest
+
+
+def split_extract(extract_path, projects, outdir):
+    """
+    Write one copy of a runfolder extract or a snpseq-data extract per project, with the same name,
+    to `outdir`/<project> with only the entries that belong to that project, and return a dict
+    with the path for each project
+    """
+    extract = _load(extract_path)
+    key, project_id = _entries(extract)
+    entries = {project: [] for project in projects}
+    for entry in extract.get(key, []):
+        if project_id(entry) in entries:
+            entries[project_id(entry)].append(entry)
+
+    paths = {}
+    for project in projects:
+        shard = dict(extract)
+        shard[key] = entries[project]
+        os.makedirs(os.path.join(outdir, project), exist_ok=True)
+        paths[project] = os.path.join(outdir, project, os.path.basename(extract_path))
+        with open(paths[project], "w") as fh:
+            json.dump(shard, fh, indent=2)
+    return paths
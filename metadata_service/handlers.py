@@ -1,17 +1,147 @@
 
+import asyncio
+import contextlib
+import datetime
+import functools
+import json
 import logging
 import os
 import pathlib
-import shutil
-import tempfile
+import time
 
 import importlib.metadata
 import aiohttp.web
 
+from metadata_service.admission import AdmissionController, AdmissionRejected
+from metadata_service.archives import \
+    ARCHIVE_FORMATS, ArchiveWriter, ArchiveWritersBusy, archive_members, archive_name
+from metadata_service.cache import runfolder_fingerprint, snpseq_data_fingerprint
+from metadata_service.checksums import ChecksumRunInProgress
+from metadata_service.extracts import \
+    UnknownProjectsError, extract_projects, filter_extract, split_extract
+from metadata_service.jobs import SchedulerClosedError
+from metadata_service.manifest import ExportManifest
+from metadata_service.metrics import EXPORTS_IN_PROGRESS, REGISTRY, track_stage
+from metadata_service.tracing import REQUEST_ID
+from metadata_service.utils import gather_or_cancel, query_flag, query_list
+from metadata_service.workspace import Workspace, link_or_copy
+
 
 log = logging.getLogger(__name__)
 
 
+@contextlib.contextmanager
+def report_stage(progress, stage):
+    """
+    Context manager that reports when an export stage starts and finishes to the `progress`
+    callback, if one is given. Details about the outcome of the stage can be added to the yielded
+    dict and will be included in the report.
+    """
+    outcome = {}
+    if progress is None:
+        yield outcome
+        return
+
+    start = time.perf_counter()
+    progress({"event": "started", "stage": stage})
+    try:
+        yield outcome
+    except Exception as ex:
+        progress({
+            "event": "failed",
+            "stage": stage,
+            "elapsed": round(time.perf_counter() - start, 3),
+            "exception": str(ex)})
+        raise
+    progress({
+        "event": "finished",
+        "stage": stage,
+        "elapsed": round(time.perf_counter() - start, 3),
+        **outcome})
+
+
+def stream_format(request):
+    stream = request.query.get("stream")
+    if stream is None and "text/event-stream" in request.headers.get("Accept", ""):
+        stream = "sse"
+    return stream
+
+
+def format_event(stream, event):
+    if stream == "sse":
+        return f"event: {event['event']}\ndata: {json.dumps(event)}\n\n".encode()
+    return f"{json.dumps(event)}\n".encode()
+
+
+def error_status(ex):
+    """
+    The HTTP status to report for an exception raised by an export or a checksum run
+    """
+    if isinstance(ex, AdmissionRejected):
+        return ex.status
+    if isinstance(ex, ChecksumRunInProgress):
+        return 409
+    return 400 if isinstance(ex, UnknownProjectsError) else 500
+
+
+def error_details(ex):
+    """
+    The exception, the HTTP status and, for rejected requests, when to retry, as reported for an
+    export that failed
+    """
+    details = {"exception": str(ex), "status": error_status(ex)}
+    if isinstance(ex, AdmissionRejected):
+        details["retry_after"] = ex.retry_after
+    return details
+
+
+async def stream_events(request, stream, run):
+    """
+    Run `run(progress)` and stream the events that it passes to the `progress` callback to the
+    client, followed by the event that it returns, or an error event, as newline-delimited json or
+    as server-sent events
+    """
+    response = aiohttp.web.StreamResponse(
+        status=200,
+        headers={
+            "Content-Type":
+                "text/event-stream" if stream == "sse" else "application/x-ndjson",
+            "Cache-Control": "no-cache"})
+    await response.prepare(request)
+
+    keepalive = float(request.app["config"].get("stream_keepalive", 15))
+    events = asyncio.Queue()
+
+    async def _run():
+        try:
+            events.put_nowait(await run(events.put_nowait))
+        except Exception as ex:
+            log.error(str(ex))
+            events.put_nowait({"event": "error", **error_details(ex)})
+        finally:
+            events.put_nowait(None)
+
+    task = asyncio.ensure_future(_run())
+    try:
+        while True:
+            try:
+                event = await asyncio.wait_for(events.get(), timeout=keepalive)
+            except asyncio.TimeoutError:
+                # let the client and any proxies know that the connection is alive
+                event = {"event": "keepalive"}
+            if event is None:
+                break
+            await response.write(format_event(stream, event))
+    finally:
+        # stop the work if the client went away
+        if not task.done():
+            task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    await response.write_eof()
+    return response
+
+
 class VersionHandler:
 
     def __init__(self):
@@ -27,62 +157,934 @@ class VersionHandler:
             return aiohttp.web.json_response({'exception': str(ex)}, status=500)
 
 
+class MetricsHandler:
+
+    def __init__(self, registry=REGISTRY):
+        self.registry = registry
+
+    async def metrics(self, request):
+        return aiohttp.web.Response(
+            text=self.registry.render(),
+            content_type="text/plain",
+            headers={"X-Content-Type-Options": "nosniff"})
+
+
+class ProfileHandler:
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+
+    async def start(self, request):
+        try:
+            body = await request.json() if request.can_read_body else {}
+            if not isinstance(body, dict):
+                raise ValueError("the request body should be a json object")
+            self.profiler.start(
+                body.get("mode", "sampling"),
+                body.get("requests", 1),
+                interval=body.get("interval", 0.005))
+        except (ValueError, TypeError) as ex:
+            return aiohttp.web.json_response({'exception': str(ex)}, status=400)
+        return aiohttp.web.json_response(self.profiler.status(), status=202)
+
+    async def report(self, request):
+        try:
+            limit = int(request.query.get("limit", 50))
+        except ValueError:
+            return aiohttp.web.json_response(
+                {'exception': "limit should be an integer"},
+                status=400)
+        response = self.profiler.status()
+        response["profile"] = self.profiler.report(limit=limit)
+        return aiohttp.web.json_response(response, status=200)
+
+
 class ExportHandler:
 
-    def __init__(self, process_runner):
+    def __init__(
+            self,
+            process_runner,
+            extract_cache=None,
+            workspace=None,
+            admission=None,
+            export_index=None,
+            shard_workers=None,
+            inventory_index=None):
         self.process_runner = process_runner
+        self.extract_cache = extract_cache
+        self.workspace = workspace or Workspace()
+        self.admission = admission or AdmissionController()
+        self.export_index = export_index
+        self.shard_workers = shard_workers
+        self.inventory_index = inventory_index
 
-    async def export(self, request):
+    async def runfolder_extract(self, runfolder_path, outdir, refresh=False, progress=None):
+        with report_stage(progress, "extract_runfolder") as outcome:
+            outcome["path"] = await self._runfolder_extract(
+                runfolder_path,
+                outdir,
+                refresh,
+                outcome)
+            return outcome["path"]
 
-        try:
-            host = request.match_info["host"]
-            runfolder = request.match_info["runfolder"]
-            lims_data = request.query.get("lims_data")
+    async def cached_extract(self, fingerprint, src, extract, cached_extract, refresh, outcome):
+        """
+        Copy the cached extract of `src`, keyed on `fingerprint(src)`, to `cached_extract` and
+        return it or, if there is none or `refresh` is set, return the extract made by awaiting
+        `extract()` after adding it to the cache
+        """
+        # without a cache, always run the extraction
+        if self.extract_cache is None:
+            return await extract()
+
+        loop = asyncio.get_running_loop()
+        key = await loop.run_in_executor(None, fingerprint, src)
+        if not refresh and await loop.run_in_executor(
+                None,
+                self.extract_cache.get,
+                key,
+                cached_extract):
+            log.info(f"using cached extract for {src}")
+            outcome["cached"] = True
+            return cached_extract
 
-            runfolder_path = pathlib.Path(
-                request.app["config"].get("datadir", ".").format(
-                    host=host,
-                    runfolder=runfolder
+        extract_path = await extract()
+        await loop.run_in_executor(None, self.extract_cache.put, key, extract_path)
+        return extract_path
+
+    async def _runfolder_extract(self, runfolder_path, outdir, refresh, outcome):
+        return await self.cached_extract(
+            functools.partial(runfolder_fingerprint, inventory_index=self.inventory_index),
+            runfolder_path,
+            functools.partial(
+                self.process_runner.extract_runfolder_metadata,
+                runfolder_path,
+                outdir),
+            os.path.join(outdir, f"{os.path.basename(runfolder_path)}.ngi.json"),
+            refresh,
+            outcome)
+
+    async def snpseq_data_extract(
+            self,
+            session,
+            runfolder_path,
+            metadata_export_path,
+            lims_data,
+            outdir,
+            lims_json=None,
+            refresh=False,
+            progress=None):
+        # unless a previous LIMS-export is passed as a parameter, or the LIMS data has already
+        # been fetched, do a request to the snpseq-data web service
+        if not lims_data and not lims_json:
+            with report_stage(progress, "lims_fetch") as outcome:
+                lims_data = await session.request_snpseq_data_metadata(
+                    runfolder_path,
+                    outdir
                 )
+                outcome["path"] = str(lims_data)
+        else:
+            lims_data_src = pathlib.Path(
+                lims_json or os.path.join(metadata_export_path, lims_data)
+            )
+            lims_data = pathlib.Path(
+                outdir,
+                lims_data_src.name
             )
-            metadata_export_path = os.path.join(runfolder_path, "metadata")
+            with report_stage(progress, "lims_copy") as outcome, track_stage("file_copy"):
+                outcome["method"] = link_or_copy(lims_data_src, lims_data)
+                outcome["path"] = str(lims_data)
+
+        with report_stage(progress, "extract_snpseq_data") as outcome:
+            outcome["path"] = await self._snpseq_data_extract(lims_data, outdir, refresh, outcome)
+            return outcome["path"]
+
+    async def _snpseq_data_extract(self, lims_data, outdir, refresh, outcome):
+        return await self.cached_extract(
+            snpseq_data_fingerprint,
+            lims_data,
+            functools.partial(
+                self.process_runner.extract_snpseq_data_metadata,
+                lims_data,
+                outdir),
+            os.path.join(
+                outdir,
+                f"{'.'.join(os.path.basename(lims_data).split('.')[0:-1])}.ngi.json"),
+            refresh,
+            outcome)
+
+    async def run_export(
+            self,
+            app,
+            host,
+            runfolder,
+            lims_data=None,
+            refresh=False,
+            lims_json=None,
+            projects=None,
+            progress=None):
+        if self.export_index is None:
+            return await self._run_export(
+                app,
+                host,
+                runfolder,
+                lims_data=lims_data,
+                refresh=refresh,
+                lims_json=lims_json,
+                projects=projects,
+                progress=progress)
+
+        record = {
+            "host": host,
+            "runfolder": runfolder,
+            "flowcell_id": app['session'].flowcellid_from_runfolder(runfolder),
+            "status": "failed",
+            "started": time.time(),
+            "stages": {},
+            "request_id": REQUEST_ID.get()
+        }
+
+        def _progress(event):
+            if event["event"] in ("finished", "failed"):
+                record["stages"][event["stage"]] = event["elapsed"]
+            if progress is not None:
+                progress(event)
+
+        try:
+            record["outputs"] = await self._run_export(
+                app,
+                host,
+                runfolder,
+                lims_data=lims_data,
+                refresh=refresh,
+                lims_json=lims_json,
+                projects=projects,
+                progress=_progress,
+                record=record)
+            record["status"] = "done"
+            return record["outputs"]
+        except BaseException as ex:
+            record["exception"] = str(ex) or ex.__class__.__name__
+            raise
+        finally:
+            record["finished"] = time.time()
+            await asyncio.get_running_loop().run_in_executor(None, self.record_export, record)
 
-            with tempfile.TemporaryDirectory(prefix="extract", suffix="runfolder") as outdir:
-                # unless a previous LIMS-export is passed as a parameter, do a request to the
-                # snpseq-data web service
-                if not lims_data:
-                    lims_data = await request.app['session'].request_snpseq_data_metadata(
+    def record_export(self, record):
+        try:
+            self.export_index.record(**record)
+        except Exception as ex:
+            log.warning(
+                f"unable to record the export of {record['host']}/{record['runfolder']} in the "
+                f"export index: {ex}")
+
+    async def _run_export(
+            self,
+            app,
+            host,
+            runfolder,
+            lims_data=None,
+            refresh=False,
+            lims_json=None,
+            projects=None,
+            progress=None,
+            record=None):
+        runfolder_path = pathlib.Path(
+            app["config"].get("datadir", ".").format(
+                host=host,
+                runfolder=runfolder
+            )
+        )
+        metadata_export_path = os.path.join(runfolder_path, "metadata")
+
+        with EXPORTS_IN_PROGRESS.track_inprogress(), track_stage("total"):
+            async with self.workspace.directory() as outdir:
+                # the LIMS metadata and the runfolder metadata are independent of each other so
+                # extract them concurrently and join before the export
+                snpseq_data_extract, runfolder_extract = await gather_or_cancel(
+                    self.snpseq_data_extract(
+                        app['session'],
                         runfolder_path,
-                        outdir
-                    )
-                else:
-                    lims_data_src = pathlib.Path(
                         metadata_export_path,
-                        lims_data
-                    )
-                    lims_data = pathlib.Path(
+                        lims_data,
+                        outdir,
+                        lims_json=lims_json,
+                        refresh=refresh,
+                        progress=progress
+                    ),
+                    self.runfolder_extract(
+                        runfolder_path,
                         outdir,
-                        lims_data
+                        refresh=refresh,
+                        progress=progress
                     )
-                    shutil.copy(lims_data_src, lims_data)
-
-                snpseq_data_extract = self.process_runner.extract_snpseq_data_metadata(
-                    lims_data,
-                    outdir
-                )
-
-                runfolder_extract = self.process_runner.extract_runfolder_metadata(
-                    runfolder_path,
-                    outdir
                 )
+                if projects:
+                    with report_stage(progress, "filter_projects") as outcome, \
+                            track_stage("filter_projects"):
+                        runfolder_extract, snpseq_data_extract = \
+                            await asyncio.get_running_loop().run_in_executor(
+                                None,
+                                self.filter_extracts,
+                                runfolder_extract,
+                                snpseq_data_extract,
+                                projects,
+                                os.path.join(outdir, "projects"))
+                        outcome["projects"] = projects
+                if record is not None:
+                    record["projects"] = await asyncio.get_running_loop().run_in_executor(
+                        None,
+                        extract_projects,
+                        runfolder_extract)
 
-                metadata_export = self.process_runner.export_runfolder_metadata(
+                with report_stage(progress, "export") as outcome:
+                    outcome["paths"] = await self.export_runfolder_metadata(
                         runfolder_extract,
                         snpseq_data_extract,
-                        metadata_export_path
+                        metadata_export_path,
+                        outdir,
+                        refresh=refresh,
+                        outcome=outcome
+                    )
+                    if record is not None:
+                        record["inputs"] = outcome.get("inputs")
+                        record["skipped"] = outcome.get("skipped", False)
+                    return outcome["paths"]
+
+    async def export_shards(self, runfolder_extract, snpseq_data_extract, outdir, outcome=None):
+        """
+        Export the metadata to a staging directory and return the exported files. If sharding is
+        enabled and the extracts have more than one project, the extracts are split by project and
+        the projects are exported in parallel, by at most `shard_workers` exports at a time, each
+        to its own staging directory.
+        """
+        loop = asyncio.get_running_loop()
+        projects = []
+        if self.shard_workers and self.shard_workers > 1:
+            projects = sorted(set().union(*await gather_or_cancel(*[
+                loop.run_in_executor(None, extract_projects, extract)
+                for extract in (runfolder_extract, snpseq_data_extract)])))
+        if len(projects) < 2:
+            return await self.process_runner.export_runfolder_metadata(
+                runfolder_extract,
+                snpseq_data_extract,
+                os.path.join(outdir, "export")
+            )
+
+        shards = await loop.run_in_executor(
+            None,
+            self.split_extracts,
+            runfolder_extract,
+            snpseq_data_extract,
+            projects,
+            os.path.join(outdir, "shards"))
+        if outcome is not None:
+            outcome["shards"] = len(shards)
+        semaphore = asyncio.Semaphore(self.shard_workers)
+
+        async def _export_shard(project, shard_runfolder_extract, shard_snpseq_data_extract):
+            async with semaphore:
+                return await self.process_runner.export_runfolder_metadata(
+                    shard_runfolder_extract,
+                    shard_snpseq_data_extract,
+                    os.path.join(outdir, "export", project)
                 )
 
+        shard_outputs = await gather_or_cancel(*[
+            _export_shard(project, *shards[project]) for project in projects])
+        return [output for outputs in shard_outputs for output in outputs]
+
+    @staticmethod
+    def split_extracts(runfolder_extract, snpseq_data_extract, projects, outdir):
+        """
+        Split the runfolder extract and the snpseq-data extract by project and return a dict with
+        the pair of extracts for each project
+        """
+        runfolder_extracts = split_extract(runfolder_extract, projects, outdir)
+        snpseq_data_extracts = split_extract(snpseq_data_extract, projects, outdir)
+        return {
+            project: (runfolder_extracts[project], snpseq_data_extracts[project])
+            for project in projects
+        }
+
+    @staticmethod
+    def filter_extracts(runfolder_extract, snpseq_data_extract, projects, outdir):
+        """
+        Prune the extracts to the sequencing runs and experiments of the given projects, so that
+        only those projects are exported
+        """
+        missing = set(projects) - set(extract_projects(runfolder_extract))
+        if missing:
+            raise UnknownProjectsError(
+                missing,
+                os.path.basename(runfolder_extract).replace('.ngi.json', ''))
+        return (
+            filter_extract(runfolder_extract, projects, outdir),
+            filter_extract(snpseq_data_extract, projects, outdir))
+
+    async def export_runfolder_metadata(
+            self,
+            runfolder_extract,
+            snpseq_data_extract,
+            metadata_export_path,
+            outdir,
+            refresh=False,
+            outcome=None):
+        """
+        Export the metadata to the metadata directory, unless the manifest there shows that the
+        current outputs were exported from identical extracts. The export is made to a staging
+        directory in the workspace first, so that only the files produced by this export are
+        reported, and then atomically published to the metadata directory.
+        """
+        loop = asyncio.get_running_loop()
+        manifest = ExportManifest(metadata_export_path)
+        inputs = await loop.run_in_executor(
+            None,
+            manifest.input_digests,
+            runfolder_extract,
+            snpseq_data_extract)
+        if outcome is not None:
+            outcome["inputs"] = inputs
+
+        if not refresh:
+            outputs = await loop.run_in_executor(None, manifest.up_to_date, inputs)
+            if outputs is not None:
+                log.info(f"metadata in {metadata_export_path} is up-to-date, skipping export")
+                if outcome is not None:
+                    outcome["skipped"] = True
+                return outputs
+
+        staged_outputs = await self.export_shards(
+            runfolder_extract,
+            snpseq_data_extract,
+            outdir,
+            outcome=outcome)
+        outputs = await loop.run_in_executor(
+            None,
+            self.workspace.publish,
+            staged_outputs,
+            metadata_export_path)
+        await loop.run_in_executor(None, manifest.write, inputs, outputs)
+        return outputs
+
+    async def stream_export(self, request, stream, priority="normal"):
+        """
+        Run the export once it has been admitted and stream an event to the client as each stage
+        starts and finishes, followed by the result, as newline-delimited json or as server-sent
+        events. The stream is started before the export is admitted, so that a request that has to
+        wait for a slot is told so and kept alive while it waits.
+        """
+        host = request.match_info["host"]
+
+        async def _run_export(progress):
+            if not self.admission.has_capacity(host):
+                progress({"event": "queued"})
+            metadata_export = await self.admitted_export(
+                request.app,
+                host,
+                request.match_info["runfolder"],
+                request.query.get("lims_data"),
+                refresh=query_flag(request, "refresh"),
+                projects=query_list(request, "project"),
+                progress=progress,
+                priority=priority
+            )
+            return {"event": "result", "metadata": metadata_export}
+
+        return await stream_events(request, stream, _run_export)
+
+    async def export(self, request):
+
+        stream = stream_format(request)
+        if stream is not None and stream not in ("ndjson", "sse"):
+            return aiohttp.web.json_response(
+                {'exception': f"unknown stream format '{stream}', use 'ndjson' or 'sse'"},
+                status=400)
+        try:
+            priority = self.parse_priority(request)
+        except ValueError as ex:
+            return aiohttp.web.json_response({'exception': str(ex)}, status=400)
+
+        if stream is not None:
+            return await self.stream_export(request, stream, priority=priority)
+        try:
+            async with self.admission.admit(request.match_info["host"], priority=priority):
+                return await self._export(request)
+        except AdmissionRejected as ex:
+            return aiohttp.web.json_response(
+                {'exception': str(ex)},
+                status=ex.status,
+                headers={"Retry-After": str(ex.retry_after)})
+
+    async def _export(self, request):
+        try:
+            metadata_export = await self.run_export(
+                request.app,
+                request.match_info["host"],
+                request.match_info["runfolder"],
+                request.query.get("lims_data"),
+                refresh=query_flag(request, "refresh"),
+                projects=query_list(request, "project")
+            )
             return aiohttp.web.json_response({'metadata': metadata_export}, status=200)
+        except Exception as ex:
+            log.error(str(ex))
+            return aiohttp.web.json_response({'exception': str(ex)}, status=error_status(ex))
+
+    async def admitted_export(
+            self,
+            app,
+            host,
+            runfolder,
+            *args,
+            priority="normal",
+            bounded=True,
+            **kwargs):
+        """
+        Run the export once it has been admitted by the admission control, so that exports
+        started in the background count towards the same limits as requests to the export
+        endpoint. Unless `bounded`, the export waits for a slot rather than being rejected when
+        the queue is full or the wait is too long.
+        """
+        async with self.admission.admit(host, priority=priority, bounded=bounded):
+            return await self.run_export(app, host, runfolder, *args, **kwargs)
+
+    def parse_priority(self, request):
+        priority = request.query.get("priority", "normal")
+        if priority not in self.admission.priorities:
+            raise ValueError(
+                f"unknown priority '{priority}', use one of {', '.join(self.admission.priorities)}")
+        return priority
+
+    async def run_batch_export(
+            self,
+            app,
+            runfolders,
+            concurrency,
+            refresh=False,
+            priority="normal"):
+        """
+        Export the runfolders, given as a list of dicts with the keys host, runfolder and,
+        optionally, lims_data, with at most `concurrency` exports running at a time. Each export
+        also has to be admitted by the admission control. Runfolders on the same flowcell share
+        one request to snpseq-data. A result is returned for each runfolder, with either the
+        exported metadata or the exception that was raised.
+        """
+        semaphore = asyncio.Semaphore(max(int(concurrency), 1))
+        session = app['session']
+        lims_lookups = {}
+
+        async with self.workspace.directory() as limsdir:
+
+            def _lims_lookup(runfolder):
+                flowcell_id = session.flowcellid_from_runfolder(runfolder)
+                if flowcell_id not in lims_lookups:
+                    lims_lookups[flowcell_id] = asyncio.ensure_future(
+                        session.request_snpseq_data_metadata(
+                            runfolder,
+                            limsdir
+                        )
+                    )
+                return lims_lookups[flowcell_id]
+
+            async def _export(item):
+                result = {
+                    "host": item.get("host"),
+                    "runfolder": item.get("runfolder")
+                }
+                try:
+                    if not result["host"] or not result["runfolder"]:
+                        raise Exception(
+                            "each runfolder must be specified with a host and a runfolder name")
+                    projects = item.get("projects")
+                    if projects is not None and not isinstance(projects, list):
+                        raise Exception("the projects must be given as a list of project ids")
+                    projects = sorted(set(projects)) if projects else None
+                    async with semaphore:
+                        lims_json = None
+                        if not item.get("lims_data"):
+                            lims_json = await asyncio.shield(_lims_lookup(result["runfolder"]))
+                        result["metadata"] = await self.admitted_export(
+                            app,
+                            result["host"],
+                            result["runfolder"],
+                            lims_data=item.get("lims_data"),
+                            refresh=refresh,
+                            lims_json=lims_json,
+                            projects=projects,
+                            priority=priority
+                        )
+                except Exception as ex:
+                    log.error(f"export of {result['host']}/{result['runfolder']} failed: {ex}")
+                    result.update(error_details(ex))
+                return result
+
+            try:
+                return await asyncio.gather(*[_export(item) for item in runfolders])
+            finally:
+                await asyncio.gather(*lims_lookups.values(), return_exceptions=True)
+
+    async def batch_export(self, request):
+        try:
+            body = await request.json()
+            runfolders = body["runfolders"]
+            if not isinstance(runfolders, list) or not all(
+                    isinstance(item, dict) for item in runfolders):
+                raise ValueError()
+        except Exception:
+            return aiohttp.web.json_response(
+                {'exception': "the request body should be a json object with a list of objects "
+                              "with host and runfolder under the key 'runfolders'"},
+                status=400)
+
+        try:
+            max_concurrency = int(request.app["config"].get("batch_concurrency", 4))
+            concurrency = body.get("concurrency", max_concurrency)
+            if isinstance(concurrency, bool) or not isinstance(concurrency, int):
+                raise ValueError("the concurrency should be an integer")
+            concurrency = min(concurrency, max_concurrency)
+            priority = self.parse_priority(request)
+        except ValueError as ex:
+            return aiohttp.web.json_response({'exception': str(ex)}, status=400)
+
+        try:
+            results = await self.run_batch_export(
+                request.app,
+                runfolders,
+                concurrency,
+                refresh=query_flag(request, "refresh"),
+                priority=priority
+            )
+            return aiohttp.web.json_response({'results': results}, status=200)
+        except Exception as ex:
+            log.error(str(ex))
+            return aiohttp.web.json_response({'exception': str(ex)}, status=500)
+
+
+class ExportIndexHandler:
+
+    max_limit = 500
+
+    def __init__(self, export_index):
+        self.export_index = export_index
+
+    @staticmethod
+    def parse_timestamp(value):
+        if value is None:
+            return None
+        try:
+            return datetime.datetime.fromisoformat(value).timestamp()
+        except ValueError:
+            raise ValueError(f"'{value}' is not a date in ISO format, e.g. 2021-04-15")
+
+    async def latest(self, request):
+        host = request.match_info["host"]
+        runfolder = request.match_info["runfolder"]
+        try:
+            export = await asyncio.get_running_loop().run_in_executor(
+                None,
+                functools.partial(
+                    self.export_index.latest,
+                    host,
+                    runfolder,
+                    status=request.query.get("status")))
+        except Exception as ex:
+            log.error(str(ex))
+            return aiohttp.web.json_response({'exception': str(ex)}, status=500)
+        if export is None:
+            return aiohttp.web.json_response(
+                {'exception': f"no export of {host}/{runfolder} has been recorded"},
+                status=404)
+        return aiohttp.web.json_response(export, status=200)
+
+    async def list(self, request):
+        try:
+            limit = min(int(request.query.get("limit", 50)), self.max_limit)
+            offset = int(request.query.get("offset", 0))
+            if limit < 1 or offset < 0:
+                raise ValueError("limit must be positive and offset must not be negative")
+            filters = {
+                "host": request.query.get("host"),
+                "runfolder": request.query.get("runfolder"),
+                "flowcell_id": request.query.get("flowcell_id"),
+                "project": request.query.get("project"),
+                "status": request.query.get("status"),
+                "since": self.parse_timestamp(request.query.get("since")),
+                "until": self.parse_timestamp(request.query.get("until"))
+            }
+        except ValueError as ex:
+            return aiohttp.web.json_response({'exception': str(ex)}, status=400)
+
+        try:
+            exports, total = await asyncio.get_running_loop().run_in_executor(
+                None,
+                functools.partial(self.export_index.list, limit=limit, offset=offset, **filters))
+        except Exception as ex:
+            log.error(str(ex))
+            return aiohttp.web.json_response({'exception': str(ex)}, status=500)
+
+        response = {
+            "exports": exports,
+            "total": total,
+            "limit": limit,
+            "offset": offset,
+            "next": None
+        }
+        if offset + limit < total:
+            response["next"] = str(request.rel_url.update_query(offset=offset + limit))
+        return aiohttp.web.json_response(response, status=200)
+
+
+class InventoryHandler:
+
+    def __init__(self, inventory_index):
+        self.inventory_index = inventory_index
+
+    async def inventory(self, request):
+        host = request.match_info["host"]
+        runfolder = request.match_info["runfolder"]
+        runfolder_path = request.app["config"].get("datadir", ".").format(
+            host=host,
+            runfolder=runfolder
+        )
+        projects = query_list(request, "project")
+        try:
+            inventory = await asyncio.get_running_loop().run_in_executor(
+                None,
+                self.inventory_index.get,
+                runfolder_path)
+            response = inventory.to_dict()
+        except FileNotFoundError as ex:
+            return aiohttp.web.json_response({'exception': str(ex)}, status=404)
+        except Exception as ex:
+            log.error(str(ex))
+            return aiohttp.web.json_response({'exception': str(ex)}, status=500)
+
+        if projects:
+            response["files"] = [f for f in response["files"] if f.get("project") in projects]
+            response["total_size"] = sum(f["size"] for f in response["files"])
+        return aiohttp.web.json_response(response, status=200)
+
+
+class ChecksumHandler:
+
+    def __init__(self, checksum_runner):
+        self.checksum_runner = checksum_runner
+
+    async def checksums(self, request):
+        runfolder_path = request.app["config"].get("datadir", ".").format(
+            host=request.match_info["host"],
+            runfolder=request.match_info["runfolder"]
+        )
+        mode = request.query.get("mode", "verify")
+        stream = stream_format(request)
+        if mode not in self.checksum_runner.modes:
+            return aiohttp.web.json_response(
+                {'exception': f"unknown checksum mode '{mode}', use one of "
+                              f"{', '.join(self.checksum_runner.modes)}"},
+                status=400)
+        if stream is not None and stream not in ("ndjson", "sse"):
+            return aiohttp.web.json_response(
+                {'exception': f"unknown stream format '{stream}', use 'ndjson' or 'sse'"},
+                status=400)
+        if not os.path.isdir(runfolder_path):
+            return aiohttp.web.json_response(
+                {'exception': f"runfolder {runfolder_path} does not exist"},
+                status=404)
+        if runfolder_path in self.checksum_runner.running:
+            return aiohttp.web.json_response(
+                {'exception': f"the checksums of {runfolder_path} are already being computed"},
+                status=409)
+
+        if stream is not None:
+            async def _run(progress):
+                result = await self.checksum_runner.run(runfolder_path, mode, progress=progress)
+                return {"event": "result", **result}
+
+            return await stream_events(request, stream, _run)
+
+        try:
+            result = await self.checksum_runner.run(runfolder_path, mode)
+        except ChecksumRunInProgress as ex:
+            return aiohttp.web.json_response({'exception': str(ex)}, status=409)
+        except Exception as ex:
+            log.error(str(ex))
+            return aiohttp.web.json_response({'exception': str(ex)}, status=500)
+        return aiohttp.web.json_response(result, status=200)
+
+
+class DownloadHandler:
+    """
+    Serves the files of the latest export of a runfolder, as recorded in the export manifest in
+    its metadata directory, one by one or as a zip or tar.gz archive
+    """
+
+    def __init__(self, archive_writer=None):
+        self.archive_writer = archive_writer or ArchiveWriter()
+
+    @staticmethod
+    def exported_files(request):
+        """
+        Return a dict with the path and size of each file of the latest export of the runfolder,
+        by name. Only the files directly inside the metadata directory of the runfolder are
+        returned, whatever else the manifest lists.
+        """
+        runfolder_path = request.app["config"].get("datadir", ".").format(
+            host=request.match_info["host"],
+            runfolder=request.match_info["runfolder"]
+        )
+        metadata_path = os.path.join(runfolder_path, "metadata")
+        manifest = ExportManifest(metadata_path).load()
+        if manifest is None:
+            raise FileNotFoundError(
+                f"no export of {request.match_info['runfolder']} was found")
+        metadata_path = os.path.realpath(metadata_path)
+        files = {}
+        for path in manifest.get("outputs", {}):
+            path = os.path.realpath(path)
+            if os.path.dirname(path) != metadata_path:
+                log.warning(f"not serving {path}, which is outside of {metadata_path}")
+                continue
+            try:
+                files[os.path.basename(path)] = (path, os.stat(path).st_size)
+            except FileNotFoundError:
+                pass
+        return files
+
+    async def files(self, request):
+        loop = asyncio.get_running_loop()
+        archive_format = request.query.get("format")
+        if archive_format is not None and archive_format not in ARCHIVE_FORMATS:
+            return aiohttp.web.json_response(
+                {'exception': f"unknown archive format '{archive_format}', use one of "
+                              f"{', '.join(ARCHIVE_FORMATS)}"},
+                status=400)
+        try:
+            files = await loop.run_in_executor(None, self.exported_files, request)
+        except FileNotFoundError as ex:
+            return aiohttp.web.json_response({'exception': str(ex)}, status=404)
         except Exception as ex:
             log.error(str(ex))
             return aiohttp.web.json_response({'exception': str(ex)}, status=500)
+
+        projects = query_list(request, "project")
+        if projects:
+            files = {
+                name: entry for name, entry in files.items()
+                if any(
+                    name.startswith(f"{project}-") or name.startswith(f"{project}.")
+                    for project in projects)}
+
+        if archive_format is None:
+            return aiohttp.web.json_response({
+                "files": [
+                    {
+                        "name": name,
+                        "size": size,
+                        "url": str(request.rel_url.with_query(None) / name)
+                    }
+                    for name, (path, size) in sorted(files.items())
+                ]
+            }, status=200)
+
+        runfolder = request.match_info["runfolder"]
+        response = aiohttp.web.StreamResponse(
+            status=200,
+            headers={
+                "Content-Type": ARCHIVE_FORMATS[archive_format][0],
+                "Content-Disposition":
+                    f'attachment; filename="{archive_name(runfolder, archive_format)}"'})
+        try:
+            await self.archive_writer.stream(
+                request,
+                response,
+                archive_format,
+                archive_members(runfolder, [path for path, _ in files.values()]))
+        except ArchiveWritersBusy as ex:
+            log.warning(str(ex))
+            return aiohttp.web.json_response(
+                {'exception': str(ex)},
+                status=503,
+                headers={"Retry-After": str(ex.retry_after)})
+        await response.write_eof()
+        return response
+
+    async def file(self, request):
+        try:
+            files = await asyncio.get_running_loop().run_in_executor(
+                None,
+                self.exported_files,
+                request)
+        except FileNotFoundError as ex:
+            return aiohttp.web.json_response({'exception': str(ex)}, status=404)
+        except Exception as ex:
+            log.error(str(ex))
+            return aiohttp.web.json_response({'exception': str(ex)}, status=500)
+
+        # only the exported files in the metadata directory are served, whatever the file name in
+        # the request
+        if request.match_info["filename"] not in files:
+            return aiohttp.web.json_response(
+                {'exception': f"{request.match_info['filename']} is not an exported file"},
+                status=404)
+        path, _ = files[request.match_info["filename"]]
+        return aiohttp.web.FileResponse(
+            path,
+            headers={"Content-Disposition": f'attachment; filename="{os.path.basename(path)}"'})
+
+
+class JobHandler:
+
+    def __init__(self, export_handler, scheduler):
+        self.export_handler = export_handler
+        self.scheduler = scheduler
+
+    def job_url(self, request, job):
+        return f"{request.app['config'].get('base_url', '')}/jobs/{job.job_id}"
+
+    async def submit(self, request):
+        projects = query_list(request, "project")
+        try:
+            priority = self.export_handler.parse_priority(request)
+        except ValueError as ex:
+            return aiohttp.web.json_response({'exception': str(ex)}, status=400)
+        try:
+            job = self.scheduler.submit(
+                functools.partial(
+                    self.export_handler.admitted_export,
+                    request.app,
+                    refresh=query_flag(request, "refresh"),
+                    projects=projects,
+                    priority=priority,
+                    bounded=False),
+                request.match_info["host"],
+                request.match_info["runfolder"],
+                request.query.get("lims_data"),
+                projects=projects
+            )
+            response = job.to_dict()
+            response["url"] = self.job_url(request, job)
+            return aiohttp.web.json_response(response, status=202)
+        except SchedulerClosedError as ex:
+            log.warning(str(ex))
+            return aiohttp.web.json_response(
+                {'exception': str(ex)},
+                status=503,
+                headers={"Retry-After": "30"})
+        except Exception as ex:
+            log.error(str(ex))
+            return aiohttp.web.json_response({'exception': str(ex)}, status=500)
+
+    async def status(self, request):
+        job_id = request.match_info["job_id"]
+        job = self.scheduler.get(job_id)
+        if job is None:
+            return aiohttp.web.json_response(
+                {'exception': f"no export job with id {job_id}"},
+                status=404)
+        return aiohttp.web.json_response(job.to_dict(), status=200)
+
+    async def list(self, request):
+        return aiohttp.web.json_response(
+            {'jobs': [job.to_dict() for job in self.scheduler.list()]},
+            status=200)
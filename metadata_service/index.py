@@ -0,0 +1,213 @@
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+
+log = logging.getLogger(__name__)
+
+
+class ExportIndex:
+    """
+    A local SQLite database with a record of every export made by the service: the runfolder,
+    host and flowcell, the projects, the digests of the extracts, the exported files, the time
+    spent in each stage and the outcome. The database can be shared by several worker processes.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS exports (
+            export_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            host TEXT NOT NULL,
+            runfolder TEXT NOT NULL,
+            flowcell_id TEXT,
+            status TEXT NOT NULL,
+            skipped INTEGER NOT NULL DEFAULT 0,
+            started REAL NOT NULL,
+            finished REAL NOT NULL,
+            inputs TEXT,
+            outputs TEXT,
+            stages TEXT,
+            exception TEXT,
+            request_id TEXT
+        );
+        CREATE INDEX IF NOT EXISTS exports_runfolder ON exports (host, runfolder, finished);
+        CREATE INDEX IF NOT EXISTS exports_flowcell ON exports (flowcell_id, finished);
+        CREATE INDEX IF NOT EXISTS exports_finished ON exports (finished);
+        CREATE TABLE IF NOT EXISTS export_projects (
+            export_id INTEGER NOT NULL REFERENCES exports (export_id) ON DELETE CASCADE,
+            project_id TEXT NOT NULL,
+            PRIMARY KEY (project_id, export_id)
+        );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self._connection = None
+
+    @property
+    def connection(self):
+        # connect lazily, so that each worker process opens its own connection
+        if self._connection is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA foreign_keys=ON")
+            connection.executescript(self.schema)
+            self._connection = connection
+        return self._connection
+
+    def close(self):
+        with self.lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    async def index_context(self, app):
+        yield
+        self.close()
+
+    def record(
+            self,
+            host,
+            runfolder,
+            status,
+            started,
+            finished,
+            flowcell_id=None,
+            projects=None,
+            skipped=False,
+            inputs=None,
+            outputs=None,
+            stages=None,
+            exception=None,
+            request_id=None):
+        """
+        Add an export to the index and return its id
+        """
+        with self.lock, self.connection as connection:
+            cursor = connection.execute(
+                "INSERT INTO exports (host, runfolder, flowcell_id, status, skipped, started, "
+                "finished, inputs, outputs, stages, exception, request_id) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    host,
+                    runfolder,
+                    flowcell_id,
+                    status,
+                    int(bool(skipped)),
+                    started,
+                    finished,
+                    json.dumps(inputs) if inputs is not None else None,
+                    json.dumps(outputs) if outputs is not None else None,
+                    json.dumps(stages) if stages is not None else None,
+                    exception,
+                    request_id))
+            export_id = cursor.lastrowid
+            connection.executemany(
+                "INSERT OR IGNORE INTO export_projects (export_id, project_id) VALUES (?, ?)",
+                [(export_id, project_id) for project_id in projects or []])
+        return export_id
+
+    @staticmethod
+    def _isoformat(timestamp):
+        return datetime.datetime.fromtimestamp(timestamp).isoformat()
+
+    def _to_dict(self, row, projects):
+        entry = {
+            "export_id": row["export_id"],
+            "host": row["host"],
+            "runfolder": row["runfolder"],
+            "flowcell_id": row["flowcell_id"],
+            "projects": projects,
+            "status": row["status"],
+            "skipped": bool(row["skipped"]),
+            "started": self._isoformat(row["started"]),
+            "finished": self._isoformat(row["finished"]),
+            "request_id": row["request_id"]
+        }
+        for key in ("inputs", "stages"):
+            entry[key] = json.loads(row[key]) if row[key] is not None else None
+        if row["status"] == "done":
+            entry["metadata"] = json.loads(row["outputs"]) if row["outputs"] is not None else []
+        else:
+            entry["exception"] = row["exception"]
+        return entry
+
+    def _projects(self, connection, export_ids):
+        projects = {export_id: [] for export_id in export_ids}
+        if export_ids:
+            rows = connection.execute(
+                f"SELECT export_id, project_id FROM export_projects WHERE export_id IN "
+                f"({', '.join('?' * len(export_ids))}) ORDER BY project_id",
+                export_ids)
+            for row in rows:
+                projects[row["export_id"]].append(row["project_id"])
+        return projects
+
+    def latest(self, host, runfolder, status=None):
+        """
+        Return the latest export of the runfolder, optionally with the given status, or None
+        """
+        query = "SELECT * FROM exports WHERE host = ? AND runfolder = ?"
+        params = [host, runfolder]
+        if status is not None:
+            query += " AND status = ?"
+            params.append(status)
+        query += " ORDER BY finished DESC, export_id DESC LIMIT 1"
+        with self.lock:
+            row = self.connection.execute(query, params).fetchone()
+            if row is None:
+                return None
+            projects = self._projects(self.connection, [row["export_id"]])
+        return self._to_dict(row, projects[row["export_id"]])
+
+    def list(
+            self,
+            host=None,
+            runfolder=None,
+            flowcell_id=None,
+            project=None,
+            status=None,
+            since=None,
+            until=None,
+            limit=50,
+            offset=0):
+        """
+        Return the exports matching the filters, latest first, and the total number of matching
+        exports. `since` and `until` are timestamps that the export must have finished between.
+        """
+        conditions, params = [], []
+        for column, value in (
+                ("host", host),
+                ("runfolder", runfolder),
+                ("flowcell_id", flowcell_id),
+                ("status", status)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if project is not None:
+            conditions.append(
+                "export_id IN (SELECT export_id FROM export_projects WHERE project_id = ?)")
+            params.append(project)
+        if since is not None:
+            conditions.append("finished >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("finished < ?")
+            params.append(until)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        with self.lock:
+            total = self.connection.execute(
+                f"SELECT COUNT(*) FROM exports{where}", params).fetchone()[0]
+            rows = self.connection.execute(
+                f"SELECT * FROM exports{where} ORDER BY finished DESC, export_id DESC "
+                f"LIMIT ? OFFSET ?",
+                params + [int(limit), int(offset)]).fetchall()
+            projects = self._projects(self.connection, [row["export_id"] for row in rows])
+        return [self._to_dict(row, projects[row["export_id"]]) for row in rows], total
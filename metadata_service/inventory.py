@@ -0,0 +1,195 @@
+import collections
+import datetime
+import logging
+import os
+import re
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+FASTQ_PATTERN = re.compile(
+    r"^(?P<sample>.+)_S(?P<sample_number>\d+)_L(?P<lane>\d{3})_(?P<read>[RI]\d)_\d{3}\.fastq\.gz$")
+
+
+def read_checksums(path):
+    """
+    Yield the md5 digest, the path as it is listed and whether it was read in binary mode, for
+    each entry of a checksum file in the format written by md5sum
+    """
+    with open(path) as fh:
+        for line in fh:
+            digest, sep, listed = line.rstrip("\n").partition(" ")
+            if not sep or not listed:
+                continue
+            # md5sum separates the digest and the path with a space and a space or an asterisk
+            binary = listed[0] == "*"
+            yield digest, listed[1:] if listed[0] in (" ", "*") else listed, binary
+
+
+def checksum_relpath(listed, runfolder=None):
+    """
+    Make a path listed in a checksum file relative to the runfolder, if it starts with the name
+    of the runfolder
+    """
+    relpath = os.path.normpath(listed)
+    if runfolder and relpath.startswith(runfolder + os.sep):
+        relpath = relpath[len(runfolder) + 1:]
+    return relpath
+
+
+def parse_checksums(path, runfolder=None):
+    """
+    Return a dict with the md5 digest of each path listed in a checksum file in the format
+    written by md5sum. Paths that start with the name of the runfolder are made relative to the
+    runfolder.
+    """
+    return {
+        checksum_relpath(listed, runfolder): digest
+        for digest, listed, _ in read_checksums(path)}
+
+
+def fastq_entry(relpath, st):
+    """
+    Describe a file under Unaligned, with the project, sample, lane and read parsed from its path
+    and name for fastq files in either the <project>/Sample_<sample> or the
+    Project_<project>/<sample> layout
+    """
+    entry = {"path": relpath, "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+    parts = relpath.split(os.sep)
+    match = FASTQ_PATTERN.match(parts[-1])
+    if match is None:
+        return entry
+    if len(parts) >= 4:
+        project, sample = parts[1], parts[2]
+        entry["project"] = project[len("Project_"):] if project.startswith("Project_") else project
+        entry["sample"] = sample[len("Sample_"):] if sample.startswith("Sample_") else sample
+    entry["lane"] = int(match.group("lane"))
+    entry["read"] = match.group("read")
+    return entry
+
+
+class RunfolderInventory:
+    """
+    The files under Unaligned in a runfolder, and the entries of MD5/checksums.md5, as listed by
+    os.scandir. Each directory is listed together with its modification time, so that when the
+    inventory is refreshed, only the directories that have changed since are listed again.
+    Directories that were modified just before they were listed are always listed again, since a
+    change made within the resolution of the modification time would otherwise go unnoticed.
+    """
+
+    racy_window = 2.0
+
+    def __init__(self, runfolder_path):
+        self.runfolder_path = str(runfolder_path)
+        self.directories = {}
+        self.checksums = {}
+        self.checksums_stat = None
+        self.scanned = None
+        self.scans = 0
+
+    def _scan_directory(self, reldir, mtime_ns):
+        files, subdirs = [], []
+        with os.scandir(os.path.join(self.runfolder_path, reldir)) as it:
+            for entry in it:
+                relpath = os.path.join(reldir, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                elif entry.is_file():
+                    files.append(fastq_entry(relpath, entry.stat()))
+        self.scans += 1
+        racy = time.time() - mtime_ns / 1e9 < self.racy_window
+        return mtime_ns, racy, sorted(files, key=lambda f: f["path"]), sorted(subdirs)
+
+    def _refresh_directory(self, reldir, directories):
+        try:
+            mtime_ns = os.stat(os.path.join(self.runfolder_path, reldir)).st_mtime_ns
+        except FileNotFoundError:
+            return
+        listing = self.directories.get(reldir)
+        if listing is None or listing[0] != mtime_ns or listing[1]:
+            listing = self._scan_directory(reldir, mtime_ns)
+        directories[reldir] = listing
+        for subdir in listing[3]:
+            self._refresh_directory(os.path.join(reldir, subdir), directories)
+
+    def _refresh_checksums(self):
+        path = os.path.join(self.runfolder_path, "MD5", "checksums.md5")
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            self.checksums, self.checksums_stat = {}, None
+            return
+        if self.checksums_stat != (st.st_size, st.st_mtime_ns):
+            self.checksums = parse_checksums(path, os.path.basename(self.runfolder_path))
+            self.checksums_stat = (st.st_size, st.st_mtime_ns)
+
+    def refresh(self):
+        """
+        Bring the inventory up to date with the runfolder and return it
+        """
+        directories = {}
+        self._refresh_directory("Unaligned", directories)
+        self.directories = directories
+        self._refresh_checksums()
+        self.scanned = time.time()
+        return self
+
+    def files(self):
+        return [f for listing in self.directories.values() for f in listing[2]]
+
+    def walk_paths(self):
+        """
+        The paths of the files under Unaligned, in the order that they would be visited by a
+        sorted directory walk
+        """
+        return [f["path"] for f in sorted(
+            self.files(), key=lambda f: (os.path.dirname(f["path"]).split(os.sep), f["path"]))]
+
+    def to_dict(self):
+        files = self.files()
+        return {
+            "runfolder_path": self.runfolder_path,
+            "scanned": datetime.datetime.fromtimestamp(self.scanned).isoformat(),
+            "directories": len(self.directories),
+            "files": files,
+            "total_size": sum(f["size"] for f in files),
+            "projects": sorted({f["project"] for f in files if "project" in f}),
+            "checksums": self.checksums
+        }
+
+
+class InventoryIndex:
+    """
+    Keeps the inventories of the most recently used runfolders, up to `max_entries`, in memory
+    and refreshes them when they are requested
+    """
+
+    def __init__(self, max_entries=128):
+        self.max_entries = max_entries
+        self.inventories = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self._runfolder_locks = {}
+
+    def get(self, runfolder_path):
+        """
+        Return the up-to-date inventory of the runfolder. This lists directories and should be
+        run in an executor.
+        """
+        runfolder_path = str(runfolder_path)
+        if not os.path.isdir(runfolder_path):
+            raise FileNotFoundError(f"runfolder {runfolder_path} does not exist")
+        with self.lock:
+            inventory = self.inventories.get(runfolder_path)
+            if inventory is None:
+                inventory = RunfolderInventory(runfolder_path)
+                self.inventories[runfolder_path] = inventory
+            self.inventories.move_to_end(runfolder_path)
+            runfolder_lock = self._runfolder_locks.setdefault(runfolder_path, threading.Lock())
+            while self.max_entries and len(self.inventories) > self.max_entries:
+                evicted, _ = self.inventories.popitem(last=False)
+                self._runfolder_locks.pop(evicted, None)
+        # a runfolder is refreshed by one thread at a time
+        with runfolder_lock:
+            return inventory.refresh()
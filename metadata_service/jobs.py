@@ -0,0 +1,204 @@
+import asyncio
+import datetime
+import logging
+import time
+import uuid
+
+from metadata_service.tracing import REQUEST_ID
+
+
+log = logging.getLogger(__name__)
+
+
+class SchedulerClosedError(Exception):
+    pass
+
+
+class ExportJob:
+
+    def __init__(self, host, runfolder, lims_data=None, projects=None):
+        self.job_id = uuid.uuid4().hex
+        self.host = host
+        self.runfolder = runfolder
+        self.lims_data = lims_data
+        self.projects = tuple(projects) if projects else None
+        self.request_id = REQUEST_ID.get()
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.task = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    @property
+    def key(self):
+        return self.host, self.runfolder, self.lims_data, self.projects
+
+    @property
+    def done(self):
+        return self.status in ("done", "failed")
+
+    @staticmethod
+    def _isoformat(timestamp):
+        if timestamp is None:
+            return None
+        return datetime.datetime.fromtimestamp(timestamp).isoformat()
+
+    def to_dict(self):
+        job = {
+            "job_id": self.job_id,
+            "host": self.host,
+            "runfolder": self.runfolder,
+            "lims_data": self.lims_data,
+            "projects": list(self.projects) if self.projects else None,
+            "request_id": self.request_id,
+            "status": self.status,
+            "submitted": self._isoformat(self.submitted),
+            "started": self._isoformat(self.started),
+            "finished": self._isoformat(self.finished)
+        }
+        if self.status == "done":
+            job["metadata"] = self.result
+        elif self.status == "failed":
+            job["exception"] = self.error
+        return job
+
+
+class ExportScheduler:
+    """
+    Runs submitted export jobs in the background, with a cap on the number of exports running
+    concurrently, both in total and per host. A job submitted for a runfolder that already has a
+    queued or running job is de-duplicated to the existing job. Finished jobs are kept for
+    `retention` seconds. When the service shuts down, no new jobs are accepted and the active jobs
+    are given `drain_timeout` seconds to finish before they are cancelled.
+    """
+
+    def __init__(
+            self,
+            max_exports=None,
+            max_exports_per_host=None,
+            retention=3600,
+            drain_timeout=None):
+        self.max_exports = max_exports
+        self.max_exports_per_host = max_exports_per_host
+        self.retention = retention
+        self.drain_timeout = drain_timeout
+        self.draining = False
+        self.jobs = {}
+        self.active = {}
+        self._semaphore = None
+        self._host_semaphores = {}
+
+    @property
+    def semaphore(self):
+        if self._semaphore is None and self.max_exports:
+            self._semaphore = asyncio.Semaphore(int(self.max_exports))
+        return self._semaphore
+
+    def host_semaphore(self, host):
+        if not self.max_exports_per_host:
+            return None
+        if host not in self._host_semaphores:
+            self._host_semaphores[host] = asyncio.Semaphore(int(self.max_exports_per_host))
+        return self._host_semaphores[host]
+
+    async def scheduler_context(self, app):
+        yield
+        self.draining = True
+        tasks = [job.task for job in self.active.values() if job.task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def drain(self, app=None):
+        """
+        Stop accepting new jobs and wait for the active jobs to finish, for at most
+        `drain_timeout` seconds. Suitable as an `on_shutdown` signal handler.
+        """
+        self.draining = True
+        tasks = [job.task for job in self.active.values() if job.task is not None]
+        if not tasks:
+            return
+        log.info(f"waiting for {len(tasks)} active export jobs to finish")
+        done, pending = await asyncio.wait(tasks, timeout=self.drain_timeout)
+        if pending:
+            log.warning(
+                f"{len(pending)} export jobs did not finish within {self.drain_timeout} seconds "
+                f"and will be cancelled")
+
+    def prune(self):
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            if job.done and now - job.finished > self.retention:
+                del self.jobs[job_id]
+
+    def get(self, job_id):
+        self.prune()
+        return self.jobs.get(job_id)
+
+    def list(self):
+        self.prune()
+        return list(self.jobs.values())
+
+    def submit(self, export_func, host, runfolder, lims_data=None, projects=None):
+        """
+        Submit a job that will call `export_func(host, runfolder, lims_data)` when there is
+        capacity for it and return the job. If an identical job, for the same runfolder, LIMS
+        data and projects, is already queued or running, that job is returned instead.
+        """
+        self.prune()
+        job = ExportJob(host, runfolder, lims_data, projects=projects)
+        if self.draining:
+            raise SchedulerClosedError(
+                "the service is shutting down and does not accept new export jobs")
+        if job.key in self.active:
+            log.info(f"an export job for {host}/{runfolder} is already active")
+            return self.active[job.key]
+
+        self.jobs[job.job_id] = job
+        self.active[job.key] = job
+        job.task = asyncio.ensure_future(self._run(job, export_func))
+        return job
+
+    async def _acquire(self, job):
+        acquired = []
+        # take the per-host slot first so that a job waiting for its host does not hold on to
+        # one of the global slots
+        for semaphore in (self.host_semaphore(job.host), self.semaphore):
+            if semaphore is not None:
+                try:
+                    await semaphore.acquire()
+                except BaseException:
+                    self._release(acquired)
+                    raise
+                acquired.append(semaphore)
+        return acquired
+
+    @staticmethod
+    def _release(acquired):
+        for semaphore in acquired:
+            semaphore.release()
+
+    async def _run(self, job, export_func):
+        acquired = []
+        try:
+            acquired = await self._acquire(job)
+            job.status = "running"
+            job.started = time.time()
+            log.info(f"export job {job.job_id} for {job.host}/{job.runfolder} started")
+            job.result = await export_func(job.host, job.runfolder, job.lims_data)
+            job.status = "done"
+        except asyncio.CancelledError:
+            job.status = "failed"
+            job.error = "the export job was cancelled"
+            raise
+        except Exception as ex:
+            log.error(f"export job {job.job_id} failed: {ex}")
+            job.status = "failed"
+            job.error = str(ex)
+        finally:
+            self._release(acquired)
+            job.finished = time.time()
+            self.active.pop(job.key, None)
+            log.info(f"export job {job.job_id} finished with status {job.status}")
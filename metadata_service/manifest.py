@@ -0,0 +1,96 @@
+import datetime
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+
+log = logging.getLogger(__name__)
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ExportManifest:
+    """
+    A record, kept in the metadata directory, of the digests of the extracts that an export was
+    made from and of the files that it produced. An export with identical inputs can re-use the
+    recorded outputs, as long as they have not been modified since.
+    """
+
+    filename = ".export_manifest.json"
+
+    def __init__(self, metadata_export_path):
+        self.path = os.path.join(metadata_export_path, self.filename)
+
+    @staticmethod
+    def input_digests(runfolder_extract, snpseq_data_extract):
+        return {
+            "runfolder_extract": file_digest(runfolder_extract),
+            "snpseq_data_extract": file_digest(snpseq_data_extract)
+        }
+
+    @staticmethod
+    def output_entry(path):
+        st = os.stat(path)
+        return {
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "sha256": file_digest(path)
+        }
+
+    def load(self):
+        try:
+            with open(self.path) as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            log.warning(f"ignoring unreadable export manifest {self.path}")
+            return None
+
+    def up_to_date(self, inputs):
+        """
+        Return the outputs recorded in the manifest if they were produced from the same inputs and
+        are unchanged on disk, otherwise return None
+        """
+        manifest = self.load()
+        if manifest is None or manifest.get("inputs") != inputs:
+            return None
+
+        outputs = manifest.get("outputs", {})
+        for path, entry in outputs.items():
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                return None
+            if st.st_size != entry["size"] or st.st_mtime_ns != entry["mtime_ns"]:
+                return None
+        return list(outputs.keys())
+
+    def write(self, inputs, outputs):
+        manifest = {
+            "created": datetime.datetime.now().isoformat(),
+            "inputs": inputs,
+            "outputs": {
+                str(path): self.output_entry(path) for path in outputs
+            }
+        }
+        fd, tmppath = tempfile.mkstemp(
+            dir=os.path.dirname(self.path),
+            prefix=self.filename,
+            suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as fh:
+                json.dump(manifest, fh, indent=2)
+            os.replace(tmppath, self.path)
+        except BaseException:
+            os.unlink(tmppath)
+            raise
+        return self.path
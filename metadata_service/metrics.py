@@ -0,0 +1,258 @@
+import abc
+import contextlib
+import logging
+import math
+import threading
+import time
+
+from metadata_service.tracing import span
+
+
+log = logging.getLogger(__name__)
+
+
+class Metric(abc.ABC):
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+        registry = REGISTRY if registry is None else registry
+        registry.register(self)
+
+    def labels(self, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = self.new_value()
+            return self.values[key]
+
+    @abc.abstractmethod
+    def new_value(self):
+        pass
+
+    @staticmethod
+    def escape(value):
+        return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+    @staticmethod
+    def format_labels(labelnames, key, extra=None):
+        pairs = list(zip(labelnames, key)) + list(extra or [])
+        if not pairs:
+            return ""
+        return "{" + ",".join(
+            f'{name}="{Metric.escape(value)}"' for name, value in pairs) + "}"
+
+    @abc.abstractmethod
+    def samples(self):
+        pass
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines)
+
+
+class _Value:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+
+
+class Counter(Metric):
+
+    type = "counter"
+
+    def new_value(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def samples(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            yield self.name, self.format_labels(self.labelnames, key), value.value
+
+
+class Gauge(Counter):
+
+    type = "gauge"
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+    @contextlib.contextmanager
+    def track_inprogress(self, **labels):
+        value = self.labels(**labels)
+        value.inc()
+        try:
+            yield
+        finally:
+            value.dec()
+
+
+class _HistogramValue:
+
+    def __init__(self, buckets):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        with self.lock:
+            self.sum += value
+            self.count += 1
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+
+
+class Histogram(Metric):
+
+    type = "histogram"
+
+    DEFAULT_BUCKETS = (
+        0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0,
+        600.0, 1800.0, 3600.0, math.inf)
+
+    def __init__(self, name, documentation, labelnames=(), registry=None, buckets=None):
+        buckets = sorted(set(buckets or self.DEFAULT_BUCKETS) | {math.inf})
+        self.buckets = tuple(buckets)
+        super(Histogram, self).__init__(
+            name,
+            documentation,
+            labelnames=labelnames,
+            registry=registry)
+
+    def new_value(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    @staticmethod
+    def format_bound(bound):
+        return "+Inf" if bound == math.inf else repr(float(bound))
+
+    def samples(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            with value.lock:
+                counts, total, count = list(value.counts), value.sum, value.count
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", self.format_labels(
+                    self.labelnames,
+                    key,
+                    extra=[("le", self.format_bound(bound))]), cumulative
+            yield f"{self.name}_sum", self.format_labels(self.labelnames, key), total
+            yield f"{self.name}_count", self.format_labels(self.labelnames, key), count
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_DURATION = Histogram(
+    "metadata_service_stage_duration_seconds",
+    "Time spent in each stage of the export pipeline",
+    labelnames=("stage",))
+
+STAGE_RESULTS = Counter(
+    "metadata_service_stage_results_total",
+    "Number of times each stage of the export pipeline has finished, by outcome",
+    labelnames=("stage", "outcome"))
+
+EXPORTS_IN_PROGRESS = Gauge(
+    "metadata_service_exports_in_progress",
+    "Number of exports currently in progress")
+EXPORTS_IN_PROGRESS.set(0)
+
+PROCESSES_IN_PROGRESS = Gauge(
+    "metadata_service_processes_in_progress",
+    "Number of snpseq_metadata commands currently running")
+PROCESSES_IN_PROGRESS.set(0)
+
+UPSTREAM_RESPONSE_SIZE = Histogram(
+    "metadata_service_upstream_response_size_bytes",
+    "Size of the response bodies received from upstream services",
+    labelnames=("upstream",),
+    buckets=[1024 * 4 ** i for i in range(11)])
+
+UPSTREAM_RETRIES = Counter(
+    "metadata_service_upstream_retries_total",
+    "Number of requests to upstream services that have been retried",
+    labelnames=("upstream",))
+
+ADMISSION_QUEUED = Gauge(
+    "metadata_service_admission_queued",
+    "Number of export requests waiting to be admitted")
+ADMISSION_QUEUED.set(0)
+
+ADMISSION_REJECTED = Counter(
+    "metadata_service_admission_rejected_total",
+    "Number of export requests rejected by the admission control, by reason",
+    labelnames=("reason",))
+
+CHECKSUM_BYTES = Counter(
+    "metadata_service_checksum_bytes_total",
+    "Number of bytes of runfolder files that have been hashed for checksums")
+
+
+@contextlib.contextmanager
+def track_stage(stage):
+    """
+    Context manager that records the duration and the outcome of a pipeline stage, and writes it
+    to the trace log as a span
+    """
+    start = time.perf_counter()
+    try:
+        with span(stage):
+            yield
+    except BaseException:
+        STAGE_RESULTS.labels(stage=stage, outcome="failure").inc()
+        raise
+    else:
+        STAGE_RESULTS.labels(stage=stage, outcome="success").inc()
+    finally:
+        STAGE_DURATION.labels(stage=stage).observe(time.perf_counter() - start)
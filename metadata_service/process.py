@@ -1,9 +1,18 @@
-
+import asyncio
+import concurrent.futures
+import contextlib
+import importlib.metadata
+import io
 import logging
+import multiprocessing
 import os
 import shlex
 import subprocess
+import sys
+import traceback
 
+from metadata_service.metrics import PROCESSES_IN_PROGRESS, track_stage
+from metadata_service.tracing import REQUEST_ID, REQUEST_ID_ENV
 from metadata_service.utils import safe_outdir
 
 
@@ -12,17 +21,76 @@ log = logging.getLogger(__name__)
 
 class ProcessRunner:
 
-    def __init__(self):
-        pass
+    chunk_size = 65536
+
+    def __init__(self, max_processes=None):
+        self.max_processes = max_processes
+        self._semaphore = None
+
+    @property
+    def semaphore(self):
+        # create the semaphore lazily so that it is bound to the running event loop
+        if self._semaphore is None and self.max_processes:
+            self._semaphore = asyncio.Semaphore(int(self.max_processes))
+        return self._semaphore
+
+    async def process_context(self, app):
+        yield
+
+    @staticmethod
+    async def _read_stream(stream, logfunc):
+        chunks = []
+        pending = b""
+        while True:
+            chunk = await stream.read(ProcessRunner.chunk_size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            lines = (pending + chunk).split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                logfunc(line.decode(errors="replace"))
+        if pending:
+            logfunc(pending.decode(errors="replace"))
+        return b"".join(chunks).decode(errors="replace")
+
+    @staticmethod
+    def process_env():
+        request_id = REQUEST_ID.get()
+        if request_id is None:
+            return None
+        return dict(os.environ, **{REQUEST_ID_ENV: request_id})
+
+    async def _run_process(self, cmdline):
+        args = shlex.split(cmdline)
+        proc = await asyncio.create_subprocess_exec(
+            *args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env=self.process_env()
+        )
+        try:
+            stdout, stderr = await asyncio.gather(
+                self._read_stream(proc.stdout, log.debug),
+                self._read_stream(proc.stderr, log.debug))
+            returncode = await proc.wait()
+        except asyncio.CancelledError:
+            if proc.returncode is None:
+                log.warning(f"{cmdline} was cancelled, terminating process {proc.pid}")
+                proc.kill()
+                await proc.wait()
+            raise
+        return subprocess.CompletedProcess(args, returncode, stdout, stderr)
 
-    def run_process(self, cmdline):
+    async def run_process(self, cmdline):
         try:
-            proc = subprocess.run(
-                shlex.split(cmdline),
-                capture_output=True,
-                text=True
-            )
-            log.debug(proc.stdout)
+            if self.semaphore is None:
+                with PROCESSES_IN_PROGRESS.track_inprogress():
+                    proc = await self._run_process(cmdline)
+            else:
+                async with self.semaphore:
+                    with PROCESSES_IN_PROGRESS.track_inprogress():
+                        proc = await self._run_process(cmdline)
             proc.check_returncode()
             log.info(
                 f"{cmdline} exited with exit-code {proc.returncode}")
@@ -37,37 +105,40 @@ class ProcessRunner:
 
 class MetadataProcessRunner(ProcessRunner):
 
-    def __init__(self, metadata_executable):
-        super(MetadataProcessRunner, self).__init__()
+    def __init__(self, metadata_executable, max_processes=None):
+        super(MetadataProcessRunner, self).__init__(max_processes=max_processes)
         self.metadata_executable = metadata_executable
 
     @safe_outdir
-    def extract_runfolder_metadata(self, runfolder_path, outdir):
+    async def extract_runfolder_metadata(self, runfolder_path, outdir):
         cmdline = f"{self.metadata_executable} extract runfolder --outdir {outdir} " \
                   f"{runfolder_path} json"
-        self.run_process(cmdline)
+        with track_stage("extract_runfolder"):
+            await self.run_process(cmdline)
         return os.path.join(
             outdir,
             f"{os.path.basename(runfolder_path)}.ngi.json")
 
     @safe_outdir
-    def extract_snpseq_data_metadata(self, data_path, outdir):
+    async def extract_snpseq_data_metadata(self, data_path, outdir):
         cmdline = f"{self.metadata_executable} extract snpseq-data --outdir {outdir} " \
                   f"{data_path} json"
-        self.run_process(cmdline)
+        with track_stage("extract_snpseq_data"):
+            await self.run_process(cmdline)
         return os.path.join(
             outdir,
             f"{'.'.join(os.path.basename(data_path).split('.')[0:-1])}.ngi.json")
 
     @safe_outdir
-    def export_runfolder_metadata(self, runfolder_extract, snpseq_data_extract, outdir):
+    async def export_runfolder_metadata(self, runfolder_extract, snpseq_data_extract, outdir):
         cmdline = f"" \
                   f"{self.metadata_executable} export " \
                   f"--outdir {outdir} " \
                   f"{runfolder_extract} " \
                   f"{snpseq_data_extract} " \
                   f"xml tsv"
-        self.run_process(cmdline)
+        with track_stage("export"):
+            await self.run_process(cmdline)
         return [
             os.path.join(
                 outdir,
@@ -75,3 +146,131 @@ class MetadataProcessRunner(ProcessRunner):
             for xmlfile in os.listdir(outdir)
             if xmlfile.endswith(".xml") or xmlfile.endswith(".tsv")
         ]
+
+
+def _load_entry_point(name):
+    """
+    Load the console script entry point with the specified name from the current environment
+    """
+    eps = importlib.metadata.entry_points()
+    if hasattr(eps, "select"):
+        matches = list(eps.select(group="console_scripts", name=name))
+    else:
+        matches = [ep for ep in eps.get("console_scripts", []) if ep.name == name]
+    if not matches:
+        raise ImportError(f"no console script named {name} found in the environment")
+    return matches[0].load()
+
+
+# the entry points loaded in this process, by name
+_ENTRY_POINTS = {}
+
+
+def _entry_point(name):
+    if name not in _ENTRY_POINTS:
+        _ENTRY_POINTS[name] = _load_entry_point(name)
+    return _ENTRY_POINTS[name]
+
+
+def _init_worker(name):
+    # load the library up front, and only once, so that the jobs do not pay for it
+    _entry_point(name)
+
+
+def _run_entry_point(name, args, request_id=None):
+    """
+    Call the entry point in the current process, capturing its output and exit code the same
+    way as if it had been run as a separate process
+    """
+    stdout, stderr = io.StringIO(), io.StringIO()
+    returncode = 0
+    argv = sys.argv
+    if request_id is not None:
+        os.environ[REQUEST_ID_ENV] = request_id
+    else:
+        os.environ.pop(REQUEST_ID_ENV, None)
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        try:
+            main = _entry_point(name)
+            if hasattr(main, "main"):
+                # a click command, which reports usage errors and exits with the exit code of the
+                # command, as it would when run from the command line
+                result = main.main(args=args, prog_name=name, standalone_mode=True)
+                if isinstance(result, int):
+                    returncode = result
+            else:
+                sys.argv = [name] + list(args)
+                main()
+        except SystemExit as ex:
+            if isinstance(ex.code, int):
+                returncode = ex.code
+            elif ex.code is not None:
+                print(ex.code, file=sys.stderr)
+                returncode = 1
+        except Exception:
+            traceback.print_exc()
+            returncode = 1
+        finally:
+            sys.argv = argv
+    return returncode, stdout.getvalue(), stderr.getvalue()
+
+
+class MetadataLibraryRunner(MetadataProcessRunner):
+    """
+    Runs the snpseq_metadata commands by calling the library in a pool of persistent, pre-warmed
+    worker processes instead of launching a new interpreter for each command. If the library is
+    not available in the environment, the commands are run as subprocesses.
+    """
+
+    def __init__(self, metadata_executable, max_processes=None):
+        super(MetadataLibraryRunner, self).__init__(
+            metadata_executable=metadata_executable,
+            max_processes=max_processes)
+        self.entry_point = os.path.basename(metadata_executable)
+        self.workers = int(max_processes or os.cpu_count() or 1)
+        self.pool = None
+
+    def start_pool(self):
+        try:
+            _load_entry_point(self.entry_point)
+        except Exception as ex:
+            log.warning(
+                f"unable to load {self.entry_point} as a library ({ex}), "
+                f"falling back to running {self.metadata_executable} as a subprocess")
+            return
+
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self.entry_point,))
+        # submitting a job per worker makes the pool start all workers now rather than on demand
+        concurrent.futures.wait([
+            self.pool.submit(os.getpid) for _ in range(self.workers)])
+        log.info(f"started {self.workers} {self.entry_point} library workers")
+
+    def stop_pool(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+
+    async def process_context(self, app):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.start_pool)
+        yield
+        await loop.run_in_executor(None, self.stop_pool)
+
+    async def _run_process(self, cmdline):
+        if self.pool is None:
+            return await super(MetadataLibraryRunner, self)._run_process(cmdline)
+
+        args = shlex.split(cmdline)
+        returncode, stdout, stderr = await asyncio.get_running_loop().run_in_executor(
+            self.pool,
+            _run_entry_point,
+            self.entry_point,
+            args[1:],
+            REQUEST_ID.get())
+        for line in (stdout + stderr).splitlines():
+            log.debug(line)
+        return subprocess.CompletedProcess(args, returncode, stdout, stderr)
@@ -0,0 +1,127 @@
+import collections
+import cProfile
+import io
+import logging
+import pstats
+import sys
+import threading
+
+import aiohttp.web
+
+
+log = logging.getLogger(__name__)
+
+
+class Profiler:
+    """
+    Profiles the handling of the next few requests, either deterministically with cProfile or by
+    sampling the stack of the event loop thread at regular intervals, and aggregates the profiles
+    until the profiler is started again. Requests that overlap in time share the event loop thread
+    and are therefore profiled together.
+    """
+
+    modes = ("cprofile", "sampling")
+
+    def __init__(self, exclude_prefix=None):
+        self.exclude_prefix = exclude_prefix
+        self.mode = None
+        self.remaining = 0
+        self.profiled = 0
+        self.active = 0
+        self.interval = None
+        self._profile = None
+        self._samples = collections.Counter()
+        self._samples_lock = threading.Lock()
+        self._sampler = None
+        self._sampling = threading.Event()
+
+    def start(self, mode, requests, interval=0.005):
+        if mode not in self.modes:
+            raise ValueError(
+                f"unknown profiling mode '{mode}', use one of {', '.join(self.modes)}")
+        if self.active:
+            raise ValueError("requests are being profiled, wait for them to finish")
+        self.mode = mode
+        self.remaining = int(requests)
+        self.profiled = 0
+        self.interval = float(interval)
+        self._profile = cProfile.Profile() if mode == "cprofile" else None
+        self._samples = collections.Counter()
+        log.info(f"profiling the next {self.remaining} requests with {mode}")
+
+    def _sample(self, thread_id):
+        while not self._sampling.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                with self._samples_lock:
+                    self._samples[";".join(reversed(stack))] += 1
+
+    def _enable(self):
+        if self.mode == "cprofile":
+            self._profile.enable()
+        else:
+            self._sampling.clear()
+            self._sampler = threading.Thread(
+                target=self._sample,
+                args=(threading.get_ident(),),
+                name="profile-sampler",
+                daemon=True)
+            self._sampler.start()
+
+    def _disable(self):
+        if self.mode == "cprofile":
+            self._profile.disable()
+        else:
+            self._sampling.set()
+            self._sampler.join()
+            self._sampler = None
+
+    @aiohttp.web.middleware
+    async def middleware(self, request, handler):
+        if self.remaining <= 0 or (
+                self.exclude_prefix and request.path.startswith(self.exclude_prefix)):
+            return await handler(request)
+
+        self.remaining -= 1
+        self.active += 1
+        if self.active == 1:
+            self._enable()
+        try:
+            return await handler(request)
+        finally:
+            self.active -= 1
+            self.profiled += 1
+            if self.active == 0:
+                self._disable()
+
+    def report(self, limit=50):
+        """
+        The aggregated profile as text: for cProfile, the functions with the highest cumulative
+        time; when sampling, the most frequent stacks in the folded format used by flame graph
+        tools, each followed by its number of samples
+        """
+        if self.mode == "cprofile":
+            if not self.profiled:
+                return ""
+            out = io.StringIO()
+            stats = pstats.Stats(self._profile, stream=out)
+            stats.sort_stats("cumulative").print_stats(limit)
+            return out.getvalue()
+        if self.mode == "sampling":
+            with self._samples_lock:
+                samples = self._samples.most_common(limit)
+            return "\n".join(f"{stack} {count}" for stack, count in samples)
+        return ""
+
+    def status(self):
+        return {
+            "mode": self.mode,
+            "requests_profiled": self.profiled,
+            "requests_remaining": self.remaining,
+            "requests_active": self.active
+        }
@@ -0,0 +1,82 @@
+import contextlib
+import contextvars
+import json
+import logging
+import time
+import uuid
+
+import aiohttp.web
+
+
+log = logging.getLogger(__name__)
+trace_log = logging.getLogger("metadata_service.trace")
+
+REQUEST_ID = contextvars.ContextVar("request_id", default=None)
+CURRENT_SPAN = contextvars.ContextVar("current_span", default=None)
+
+REQUEST_ID_HEADER = "X-Request-ID"
+REQUEST_ID_ENV = "METADATA_SERVICE_REQUEST_ID"
+
+
+def new_request_id():
+    return uuid.uuid4().hex[0:16]
+
+
+class RequestIdFilter(logging.Filter):
+    """
+    Logging filter that adds the id of the request being handled to the log records as
+    `request_id`, so that it can be used in the log format
+    """
+
+    def filter(self, record):
+        record.request_id = REQUEST_ID.get() or "-"
+        return True
+
+
+@aiohttp.web.middleware
+async def request_id_middleware(request, handler):
+    """
+    Take the request id from the X-Request-ID header, or generate one, and make it available to
+    everything that runs on behalf of the request, including the tasks that it starts
+    """
+    request_id = request.headers.get(REQUEST_ID_HEADER) or new_request_id()
+    token = REQUEST_ID.set(request_id)
+    try:
+        response = await handler(request)
+        response.headers[REQUEST_ID_HEADER] = request_id
+        return response
+    finally:
+        REQUEST_ID.reset(token)
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """
+    Context manager that writes the timing of the enclosed block to the trace log as a json
+    record, linked to the request and to the enclosing span. Entries added to the yielded dict
+    are included in the record.
+    """
+    span_id = uuid.uuid4().hex[0:8]
+    parent = CURRENT_SPAN.get()
+    token = CURRENT_SPAN.set(span_id)
+    start, start_time = time.perf_counter(), time.time()
+    outcome = "success"
+    try:
+        yield attributes
+    except BaseException:
+        outcome = "failure"
+        raise
+    finally:
+        CURRENT_SPAN.reset(token)
+        if trace_log.isEnabledFor(logging.INFO):
+            record = {
+                "request_id": REQUEST_ID.get(),
+                "span": name,
+                "span_id": span_id,
+                "parent_id": parent,
+                "start": start_time,
+                "duration": time.perf_counter() - start,
+                "outcome": outcome
+            }
+            record.update(attributes)
+            trace_log.info(json.dumps(record, default=str))
@@ -1,4 +1,4 @@
-
+import asyncio
 import logging
 import os
 
@@ -13,3 +13,35 @@ def safe_outdir(func):
         return func(*args, **kwargs)
 
     return _makeoutdir
+
+
+def query_flag(request, name):
+    """
+    Return True if the query parameter is given with a value that is not false-ish
+    """
+    value = request.query.get(name)
+    return value is not None and value.lower() not in ("0", "false", "no")
+
+
+def query_list(request, name):
+    """
+    Return the sorted, distinct values of a query parameter that may be repeated, or None if it
+    is not given
+    """
+    values = sorted({value for value in request.query.getall(name, []) if value})
+    return values or None
+
+
+async def gather_or_cancel(*aws):
+    """
+    Run the awaitables concurrently and return their results in order. If any of them fails, the
+    remaining ones are cancelled and awaited before the exception is re-raised
+    """
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
@@ -0,0 +1,173 @@
+import asyncio
+import fcntl
+import glob
+import logging
+import os
+import re
+import time
+
+from metadata_service.manifest import ExportManifest
+from metadata_service.utils import gather_or_cancel
+
+
+log = logging.getLogger(__name__)
+
+
+class RunfolderWatcher:
+    """
+    Periodically scans the runfolders matching the `datadir` pattern for runfolders that have
+    completed since they were last seen and pre-computes what an export of them will need: the
+    runfolder extract and the snpseq-data extract are added to the extract cache, which is kept on
+    disk and shared by the worker processes. A later
+    export then only has to fetch the LIMS data again (or revalidate it with the LIMS cache of the
+    session) to look up the snpseq-data extract, and run the final export step. Without an
+    extract cache, only the LIMS data is fetched into the LIMS cache of the session of the worker
+    running the watcher, where it expires after the cache ttl.
+
+    A runfolder is considered complete when all of `completion_markers` exist. Runfolders that
+    already have an export manifest, or that completed more than `max_age` seconds ago, are left
+    alone. When several worker processes share the same `lockfile`, only the one holding the lock
+    runs the watcher.
+    """
+
+    completion_markers = (os.path.join("MD5", "checksums.md5"), "Unaligned")
+
+    def __init__(
+            self,
+            datadir,
+            export_handler,
+            session,
+            interval=300,
+            max_age=86400,
+            lockfile=None):
+        self.datadir = datadir
+        self.export_handler = export_handler
+        self.session = session
+        self.interval = interval
+        self.max_age = max_age
+        self.lockfile = lockfile
+        self.seen = {}
+        self._lock_fd = None
+
+    @property
+    def pattern(self):
+        return self.datadir.format(host="*", runfolder="*")
+
+    def parse(self, path):
+        """
+        Return the host and runfolder names that the path was matched with
+        """
+        regex = re.escape(self.datadir).replace(
+            re.escape("{host}"), "(?P<host>[^/]+)").replace(
+            re.escape("{runfolder}"), "(?P<runfolder>[^/]+)")
+        match = re.fullmatch(regex, path)
+        if match is None:
+            return None, None
+        return match.groupdict().get("host"), match.groupdict().get("runfolder")
+
+    def completed(self, runfolder_path):
+        """
+        Return the time at which the runfolder was completed, or None if it is not complete
+        """
+        mtimes = []
+        for marker in self.completion_markers:
+            try:
+                mtimes.append(os.stat(os.path.join(runfolder_path, marker)).st_mtime)
+            except FileNotFoundError:
+                return None
+        return max(mtimes)
+
+    def scan(self):
+        """
+        Return the host, runfolder name and path of the runfolders that have completed since they
+        were last seen and need to be pre-computed
+        """
+        candidates = []
+        now = time.time()
+        for runfolder_path in sorted(glob.glob(self.pattern)):
+            completed = self.completed(runfolder_path)
+            if completed is None or self.seen.get(runfolder_path) == completed:
+                continue
+            self.seen[runfolder_path] = completed
+            if self.max_age and now - completed > self.max_age:
+                continue
+            manifest = ExportManifest(os.path.join(runfolder_path, "metadata"))
+            if os.path.exists(manifest.path):
+                continue
+            host, runfolder = self.parse(runfolder_path)
+            candidates.append((host, runfolder, runfolder_path))
+        return candidates
+
+    async def prewarm(self, runfolder_path):
+        log.info(f"pre-computing the extracts for {runfolder_path}")
+        async with self.export_handler.workspace.directory() as outdir:
+            if self.export_handler.extract_cache is not None:
+                runfolder_outdir = os.path.join(outdir, "runfolder")
+                snpseq_data_outdir = os.path.join(outdir, "snpseq_data")
+                # the cached extracts are copied into these, so they have to exist up front
+                for path in (runfolder_outdir, snpseq_data_outdir):
+                    os.makedirs(path, exist_ok=True)
+                await gather_or_cancel(
+                    self.export_handler.runfolder_extract(runfolder_path, runfolder_outdir),
+                    self.export_handler.snpseq_data_extract(
+                        self.session,
+                        runfolder_path,
+                        os.path.join(runfolder_path, "metadata"),
+                        None,
+                        snpseq_data_outdir))
+            elif self.session.cache_ttl is not None:
+                await self.session.snpseq_data(
+                    self.session.flowcellid_from_runfolder(runfolder_path))
+
+    async def watch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                candidates = await loop.run_in_executor(None, self.scan)
+            except Exception as ex:
+                log.error(f"unable to scan {self.pattern} for runfolders: {ex}")
+                candidates = []
+            for host, runfolder, runfolder_path in candidates:
+                try:
+                    await self.prewarm(runfolder_path)
+                except Exception as ex:
+                    log.warning(f"unable to pre-compute the extracts for {runfolder_path}: {ex}")
+                    # try again on the next scan
+                    self.seen.pop(runfolder_path, None)
+            await asyncio.sleep(self.interval)
+
+    def acquire_lock(self):
+        if self.lockfile is None:
+            return True
+        os.makedirs(os.path.dirname(self.lockfile), exist_ok=True)
+        fd = os.open(self.lockfile, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        return True
+
+    def release_lock(self):
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    async def watcher_context(self, app):
+        if self.export_handler.extract_cache is None and self.session.cache_ttl is None:
+            log.warning(
+                "the runfolder watcher is enabled but neither the extract cache nor the "
+                "snpseq-data cache is configured, so there is nothing to pre-compute")
+            yield
+            return
+        if not self.acquire_lock():
+            log.info("the runfolder watcher is running in another worker")
+            yield
+            return
+
+        task = asyncio.ensure_future(self.watch())
+        yield
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        self.release_lock()
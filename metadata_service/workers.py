@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import os
+import signal
+import socket
+import time
+
+import aiohttp.web
+
+
+log = logging.getLogger(__name__)
+
+
+async def _serve(app, sock=None, port=None, shutdown_timeout=60.0):
+    runner = aiohttp.web.AppRunner(app, handle_signals=False, shutdown_timeout=shutdown_timeout)
+    await runner.setup()
+    try:
+        if sock is not None:
+            site = aiohttp.web.SockSite(runner, sock)
+        else:
+            site = aiohttp.web.TCPSite(runner, port=port)
+        await site.start()
+
+        # a repeated signal, e.g. from both the supervisor and the service manager, must not
+        # interrupt the draining
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop.set)
+        await stop.wait()
+        log.info(f"stopping, waiting up to {shutdown_timeout} seconds for requests in progress")
+    finally:
+        await runner.cleanup()
+
+
+def serve(app, sock=None, port=None, shutdown_timeout=60.0):
+    """
+    Serve the app until SIGTERM or SIGINT is received. In-flight requests are then given
+    `shutdown_timeout` seconds to finish before the app is cleaned up.
+    """
+    asyncio.run(_serve(app, sock=sock, port=port, shutdown_timeout=shutdown_timeout))
+
+
+class WorkerSupervisor:
+    """
+    Runs the service in `workers` pre-forked worker processes that accept connections on a shared
+    listening socket. Each worker builds its own app by calling `app_factory()` after the fork, so
+    that no event loop, connection pool or process pool is shared between workers. Workers that
+    exit unexpectedly are restarted. On SIGTERM or SIGINT the supervisor forwards SIGTERM to the
+    workers, which stop accepting connections and drain their in-flight requests and export jobs,
+    and waits for them to exit. Workers still running `shutdown_timeout` + `kill_grace` seconds
+    later are killed.
+    """
+
+    restart_backoff = 1.0
+    max_restart_backoff = 30.0
+
+    def __init__(self, app_factory, port, workers, shutdown_timeout=60.0, kill_grace=30.0):
+        self.app_factory = app_factory
+        self.port = port
+        self.workers = workers
+        self.shutdown_timeout = shutdown_timeout
+        self.kill_grace = kill_grace
+        self.children = {}
+        self.stopping = False
+        self.sock = None
+
+    def bind(self):
+        sock = socket.create_server(("", self.port), backlog=1024)
+        sock.setblocking(False)
+        return sock
+
+    def spawn(self, worker_id):
+        pid = os.fork()
+        if pid == 0:
+            exitcode = 1
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                app = self.app_factory()
+                log.info(f"worker {worker_id} (pid {os.getpid()}) is serving on port {self.port}")
+                serve(app, sock=self.sock, shutdown_timeout=self.shutdown_timeout)
+                exitcode = 0
+            except BaseException:
+                log.exception(f"worker {worker_id} (pid {os.getpid()}) failed")
+            finally:
+                logging.shutdown()
+                os._exit(exitcode)
+        self.children[pid] = (worker_id, time.monotonic())
+        return pid
+
+    def stop(self, signum=signal.SIGTERM, frame=None):
+        if not self.stopping:
+            log.info(f"received signal {signum}, stopping {len(self.children)} workers")
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def reap(self):
+        """
+        Collect the workers that have exited and return their worker ids and runtimes
+        """
+        exited = []
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.children.clear()
+                break
+            if pid == 0:
+                break
+            if pid not in self.children:
+                continue
+            worker_id, started = self.children.pop(pid)
+            # the same as os.waitstatus_to_exitcode, which is not available before Python 3.9
+            exitcode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            if not self.stopping:
+                log.warning(f"worker {worker_id} (pid {pid}) exited with code {exitcode}")
+            exited.append((worker_id, time.monotonic() - started))
+        return exited
+
+    def run(self):
+        self.sock = self.bind()
+        previous = {
+            signum: signal.signal(signum, self.stop)
+            for signum in (signal.SIGTERM, signal.SIGINT)}
+        log.info(f"starting {self.workers} workers on port {self.port}")
+        try:
+            for worker_id in range(self.workers):
+                self.spawn(worker_id)
+
+            backoff = {}
+            while not self.stopping:
+                for worker_id, runtime in self.reap():
+                    if self.stopping:
+                        break
+                    # back off when a worker keeps failing soon after it was started
+                    if runtime < self.max_restart_backoff:
+                        delay = min(
+                            2 * (backoff.get(worker_id) or self.restart_backoff / 2),
+                            self.max_restart_backoff)
+                    else:
+                        delay = 0
+                    backoff[worker_id] = delay
+                    log.info(f"restarting worker {worker_id} in {delay} seconds")
+                    time.sleep(delay)
+                    if not self.stopping:
+                        self.spawn(worker_id)
+                time.sleep(0.2)
+
+            deadline = time.monotonic() + self.shutdown_timeout + self.kill_grace
+            while self.children and time.monotonic() < deadline:
+                self.reap()
+                time.sleep(0.2)
+            for pid, (worker_id, _) in list(self.children.items()):
+                log.warning(f"worker {worker_id} (pid {pid}) did not stop in time, killing it")
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+            while self.children:
+                self.reap()
+                time.sleep(0.05)
+        finally:
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+            self.sock.close()
+        log.info("all workers have stopped")
@@ -0,0 +1,234 @@
+import asyncio
+import contextlib
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+
+log = logging.getLogger(__name__)
+
+# the Linux ioctl that clones a file by sharing its extents, on file systems such as btrfs and xfs
+FICLONE = 0x40049409
+
+# the errors for which link_or_copy falls back to the next, more expensive, method
+LINK_FALLBACK_ERRNOS = (errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.ENOTSUP)
+
+
+def directory_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except FileNotFoundError:
+                pass
+    return size
+
+
+def empty_directory(path):
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                os.unlink(entry.path)
+
+
+def publish_file(src, destdir):
+    """
+    Atomically place the file in the destination directory. Unless the file is already on the
+    same file system, it is first copied to a temporary file in the destination directory, which
+    is then renamed, so that readers never see a partially written file.
+    """
+    dest = os.path.join(destdir, os.path.basename(src))
+    if os.stat(src).st_dev == os.stat(destdir).st_dev:
+        os.replace(src, dest)
+        return dest
+
+    fd, tmppath = tempfile.mkstemp(dir=destdir, prefix=f".{os.path.basename(src)}", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as dh, open(src, "rb") as sh:
+            shutil.copyfileobj(sh, dh, 1024 * 1024)
+            dh.flush()
+            os.fsync(dh.fileno())
+        shutil.copymode(src, tmppath)
+        os.replace(tmppath, dest)
+    except BaseException:
+        os.unlink(tmppath)
+        raise
+    return dest
+
+
+def reflink(src, dest):
+    with open(src, "rb") as sh, open(dest, "wb") as dh:
+        fcntl.ioctl(dh.fileno(), FICLONE, sh.fileno())
+
+
+def link_or_copy(src, dest):
+    """
+    Make the file available at `dest` as cheaply as possible, as a hard link, a reflink, a symbolic
+    link or, failing all of those, a copy, and return the method that was used. The file must not
+    be modified through `dest`. A method is only given up on when the file system does not
+    support it; any other error, such as a missing `src`, is raised.
+    """
+    src = os.path.abspath(src)
+    # a symbolic link to a missing file would otherwise be made without complaint
+    os.stat(src)
+    try:
+        os.link(src, dest)
+        return "hardlink"
+    except OSError as ex:
+        if ex.errno not in LINK_FALLBACK_ERRNOS:
+            raise
+    try:
+        reflink(src, dest)
+        return "reflink"
+    except OSError as ex:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(dest)
+        if ex.errno not in LINK_FALLBACK_ERRNOS:
+            raise
+    try:
+        os.symlink(src, dest)
+        return "symlink"
+    except OSError as ex:
+        if ex.errno not in LINK_FALLBACK_ERRNOS:
+            raise
+    shutil.copyfile(src, dest)
+    return "copy"
+
+
+class Workspace:
+    """
+    Manages scratch directories for the extracts and exports under `root`, which could be on
+    fast local storage such as a tmpfs or a local SSD. Each process uses its own subdirectory of
+    `root`, and the subdirectories left behind by processes that are no longer running are removed
+    at startup. Released directories are emptied and re-used, keeping at most `max_idle` of them.
+    If `max_size` is set, requests for a directory wait, for at most `wait_timeout` seconds, while
+    the scratch space in use is larger than `max_size` bytes.
+    """
+
+    prefix = "worker-"
+
+    def __init__(self, root=None, max_size=None, max_idle=8, wait_timeout=600):
+        self.root = root or os.path.join(tempfile.gettempdir(), "metadata-service")
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.wait_timeout = wait_timeout
+        self.idle = []
+        self.in_use = set()
+        self._condition = None
+        self._procdir = None
+
+    @property
+    def procdir(self):
+        if self._procdir is None:
+            self._procdir = os.path.join(self.root, f"{self.prefix}{os.getpid()}")
+            os.makedirs(self._procdir, exist_ok=True)
+        return self._procdir
+
+    @property
+    def condition(self):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    def remove_stale(self):
+        if not os.path.isdir(self.root):
+            return
+        for name in os.listdir(self.root):
+            if not name.startswith(self.prefix):
+                continue
+            try:
+                pid = int(name[len(self.prefix):])
+                os.kill(pid, 0)
+            except ValueError:
+                continue
+            except ProcessLookupError:
+                log.info(f"removing stale scratch directory {os.path.join(self.root, name)}")
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+            except PermissionError:
+                # the process exists but belongs to someone else
+                pass
+
+    def cleanup(self):
+        if self._procdir is not None:
+            shutil.rmtree(self._procdir, ignore_errors=True)
+            self._procdir = None
+        self.idle = []
+
+    async def workspace_context(self, app):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.remove_stale)
+        yield
+        await loop.run_in_executor(None, self.cleanup)
+
+    def used(self):
+        return sum(directory_size(path) for path in list(self.in_use))
+
+    def _release(self, path):
+        """
+        Empty the directory and return True if it can be re-used, otherwise remove it
+        """
+        try:
+            empty_directory(path)
+            return True
+        except OSError as ex:
+            log.warning(f"unable to empty scratch directory {path}: {ex}")
+            shutil.rmtree(path, ignore_errors=True)
+            return False
+
+    async def _wait_for_space(self):
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + self.wait_timeout
+        async with self.condition:
+            while self.in_use and await loop.run_in_executor(None, self.used) >= self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise Exception(
+                        f"the scratch space under {self.root} has been full for "
+                        f"{self.wait_timeout} seconds")
+                log.info(f"waiting for scratch space under {self.root} to become available")
+                try:
+                    await asyncio.wait_for(self.condition.wait(), timeout=min(remaining, 5))
+                except asyncio.TimeoutError:
+                    pass
+
+    @contextlib.asynccontextmanager
+    async def directory(self):
+        """
+        Async context manager that provides an empty scratch directory
+        """
+        if self.max_size:
+            await self._wait_for_space()
+        loop = asyncio.get_running_loop()
+        if self.idle:
+            path = self.idle.pop()
+        else:
+            path = await loop.run_in_executor(
+                None,
+                lambda: tempfile.mkdtemp(dir=self.procdir, prefix="scratch"))
+        self.in_use.add(path)
+        try:
+            yield path
+        finally:
+            self.in_use.discard(path)
+            reusable = await loop.run_in_executor(None, self._release, path)
+            if reusable and len(self.idle) < self.max_idle:
+                self.idle.append(path)
+            elif reusable:
+                await loop.run_in_executor(None, shutil.rmtree, path, True)
+            async with self.condition:
+                self.condition.notify_all()
+
+    @staticmethod
+    def publish(paths, destdir):
+        """
+        Atomically publish the files into the destination directory and return their new paths
+        """
+        os.makedirs(destdir, exist_ok=True)
+        return [publish_file(path, destdir) for path in paths]
@@ -0,0 +1,130 @@
+import asyncio
+import pytest
+
+from metadata_service.admission import AdmissionController, AdmissionRejected
+
+
+async def test_admission_limits():
+    admission = AdmissionController(max_active=3, max_active_per_host=1)
+    running = {"total": 0, "max": 0, "host1": 0, "host1_max": 0}
+
+    async def _export(host):
+        async with admission.admit(host):
+            running["total"] += 1
+            running["max"] = max(running["max"], running["total"])
+            if host == "host1":
+                running["host1"] += 1
+                running["host1_max"] = max(running["host1_max"], running["host1"])
+            await asyncio.sleep(0.02)
+            running["total"] -= 1
+            if host == "host1":
+                running["host1"] -= 1
+
+    await asyncio.gather(*[_export(f"host{i % 4}") for i in range(12)])
+    assert running["max"] == 3
+    assert running["host1_max"] == 1
+    assert admission.active == 0
+    assert not admission.waiters
+
+
+async def test_admission_priority():
+    admission = AdmissionController(max_active=1)
+    order = []
+
+    async def _export(name, priority):
+        async with admission.admit("host", priority=priority):
+            order.append(name)
+            await asyncio.sleep(0.01)
+
+    first = asyncio.ensure_future(_export("first", "low"))
+    await asyncio.sleep(0)
+    tasks = [
+        asyncio.ensure_future(_export(name, priority))
+        for name, priority in (("low", "low"), ("normal", "normal"), ("high", "high"))]
+    await asyncio.sleep(0)
+    await asyncio.gather(first, *tasks)
+    assert order == ["first", "high", "normal", "low"]
+
+
+async def test_admission_busy_host_does_not_block_others():
+    admission = AdmissionController(max_active=4, max_active_per_host=1)
+    release = asyncio.Event()
+
+    async def _export(host):
+        async with admission.admit(host):
+            await release.wait()
+
+    busy = asyncio.ensure_future(_export("host1"))
+    waiting = asyncio.ensure_future(_export("host1"))
+    await asyncio.sleep(0)
+    assert len(admission.waiters) == 1
+
+    # a request for another host is admitted right away
+    async with admission.admit("host2"):
+        assert admission.active == 2
+
+    release.set()
+    await asyncio.gather(busy, waiting)
+
+
+async def test_admission_rejections():
+    admission = AdmissionController(max_active=1, max_queued=1, max_wait=0.1)
+    release = asyncio.Event()
+
+    async def _export():
+        async with admission.admit("host"):
+            await release.wait()
+
+    running = asyncio.ensure_future(_export())
+    await asyncio.sleep(0)
+    queued = asyncio.ensure_future(_export())
+    await asyncio.sleep(0)
+
+    with pytest.raises(AdmissionRejected) as excinfo:
+        async with admission.admit("host"):
+            pass
+    assert excinfo.value.status == 429
+    assert excinfo.value.retry_after >= 1
+
+    with pytest.raises(AdmissionRejected) as excinfo:
+        await queued
+    assert excinfo.value.status == 503
+    assert not admission.waiters
+
+    # a cancelled waiter gives up its place in the queue
+    cancelled = asyncio.ensure_future(_export())
+    await asyncio.sleep(0)
+    cancelled.cancel()
+    await asyncio.gather(cancelled, return_exceptions=True)
+    assert not admission.waiters
+
+    release.set()
+    await running
+    assert admission.active == 0
+
+
+async def test_admission_unbounded():
+    admission = AdmissionController(max_active=1, max_queued=1, max_wait=0.1)
+    release = asyncio.Event()
+
+    async def _export(bounded=True):
+        async with admission.admit("host", bounded=bounded):
+            await release.wait()
+
+    running = asyncio.ensure_future(_export())
+    await asyncio.sleep(0)
+
+    # unbounded requests wait past max_wait and do not take up the queue
+    background = [asyncio.ensure_future(_export(bounded=False)) for _ in range(3)]
+    await asyncio.sleep(0)
+    queued = asyncio.ensure_future(_export())
+    await asyncio.sleep(0.2)
+    assert not any(task.done() for task in background)
+    with pytest.raises(AdmissionRejected) as excinfo:
+        await queued
+    assert excinfo.value.status == 503
+
+    release.set()
+    await asyncio.gather(running, *background)
+    assert admission.active == 0
+    assert not admission.waiters
@@ -1,15 +1,24 @@
 
 import aiohttp.web
+import asyncio
+import datetime
 import importlib.metadata
+import io
 import json
 import logging
+import mock
 import os
 import pathlib
 import pytest
 import re
 import shutil
+import tarfile
+import yaml
+import zipfile
 
+import metadata_service.admission
 import metadata_service.app
+import metadata_service.archives
 import metadata_service.clients
 import metadata_service.process
 
@@ -34,8 +43,15 @@ def test_snpseq_data_json(test_snpseq_data_path):
 
 
 @pytest.fixture
-def test_config():
-    return pathlib.Path("tests/config")
+def test_config(tmp_path):
+    # keep the export index under tmp_path, so that each test starts with an empty index
+    config_path = tmp_path / "config"
+    shutil.copytree("tests/config", config_path)
+    app_config = config_path / "app.yaml"
+    conf = yaml.safe_load(app_config.read_text())
+    conf["export_index"] = str(tmp_path / "exports.sqlite")
+    app_config.write_text(yaml.safe_dump(conf))
+    return config_path
 
 
 @pytest.fixture
@@ -73,6 +89,18 @@ async def snpseq_data_server(aiohttp_server, load_config):
                 data=data,
                 status=status)
 
+        if "truncate" in q:
+            # announce the whole body but drop the connection part of the way through it
+            body = json.dumps(data).encode()
+            response = aiohttp.web.StreamResponse(
+                status=status,
+                headers={"Content-Type": content_type})
+            response.content_length = len(body)
+            await response.prepare(request)
+            await response.write(body[0:int(q["truncate"])])
+            request.transport.close()
+            return response
+
         return aiohttp.web.Response(
             text=json.dumps(data),
             content_type=content_type,
@@ -114,38 +142,45 @@ class SnpseqDataTestRequest(metadata_service.clients.SnpseqDataRequest):
 
 class MetadataTestProcessRunner(metadata_service.process.MetadataProcessRunner):
 
-    def __init__(self, metadata_executable):
-        super(MetadataTestProcessRunner, self).__init__(metadata_executable="echo")
+    def __init__(self, metadata_executable, **kwargs):
+        super(MetadataTestProcessRunner, self).__init__(metadata_executable="echo", **kwargs)
 
-    def extract_runfolder_metadata(self, *args):
-        outfile = super(MetadataTestProcessRunner, self).extract_runfolder_metadata(
+    async def extract_runfolder_metadata(self, *args):
+        outfile = await super(MetadataTestProcessRunner, self).extract_runfolder_metadata(
             *args)
         srcfile = os.path.join("tests", "test_data", os.path.basename(outfile))
         shutil.copy(srcfile, outfile)
         return outfile
 
-    def extract_snpseq_data_metadata(self, *args):
-        outfile = super(MetadataTestProcessRunner, self).extract_snpseq_data_metadata(
+    async def extract_snpseq_data_metadata(self, *args):
+        outfile = await super(MetadataTestProcessRunner, self).extract_snpseq_data_metadata(
             *args)
         srcfile = os.path.join("tests", "test_data", os.path.basename(outfile))
         shutil.copy(srcfile, outfile)
         return outfile
 
-    def export_runfolder_metadata(self, *args):
-        super(MetadataTestProcessRunner, self).export_runfolder_metadata(
+    async def export_runfolder_metadata(self, *args):
+        await super(MetadataTestProcessRunner, self).export_runfolder_metadata(
             *args)
         outdir = args[-1]
         srcdir = os.path.join("tests", "test_data")
         outfiles = []
 
         # extract the "original" project names from the lims export and the "tweaked" from the lims
-        # extract
-        projects = [[], []]
-        for i, jsonfile in enumerate((args[1], args[1].replace(".ngi.json", ".json"))):
-            projects[i] = get_projects_from_jsonfile(jsonfile)
+        # extract, which may have been filtered to some of the projects or split by project
+        lims_ngi_json = args[1]
+        lims_json = args[1].replace(".ngi.json", ".json")
+        while not os.path.exists(lims_json):
+            lims_ngi_json, lims_json = [
+                os.path.join(os.path.dirname(os.path.dirname(path)), os.path.basename(path))
+                for path in (lims_ngi_json, lims_json)]
+        projects = [
+            get_projects_from_jsonfile(jsonfile) for jsonfile in (lims_ngi_json, lims_json)]
+        exported = get_projects_from_jsonfile(args[1])
 
         for srcfile in filter(
-                lambda f: f.endswith(".xml") or f.endswith(".tsv"),
+                lambda f: (f.endswith(".xml") or f.endswith(".tsv")) and
+                any(f.startswith(prj) for prj in exported),
                 os.listdir(srcdir)):
             outfile = srcfile
             for prj_s, prj_c in zip(projects[0], projects[1]):
@@ -168,6 +203,16 @@ async def test_version(cli):
     assert ver["version"] == importlib.metadata.version('metadata-service')
 
 
+async def test_metrics(cli):
+    base_url = cli.server.app["config"].get("base_url", "")
+    resp = await cli.get(f"{base_url}/metrics")
+    assert resp.status == 200
+    assert resp.content_type == "text/plain"
+    metrics = await resp.text()
+    assert "# TYPE metadata_service_stage_duration_seconds histogram" in metrics
+    assert "metadata_service_exports_in_progress 0" in metrics
+
+
 async def _export_helper(
         snpseq_data_server,
         cli,
@@ -278,3 +323,633 @@ async def test_export_with_lims_cache(
         test_snpseq_data_path,
         lims_data_cache=True,
     )
+
+
+async def test_export_job(
+        snpseq_data_server,
+        cli,
+        test_runfolder
+):
+    base_url = cli.server.app["config"].get("base_url", "")
+    host = "test_data"
+    metadatadir = os.path.join(
+        cli.server.app["config"]["datadir"].format(host=host, runfolder=test_runfolder),
+        "metadata")
+
+    resp = await cli.post(f"{base_url}/export/{host}/{test_runfolder}")
+    assert resp.status == 202
+    job = await resp.json()
+    assert job["status"] in ("queued", "running")
+    job_url = job["url"]
+    assert job_url == f"{base_url}/jobs/{job['job_id']}"
+
+    for _ in range(100):
+        resp = await cli.get(job_url)
+        assert resp.status == 200
+        job = await resp.json()
+        if job["status"] not in ("queued", "running"):
+            break
+        await asyncio.sleep(0.05)
+
+    assert job["status"] == "done"
+    assert job["metadata"]
+    for metafile in job["metadata"]:
+        assert os.path.exists(metafile)
+
+    resp = await cli.get(f"{base_url}/jobs")
+    assert job["job_id"] in [j["job_id"] for j in (await resp.json())["jobs"]]
+
+    resp = await cli.get(f"{base_url}/jobs/unknown")
+    assert resp.status == 404
+
+    shutil.rmtree(metadatadir)
+
+
+def test_workers(test_config):
+    # the export jobs are only served by a single worker
+    app = metadata_service.app.setup_app(
+        test_config,
+        process_runner_cls=MetadataTestProcessRunner,
+        data_session_cls=SnpseqDataTestRequest,
+        workers=2)
+    paths = {resource.canonical for resource in app.router.resources()}
+    assert "/api/1.0/export/{host}/{runfolder}" in paths
+    assert "/api/1.0/jobs/{job_id}" not in paths
+
+    # and the service does not start with several workers that would each apply the admission
+    # limits
+    conf = metadata_service.app.load_config(test_config)
+    conf["admission"] = {"max_active": 8}
+    args = mock.Mock(configroot=test_config, workers=2)
+    with mock.patch.object(metadata_service.app, "parse_args", return_value=args), \
+            mock.patch.object(metadata_service.app, "load_config", return_value=conf), \
+            mock.patch.object(metadata_service.app, "WorkerSupervisor") as supervisor, \
+            pytest.raises(SystemExit):
+        metadata_service.app.start()
+    supervisor.assert_not_called()
+
+
+async def test_batch_export(
+        snpseq_data_server,
+        cli,
+        test_runfolder
+):
+    base_url = cli.server.app["config"].get("base_url", "")
+    host = "test_data"
+    metadatadir = os.path.join(
+        cli.server.app["config"]["datadir"].format(host=host, runfolder=test_runfolder),
+        "metadata")
+
+    with mock.patch.object(
+            SnpseqDataTestRequest,
+            "request_snpseq_data_metadata",
+            autospec=True,
+            side_effect=SnpseqDataTestRequest.request_snpseq_data_metadata) as lims_mock:
+        resp = await cli.post(
+            f"{base_url}/export",
+            json={
+                "runfolders": [
+                    {"host": host, "runfolder": test_runfolder},
+                    {"host": host, "runfolder": test_runfolder},
+                    {"host": host}
+                ]
+            })
+        # the two runfolders on the same flowcell share the LIMS lookup
+        assert lims_mock.call_count == 1
+
+    assert resp.status == 200
+    results = (await resp.json())["results"]
+    assert len(results) == 3
+    for result in results[0:2]:
+        assert result["runfolder"] == test_runfolder
+        assert result["metadata"]
+        assert "exception" not in result
+    assert "exception" in results[2]
+    assert "metadata" not in results[2]
+
+    resp = await cli.post(f"{base_url}/export", json={"runfolder": test_runfolder})
+    assert resp.status == 400
+
+    shutil.rmtree(metadatadir)
+
+
+@pytest.mark.parametrize("stream", ["ndjson", "sse"])
+async def test_export_stream(
+        snpseq_data_server,
+        cli,
+        test_runfolder,
+        stream
+):
+    base_url = cli.server.app["config"].get("base_url", "")
+    host = "test_data"
+    metadatadir = os.path.join(
+        cli.server.app["config"]["datadir"].format(host=host, runfolder=test_runfolder),
+        "metadata")
+
+    resp = await cli.get(f"{base_url}/export/{host}/{test_runfolder}?stream={stream}")
+    assert resp.status == 200
+    body = await resp.text()
+    if stream == "sse":
+        assert resp.content_type == "text/event-stream"
+        events = [
+            json.loads(line[len("data: "):])
+            for line in body.splitlines()
+            if line.startswith("data: ")]
+    else:
+        assert resp.content_type == "application/x-ndjson"
+        events = [json.loads(line) for line in body.splitlines()]
+
+    stages = [(event["event"], event["stage"]) for event in events if "stage" in event]
+    for stage in ("lims_fetch", "extract_snpseq_data", "extract_runfolder", "export"):
+        assert ("started", stage) in stages
+        assert ("finished", stage) in stages
+        assert stages.index(("started", stage)) < stages.index(("finished", stage))
+    assert stages[-1] == ("finished", "export")
+    assert all(
+        "elapsed" in event for event in events if event["event"] == "finished")
+
+    assert events[-1]["event"] == "result"
+    assert sorted(events[-1]["metadata"]) == sorted(events[-2]["paths"])
+
+    resp = await cli.get(f"{base_url}/export/{host}/{test_runfolder}?stream=xml")
+    assert resp.status == 400
+
+    shutil.rmtree(metadatadir)
+
+
+async def test_export_incremental(
+        snpseq_data_server,
+        cli,
+        test_runfolder
+):
+    base_url = cli.server.app["config"].get("base_url", "")
+    host = "test_data"
+    metadatadir = os.path.join(
+        cli.server.app["config"]["datadir"].format(host=host, runfolder=test_runfolder),
+        "metadata")
+    shutil.rmtree(metadatadir, ignore_errors=True)
+
+    # a file left from an earlier export is not reported
+    os.makedirs(metadatadir)
+    stale_file = os.path.join(metadatadir, "ZZ-9999-run.xml")
+    open(stale_file, "w").close()
+
+    async def _export():
+        resp = await cli.get(f"{base_url}/export/{host}/{test_runfolder}?stream=ndjson")
+        events = [json.loads(line) for line in (await resp.text()).splitlines()]
+        export_event = [
+            event for event in events
+            if event.get("stage") == "export" and event["event"] == "finished"][0]
+        return export_event, events[-1]["metadata"]
+
+    export_event, metadata = await _export()
+    assert not export_event.get("skipped")
+    assert metadata
+    assert stale_file not in metadata
+
+    # an export from identical inputs is skipped
+    export_event, metadata_again = await _export()
+    assert export_event.get("skipped")
+    assert sorted(metadata_again) == sorted(metadata)
+
+    # unless a refresh is requested
+    resp = await cli.get(f"{base_url}/export/{host}/{test_runfolder}?refresh=true")
+    assert sorted((await resp.json())["metadata"]) == sorted(metadata)
+
+    # or an output has been modified
+    with open(metadata[0], "a") as fh:
+        fh.write("modified")
+    export_event, _ = await _export()
+    assert not export_event.get("skipped")
+
+    shutil.rmtree(metadatadir)
+
+
+async def test_export_admission(cli, test_runfolder):
+    base_url = cli.server.app["config"].get("base_url", "")
+    export_handler = [
+        route.handler.__self__ for route in cli.server.app.router.routes()
+        if route.method == "GET" and route.resource.canonical.endswith("/export/{host}/{runfolder}")
+    ][0]
+    export_handler.admission = metadata_service.admission.AdmissionController(
+        max_active=1,
+        max_queued=1,
+        max_wait=0.5)
+
+    release = asyncio.Event()
+
+    async def _run_export(*args, **kwargs):
+        await release.wait()
+        return ["exported"]
+
+    with mock.patch.object(export_handler, "run_export", side_effect=_run_export):
+        url = f"{base_url}/export/test_data/{test_runfolder}"
+        running = asyncio.ensure_future(cli.get(url))
+        await asyncio.sleep(0.1)
+        queued = asyncio.ensure_future(cli.get(f"{url}?priority=high"))
+        await asyncio.sleep(0.1)
+
+        # the queue is full
+        resp = await cli.get(url)
+        assert resp.status == 429
+        assert int(resp.headers["Retry-After"]) >= 1
+
+        # the queued request times out
+        resp = await queued
+        assert resp.status == 503
+        assert "Retry-After" in resp.headers
+
+        resp = await cli.get(f"{url}?priority=urgent")
+        assert resp.status == 400
+
+        # a streamed export is told that it is queued, and the rejection is streamed
+        resp = await cli.get(url, params={"stream": "ndjson"})
+        assert resp.status == 200
+        events = [json.loads(line) for line in (await resp.text()).splitlines()]
+        assert events[0] == {"event": "queued"}
+        assert events[-1]["event"] == "error"
+        assert events[-1]["status"] == 503
+        assert events[-1]["retry_after"] >= 1
+
+        # batch exports and export jobs go through the same admission control
+        resp = await cli.post(
+            f"{base_url}/export",
+            json={"runfolders": [
+                {"host": "test_data", "runfolder": test_runfolder, "lims_data": "lims.json"}]})
+        assert resp.status == 200
+        result = (await resp.json())["results"][0]
+        assert "not admitted" in result["exception"]
+        assert result["status"] == 503
+        assert result["retry_after"] >= 1
+        resp = await cli.post(
+            f"{base_url}/export",
+            json={"runfolders": [], "concurrency": "many"})
+        assert resp.status == 400
+
+        # but export jobs wait for a slot for as long as it takes
+        resp = await cli.post(url)
+        assert resp.status == 202
+        job_url = (await resp.json())["url"]
+        await asyncio.sleep(1)
+        job = await (await cli.get(job_url)).json()
+        assert job["status"] in ("queued", "running")
+
+        release.set()
+        resp = await running
+        assert resp.status == 200
+        assert (await resp.json())["metadata"] == ["exported"]
+
+        for _ in range(50):
+            job = await (await cli.get(job_url)).json()
+            if job["status"] not in ("queued", "running"):
+                break
+            await asyncio.sleep(0.05)
+        assert job["status"] == "done"
+
+
+async def test_request_id(cli):
+    base_url = cli.server.app["config"].get("base_url", "")
+    resp = await cli.get(f"{base_url}/version")
+    assert resp.headers["X-Request-ID"]
+
+    resp = await cli.get(f"{base_url}/version", headers={"X-Request-ID": "abc123"})
+    assert resp.headers["X-Request-ID"] == "abc123"
+
+
+@pytest.mark.parametrize("mode", ["cprofile", "sampling"])
+async def test_profile(cli, mode):
+    base_url = cli.server.app["config"].get("base_url", "")
+    resp = await cli.post(f"{base_url}/admin/profile", json={"mode": mode, "requests": 2})
+    assert resp.status == 202
+    assert (await resp.json())["requests_remaining"] == 2
+
+    for _ in range(3):
+        await cli.get(f"{base_url}/version")
+
+    resp = await cli.get(f"{base_url}/admin/profile")
+    report = await resp.json()
+    assert report["mode"] == mode
+    assert report["requests_profiled"] == 2
+    assert report["requests_remaining"] == 0
+    if mode == "cprofile":
+        assert "version" in report["profile"]
+
+    resp = await cli.post(f"{base_url}/admin/profile", json={"mode": "unknown"})
+    assert resp.status == 400
+    resp = await cli.post(f"{base_url}/admin/profile", json=[])
+    assert resp.status == 400
+    resp = await cli.get(f"{base_url}/admin/profile", params={"limit": "many"})
+    assert resp.status == 400
+
+
+async def test_export_index(
+        snpseq_data_server,
+        cli,
+        test_runfolder
+):
+    base_url = cli.server.app["config"].get("base_url", "")
+    host = "test_data"
+    metadatadir = os.path.join(
+        cli.server.app["config"]["datadir"].format(host=host, runfolder=test_runfolder),
+        "metadata")
+    shutil.rmtree(metadatadir, ignore_errors=True)
+    since = datetime.datetime.now().isoformat()
+
+    resp = await cli.get(f"{base_url}/export/{host}/{test_runfolder}")
+    assert resp.status == 200
+    metadata = (await resp.json())["metadata"]
+
+    resp = await cli.get(f"{base_url}/exports/{host}/{test_runfolder}")
+    assert resp.status == 200
+    export = await resp.json()
+    assert export["status"] == "done"
+    assert sorted(export["metadata"]) == sorted(metadata)
+    assert export["flowcell_id"] == "XYZ321XY"
+    assert "AB-1234" in export["projects"]
+    assert "export" in export["stages"]
+
+    resp = await cli.get(f"{base_url}/exports", params={"since": since, "project": "AB-1234"})
+    exports = await resp.json()
+    assert exports["total"] == 1
+    assert exports["exports"][0]["export_id"] == export["export_id"]
+
+    resp = await cli.get(f"{base_url}/exports", params={"since": since, "project": "XX-0000"})
+    assert (await resp.json())["total"] == 0
+
+    resp = await cli.get(f"{base_url}/exports", params={"since": "yesterday"})
+    assert resp.status == 400
+
+    resp = await cli.get(f"{base_url}/exports/{host}/unknown_runfolder")
+    assert resp.status == 404
+
+    shutil.rmtree(metadatadir)
+
+
+async def test_export_projects(
+        snpseq_data_server,
+        cli,
+        test_runfolder
+):
+    base_url = cli.server.app["config"].get("base_url", "")
+    host = "test_data"
+    metadatadir = os.path.join(
+        cli.server.app["config"]["datadir"].format(host=host, runfolder=test_runfolder),
+        "metadata")
+    shutil.rmtree(metadatadir, ignore_errors=True)
+
+    resp = await cli.get(
+        f"{base_url}/export/{host}/{test_runfolder}", params={"project": "AB-1234"})
+    assert resp.status == 200
+    metadata = (await resp.json())["metadata"]
+    assert sorted(os.path.basename(path) for path in metadata) == [
+        "AB-1234-experiment.xml", "AB-1234-run.xml", "AB-1234.metadata.ena.tsv"]
+
+    resp = await cli.get(f"{base_url}/exports/{host}/{test_runfolder}")
+    assert (await resp.json())["projects"] == ["AB-1234"]
+
+    resp = await cli.get(
+        f"{base_url}/export/{host}/{test_runfolder}",
+        params=[("project", "AB-1234"), ("project", "XX-0000")])
+    assert resp.status == 400
+    assert "XX-0000" in (await resp.json())["exception"]
+
+    resp = await cli.get(
+        f"{base_url}/export/{host}/{test_runfolder}",
+        params=[("project", "XX-0000"), ("stream", "ndjson")])
+    events = [json.loads(line) for line in (await resp.text()).splitlines()]
+    assert events[-1]["event"] == "error"
+    assert events[-1]["status"] == 400
+    assert "XX-0000" in events[-1]["exception"]
+
+    resp = await cli.post(
+        f"{base_url}/export",
+        json={"runfolders": [{"host": host, "runfolder": test_runfolder, "projects": ["XX-0000"]}]})
+    result = (await resp.json())["results"][0]
+    assert result["status"] == 400
+    assert "XX-0000" in result["exception"]
+
+    shutil.rmtree(metadatadir)
+
+
+async def test_export_shards(
+        snpseq_data_server,
+        cli,
+        test_runfolder
+):
+    base_url = cli.server.app["config"].get("base_url", "")
+    host = "test_data"
+    metadatadir = os.path.join(
+        cli.server.app["config"]["datadir"].format(host=host, runfolder=test_runfolder),
+        "metadata")
+    export_handler = [
+        route.handler.__self__ for route in cli.server.app.router.routes()
+        if route.method == "GET" and route.resource.canonical.endswith("/export/{host}/{runfolder}")
+    ][0]
+
+    exported = {}
+    for shard_workers in (None, 2):
+        shutil.rmtree(metadatadir, ignore_errors=True)
+        export_handler.shard_workers = shard_workers
+        resp = await cli.get(
+            f"{base_url}/export/{host}/{test_runfolder}?stream=ndjson&refresh=true")
+        assert resp.status == 200
+        events = [json.loads(line) for line in (await resp.text()).splitlines()]
+        export_event = [
+            event for event in events
+            if event.get("event") == "finished" and event.get("stage") == "export"][0]
+        assert export_event.get("shards") == (3 if shard_workers else None)
+        exported[shard_workers] = sorted(events[-1]["metadata"])
+
+    assert exported[None] == exported[2]
+    assert len(exported[2]) == 9
+    export_handler.shard_workers = None
+    shutil.rmtree(metadatadir)
+
+
+async def test_inventory(cli, test_runfolder):
+    base_url = cli.server.app["config"].get("base_url", "")
+    host = "test_data"
+
+    resp = await cli.get(f"{base_url}/inventory/{host}/{test_runfolder}")
+    assert resp.status == 200
+    inventory = await resp.json()
+    assert inventory["projects"] == ["AB-1234", "CD-5678"]
+    assert len(inventory["files"]) == len(inventory["checksums"]) == 24
+
+    resp = await cli.get(
+        f"{base_url}/inventory/{host}/{test_runfolder}", params={"project": "CD-5678"})
+    files = (await resp.json())["files"]
+    assert files and all(f["project"] == "CD-5678" for f in files)
+
+    resp = await cli.get(f"{base_url}/inventory/{host}/no_such_runfolder")
+    assert resp.status == 404
+
+
+async def test_checksums(cli, tmp_path, test_runfolder):
+    base_url = cli.server.app["config"].get("base_url", "")
+    host = "test_data"
+    runfolder_path = cli.server.app["config"]["datadir"].format(
+        host=host,
+        runfolder=test_runfolder)
+    state_file = os.path.join(runfolder_path, "MD5", "checksums.state.json")
+    lock_file = os.path.join(runfolder_path, "MD5", "checksums.lock")
+
+    try:
+        resp = await cli.post(
+            f"{base_url}/checksums/{host}/{test_runfolder}",
+            params={"mode": "verify", "stream": "ndjson"})
+        assert resp.status == 200
+        events = [json.loads(line) for line in (await resp.text()).splitlines()]
+        assert events[0]["event"] == "progress"
+        assert events[-1]["event"] == "result"
+        assert events[-1]["ok"]
+
+        resp = await cli.post(f"{base_url}/checksums/{host}/{test_runfolder}")
+        result = await resp.json()
+        assert result["ok"] and result["unchanged"] == 24
+
+        # a run in another process is reported as a conflict, also when streaming
+        checksum_runner = [
+            route.handler.__self__ for route in cli.server.app.router.routes()
+            if route.resource.canonical.endswith("/checksums/{host}/{runfolder}")
+        ][0].checksum_runner
+        lock_fd = checksum_runner.acquire_lock(runfolder_path)
+        try:
+            resp = await cli.post(f"{base_url}/checksums/{host}/{test_runfolder}")
+            assert resp.status == 409
+            resp = await cli.post(
+                f"{base_url}/checksums/{host}/{test_runfolder}",
+                params={"stream": "ndjson"})
+            events = [json.loads(line) for line in (await resp.text()).splitlines()]
+            assert events[-1]["event"] == "error"
+            assert events[-1]["status"] == 409
+        finally:
+            os.close(lock_fd)
+    finally:
+        for path in (state_file, lock_file):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    resp = await cli.post(f"{base_url}/checksums/{host}/{test_runfolder}?mode=rehash")
+    assert resp.status == 400
+    resp = await cli.post(f"{base_url}/checksums/{host}/no_such_runfolder")
+    assert resp.status == 404
+
+
+async def test_download_outside_metadata(cli, tmp_path, test_runfolder):
+    base_url = cli.server.app["config"].get("base_url", "")
+    host = "test_data"
+    runfolder_path = cli.server.app["config"]["datadir"].format(
+        host=host,
+        runfolder=test_runfolder)
+    metadatadir = os.path.join(runfolder_path, "metadata")
+    shutil.rmtree(metadatadir, ignore_errors=True)
+    os.makedirs(metadatadir)
+
+    # a manifest listing files outside of the metadata directory, directly or through a link
+    secret = tmp_path / "secret.txt"
+    secret.write_text("secret")
+    exported = os.path.join(metadatadir, "AB-1234-run.xml")
+    with open(exported, "w") as fh:
+        fh.write("<run/>")
+    os.symlink(secret, os.path.join(metadatadir, "AB-1234-link.xml"))
+    outputs = [
+        str(secret),
+        os.path.join(metadatadir, "..", "fc_SampleSheet.csv"),
+        os.path.join(metadatadir, "AB-1234-link.xml"),
+        exported]
+    with open(os.path.join(metadatadir, ".export_manifest.json"), "w") as fh:
+        json.dump({"inputs": {}, "outputs": {path: {} for path in outputs}}, fh)
+
+    try:
+        resp = await cli.get(f"{base_url}/download/{host}/{test_runfolder}")
+        assert [f["name"] for f in (await resp.json())["files"]] == ["AB-1234-run.xml"]
+        for name in ("secret.txt", "fc_SampleSheet.csv", "AB-1234-link.xml"):
+            resp = await cli.get(f"{base_url}/download/{host}/{test_runfolder}/{name}")
+            assert resp.status == 404
+
+        resp = await cli.get(
+            f"{base_url}/download/{host}/{test_runfolder}", params={"format": "zip"})
+        with zipfile.ZipFile(io.BytesIO(await resp.read())) as archive:
+            assert archive.namelist() == [f"{test_runfolder}/AB-1234-run.xml"]
+    finally:
+        shutil.rmtree(metadatadir)
+
+
+@pytest.mark.parametrize("archive_format", ["zip", "tar.gz"])
+async def test_download(
+        snpseq_data_server,
+        cli,
+        test_runfolder,
+        archive_format
+):
+    base_url = cli.server.app["config"].get("base_url", "")
+    host = "test_data"
+    metadatadir = os.path.join(
+        cli.server.app["config"]["datadir"].format(host=host, runfolder=test_runfolder),
+        "metadata")
+    shutil.rmtree(metadatadir, ignore_errors=True)
+
+    resp = await cli.get(f"{base_url}/download/{host}/{test_runfolder}")
+    assert resp.status == 404
+
+    resp = await cli.get(f"{base_url}/export/{host}/{test_runfolder}")
+    metadata = (await resp.json())["metadata"]
+    contents = {}
+    for path in metadata:
+        with open(path, "rb") as fh:
+            contents[os.path.basename(path)] = fh.read()
+
+    resp = await cli.get(f"{base_url}/download/{host}/{test_runfolder}")
+    files = (await resp.json())["files"]
+    assert sorted(f["name"] for f in files) == sorted(contents)
+
+    # single files support conditional and range requests
+    name = files[0]["name"]
+    resp = await cli.get(files[0]["url"])
+    assert resp.status == 200
+    assert await resp.read() == contents[name]
+    etag = resp.headers["ETag"]
+    resp = await cli.get(files[0]["url"], headers={"If-None-Match": etag})
+    assert resp.status == 304
+    resp = await cli.get(files[0]["url"], headers={"Range": "bytes=0-9"})
+    assert resp.status == 206
+    assert await resp.read() == contents[name][0:10]
+
+    resp = await cli.get(f"{base_url}/download/{host}/{test_runfolder}/..%2Fconfig.yaml")
+    assert resp.status == 404
+
+    resp = await cli.get(
+        f"{base_url}/download/{host}/{test_runfolder}",
+        params={"format": archive_format, "project": "AB-1234"})
+    assert resp.status == 200
+    assert f"{test_runfolder}.metadata.{archive_format}" in resp.headers["Content-Disposition"]
+    body = await resp.read()
+    if archive_format == "zip":
+        with zipfile.ZipFile(io.BytesIO(body)) as archive:
+            archived = {name: archive.read(name) for name in archive.namelist()}
+    else:
+        with tarfile.open(fileobj=io.BytesIO(body), mode="r:gz") as archive:
+            archived = {
+                member.name: archive.extractfile(member).read() for member in archive.getmembers()}
+    assert archived == {
+        f"{test_runfolder}/{name}": data for name, data in contents.items()
+        if name.startswith("AB-1234")}
+
+    # projects are matched on the whole project id
+    resp = await cli.get(
+        f"{base_url}/download/{host}/{test_runfolder}", params={"project": "AB-123"})
+    assert (await resp.json())["files"] == []
+
+    resp = await cli.get(f"{base_url}/download/{host}/{test_runfolder}?format=rar")
+    assert resp.status == 400
+
+    with mock.patch.object(
+            metadata_service.archives.ArchiveWriter,
+            "stream",
+            side_effect=metadata_service.archives.ArchiveWritersBusy("busy", 10)):
+        resp = await cli.get(
+            f"{base_url}/download/{host}/{test_runfolder}", params={"format": archive_format})
+    assert resp.status == 503
+    assert resp.headers["Retry-After"] == "10"
+    shutil.rmtree(metadatadir)
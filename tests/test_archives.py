@@ -0,0 +1,38 @@
+import asyncio
+import io
+import mock
+import pytest
+import zipfile
+
+from metadata_service.archives import ArchiveWriter, ArchiveWritersBusy
+
+
+async def test_archive_writer(tmp_path):
+    path = tmp_path / "AB-1234-run.xml"
+    path.write_bytes(b"<run/>")
+    written = []
+    response = mock.Mock(
+        prepare=mock.AsyncMock(),
+        write=mock.AsyncMock(side_effect=written.append))
+
+    writer = ArchiveWriter(workers=1, retry_after=5)
+    context = writer.archive_context(None)
+    await context.__anext__()
+    await writer.stream(mock.Mock(), response, "zip", [(str(path), "run/AB-1234-run.xml")])
+    response.prepare.assert_awaited_once()
+    with zipfile.ZipFile(io.BytesIO(b"".join(written))) as archive:
+        assert archive.read("run/AB-1234-run.xml") == b"<run/>"
+    await asyncio.sleep(0)
+    assert writer.active == 0
+
+    # requests beyond the number of workers are turned away before the response is prepared
+    writer.active = 1
+    response.prepare.reset_mock()
+    with pytest.raises(ArchiveWritersBusy) as exc_info:
+        await writer.stream(mock.Mock(), response, "zip", [])
+    assert exc_info.value.retry_after == 5
+    response.prepare.assert_not_awaited()
+
+    with pytest.raises(StopAsyncIteration):
+        await context.__anext__()
+    assert writer._executor is None
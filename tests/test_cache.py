@@ -0,0 +1,134 @@
+import mock
+import os
+import pathlib
+import pytest
+import shutil
+import time
+
+from metadata_service.cache import ExtractCache, runfolder_fingerprint, snpseq_data_fingerprint
+from metadata_service.handlers import ExportHandler
+from metadata_service.workspace import Workspace
+
+from tests.test_app import test_runfolder
+
+
+def test_runfolder_fingerprint(tmp_path, test_runfolder):
+    runfolder_path = tmp_path / test_runfolder
+    shutil.copytree(
+        pathlib.Path("tests", "test_data", "runfolders", test_runfolder),
+        runfolder_path)
+
+    fingerprint = runfolder_fingerprint(runfolder_path)
+    assert fingerprint == runfolder_fingerprint(runfolder_path)
+
+    # a modified input file changes the fingerprint
+    samplesheet = runfolder_path / "fc_SampleSheet.csv"
+    with open(samplesheet, "a") as fh:
+        fh.write("\n")
+    modified = runfolder_fingerprint(runfolder_path)
+    assert modified != fingerprint
+
+    # a new fastq file changes the fingerprint
+    fastq = next((runfolder_path / "Unaligned").rglob("*.fastq.gz"))
+    shutil.copy(fastq, fastq.parent / "Extra_S9_L001_R1_001.fastq.gz")
+    assert runfolder_fingerprint(runfolder_path) != modified
+
+    # a fastq file modified in place, without its directory changing, changes the fingerprint
+    modified = runfolder_fingerprint(runfolder_path)
+    dir_stat = os.stat(fastq.parent)
+    with open(fastq, "ab") as fh:
+        fh.write(b"\0")
+    os.utime(fastq.parent, ns=(dir_stat.st_atime_ns, dir_stat.st_mtime_ns))
+    assert runfolder_fingerprint(runfolder_path) != modified
+
+    # files outside of the inputs do not change the fingerprint
+    modified = runfolder_fingerprint(runfolder_path)
+    os.makedirs(runfolder_path / "metadata", exist_ok=True)
+    (runfolder_path / "metadata" / "AB-1234-run.xml").touch()
+    assert runfolder_fingerprint(runfolder_path) == modified
+
+
+def test_extract_cache(tmp_path):
+    cache = ExtractCache(str(tmp_path / "cache"))
+    src = tmp_path / "src.ngi.json"
+    src.write_text("{}")
+    dest = str(tmp_path / "dest.ngi.json")
+
+    assert cache.get("abcdef", dest) is None
+    cache.put("abcdef", str(src))
+    assert cache.get("abcdef", dest) == dest
+    assert pathlib.Path(dest).read_text() == "{}"
+
+    # only a missing entry is a cache miss, not a missing destination
+    with pytest.raises(FileNotFoundError):
+        cache.get("abcdef", str(tmp_path / "missing" / "dest.ngi.json"))
+
+    cache.invalidate("abcdef")
+    assert cache.get("abcdef", dest) is None
+
+
+def test_extract_cache_eviction(tmp_path):
+    cache = ExtractCache(str(tmp_path / "cache"), max_entries=2, max_size=25)
+    src = tmp_path / "src.ngi.json"
+    src.write_text("0123456789")
+    dest = str(tmp_path / "dest.ngi.json")
+
+    for key in ("aa01", "bb02"):
+        cache.put(key, str(src))
+        time.sleep(0.01)
+
+    # use the oldest entry so that the other one is the least recently used
+    assert cache.get("aa01", dest) == dest
+    time.sleep(0.01)
+    cache.put("cc03", str(src))
+    assert cache.get("bb02", dest) is None
+    assert cache.get("aa01", dest) == dest
+    assert cache.get("cc03", dest) == dest
+
+    # the size limit is also respected
+    src.write_text("0123456789" * 2)
+    cache.put("dd04", str(src))
+    assert len(cache.entries()) == 1
+    assert cache.get("dd04", dest) == dest
+
+
+def test_snpseq_data_fingerprint(tmp_path):
+    lims_json = pathlib.Path("tests", "test_data", "XYZ321XY.lims.json")
+    other = tmp_path / "XYZ321XY.lims.json"
+    shutil.copy(lims_json, other)
+
+    # identical contents give the same fingerprint wherever the file is
+    fingerprint = snpseq_data_fingerprint(lims_json)
+    assert snpseq_data_fingerprint(other) == fingerprint
+
+    with open(other, "a") as fh:
+        fh.write("\n")
+    assert snpseq_data_fingerprint(other) != fingerprint
+
+
+async def test_snpseq_data_extract_cache(tmp_path):
+    lims_json = pathlib.Path("tests", "test_data", "XYZ321XY.lims.json").absolute()
+
+    async def _extract(data_path, outdir):
+        outfile = os.path.join(outdir, "XYZ321XY.lims.ngi.json")
+        shutil.copy(os.path.join("tests", "test_data", "XYZ321XY.lims.ngi.json"), outfile)
+        return outfile
+
+    process_runner = mock.Mock(
+        extract_snpseq_data_metadata=mock.AsyncMock(side_effect=_extract))
+    handler = ExportHandler(
+        process_runner,
+        extract_cache=ExtractCache(str(tmp_path / "cache")),
+        workspace=Workspace(root=str(tmp_path / "scratch")))
+
+    extracts = []
+    for refresh in (False, False, True):
+        async with handler.workspace.directory() as outdir:
+            extract = await handler.snpseq_data_extract(
+                None, None, None, None, outdir, lims_json=lims_json, refresh=refresh)
+            assert os.path.exists(os.path.join(outdir, lims_json.name))
+            extracts.append(pathlib.Path(extract).read_text())
+
+    # the second export re-uses the cached extract, the refresh runs the extraction again
+    assert process_runner.extract_snpseq_data_metadata.await_count == 2
+    assert extracts[0] == extracts[1] == extracts[2]
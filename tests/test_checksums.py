@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import pathlib
+import pytest
+import shutil
+import threading
+
+from metadata_service.checksums import ChecksumRunInProgress, ChecksumRunner, md5_file
+from metadata_service.inventory import InventoryIndex, parse_checksums
+
+from tests.test_app import test_runfolder
+
+
+@pytest.fixture
+def runfolder_path(tmp_path, test_runfolder):
+    runfolder_path = tmp_path / test_runfolder
+    shutil.copytree(
+        pathlib.Path("tests", "test_data", "runfolders", test_runfolder),
+        runfolder_path)
+    return runfolder_path
+
+
+def test_md5_file(tmp_path):
+    path = tmp_path / "data"
+    data = os.urandom(100000)
+    path.write_bytes(data)
+    assert md5_file(path, buffer_size=4096) == hashlib.md5(data).hexdigest()
+
+
+async def test_verify(runfolder_path):
+    runner = ChecksumRunner(InventoryIndex(), workers=2)
+    events = []
+    result = await runner.run(runfolder_path, "verify", progress=events.append)
+    assert result["ok"]
+    assert result["verified"] == result["hashed"] == 24
+    assert events[-1] == {
+        "event": "progress",
+        "hashed": 24,
+        "total": 24,
+        "bytes": events[-1]["total_bytes"],
+        "total_bytes": events[-1]["total_bytes"]}
+
+    # files that have not changed since the last run are not hashed again
+    result = await runner.run(runfolder_path, "verify")
+    assert result["ok"]
+    assert (result["hashed"], result["unchanged"]) == (0, 24)
+
+    # a modified file is hashed again and reported
+    fastq = sorted((runfolder_path / "Unaligned").rglob("*.fastq.gz"))[0]
+    with open(fastq, "ab") as fh:
+        fh.write(b"\0")
+    result = await runner.run(runfolder_path, "verify")
+    assert not result["ok"]
+    assert result["hashed"] == 1
+    assert result["mismatched"] == [str(fastq.relative_to(runfolder_path))]
+
+
+async def test_generate(runfolder_path):
+    checksum_file = runfolder_path / "MD5" / "checksums.md5"
+    expected = parse_checksums(checksum_file, runfolder_path.name)
+
+    # drop some of the entries and let them be generated again
+    lines = checksum_file.read_text().splitlines(keepends=True)
+    checksum_file.write_text("".join(lines[4:]))
+    runner = ChecksumRunner(InventoryIndex())
+    result = await runner.run(runfolder_path, "generate")
+    assert len(result["generated"]) == result["hashed"] == 4
+    assert parse_checksums(checksum_file, runfolder_path.name) == expected
+
+    # the state is kept next to the checksum file
+    state = json.loads((runfolder_path / "MD5" / "checksums.state.json").read_text())
+    assert sorted(state) == result["generated"]
+
+    result = await runner.run(runfolder_path, "generate")
+    assert result["generated"] == []
+    assert not [name for name in os.listdir(runfolder_path / "MD5") if name.endswith(".tmp")]
+
+
+async def test_generate_keeps_listed_paths(runfolder_path):
+    # entries listed relative to the runfolder, in binary mode, are left as they are and new
+    # entries are listed the same way
+    checksum_file = runfolder_path / "MD5" / "checksums.md5"
+    lines = [
+        line.replace(f" {runfolder_path.name}/", " *", 1)
+        for line in checksum_file.read_text().splitlines(keepends=True)]
+    checksum_file.write_text("".join(lines[1:]))
+    result = await ChecksumRunner(InventoryIndex()).run(runfolder_path, "generate")
+    assert len(result["generated"]) == 1
+    assert sorted(checksum_file.read_text().splitlines(keepends=True)) == sorted(
+        lines[1:] + [lines[0].replace(" *", "  ", 1)])
+
+
+async def test_run_lock(runfolder_path):
+    # a run in another process holds the lock on the checksum files
+    runner = ChecksumRunner(InventoryIndex())
+    lock_fd = runner.acquire_lock(runfolder_path)
+    try:
+        with pytest.raises(ChecksumRunInProgress):
+            await ChecksumRunner(InventoryIndex()).run(runfolder_path, "verify")
+    finally:
+        os.close(lock_fd)
+    assert (await runner.run(runfolder_path, "verify"))["ok"]
+
+
+async def test_invalid_mode(runfolder_path):
+    with pytest.raises(ValueError):
+        await ChecksumRunner(InventoryIndex()).run(runfolder_path, "rehash")
+
+
+async def test_checksum_context(runfolder_path):
+    runner = ChecksumRunner(InventoryIndex(), workers=1)
+    context = runner.checksum_context(None)
+    await context.__anext__()
+
+    # a file that is being hashed is left to finish, the files waiting for a thread are dropped
+    started, release = threading.Event(), threading.Event()
+    running = runner.executor.submit(lambda: started.set() or release.wait(timeout=5))
+    waiting = runner.executor.submit(md5_file, runfolder_path / "fc_SampleSheet.csv")
+    runner.pending.update((running, waiting))
+    assert started.wait(timeout=5)
+    with pytest.raises(StopAsyncIteration):
+        await context.__anext__()
+    assert waiting.cancelled()
+    assert runner._executor is None
+    release.set()
+    assert running.result(timeout=5)
@@ -1,12 +1,14 @@
 
 import aiohttp
+import aiohttp.web
+import asyncio
 import json
 import mock
 import os
 import pytest
 import tempfile
 
-from metadata_service.clients import SnpseqDataRequest
+from metadata_service.clients import CircuitBreaker, CircuitOpenError, SnpseqDataRequest
 
 from tests.test_app import \
     snpseq_data_server, \
@@ -62,3 +64,195 @@ async def test_snpseq_data_client(
             await rq.request_snpseq_data_metadata(test_runfolder, outdir)
 
     await rq.session.close()
+
+
+@pytest.fixture
+async def etag_server(aiohttp_server, test_snpseq_data_json):
+    """
+    A snpseq-data test server that supports conditional requests and counts the requests made
+    """
+    requests = []
+
+    async def snpseq_data(request):
+        requests.append(request.headers.get("If-None-Match"))
+        await asyncio.sleep(0.1)
+        if request.headers.get("If-None-Match") == '"v1"':
+            return aiohttp.web.Response(status=304)
+        return aiohttp.web.json_response(
+            data=test_snpseq_data_json,
+            headers={"ETag": '"v1"'})
+
+    app = aiohttp.web.Application()
+    app.add_routes([
+        aiohttp.web.get("/api/containers", snpseq_data)])
+    server = await aiohttp_server(app)
+    server.requests = requests
+    yield server
+
+
+async def test_snpseq_data_client_cache(
+        etag_server,
+        test_runfolder,
+        test_snpseq_data_json):
+    rq = SnpseqDataRequest(
+        external_url=f"http://{etag_server.host}:{etag_server.port}",
+        cache_ttl=60
+    )
+    rq.session = aiohttp.ClientSession(rq.external_url)
+
+    with tempfile.TemporaryDirectory(prefix="test_snpseq_data_client_cache") as outdir:
+        # concurrent requests for the same flowcell are coalesced into one
+        jsonfiles = await asyncio.gather(*[
+            rq.request_snpseq_data_metadata(test_runfolder, os.path.join(outdir, str(i)))
+            for i in range(5)])
+        assert len(etag_server.requests) == 1
+        for jsonfile in jsonfiles:
+            with open(jsonfile) as fh:
+                assert json.load(fh) == test_snpseq_data_json
+
+        # a fresh cache entry is used without a request
+        await rq.request_snpseq_data_metadata(test_runfolder, outdir)
+        assert len(etag_server.requests) == 1
+
+        # a stale cache entry is revalidated
+        rq.cache_ttl = 0
+        jsonfile = await rq.request_snpseq_data_metadata(test_runfolder, outdir)
+        assert etag_server.requests == [None, '"v1"']
+        with open(jsonfile) as fh:
+            assert json.load(fh) == test_snpseq_data_json
+
+    await rq.session.close()
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(threshold=2, reset_timeout=60)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+    # after the reset timeout, a single trial request is allowed
+    breaker.opened -= 61
+    assert breaker.state == "half-open"
+    assert breaker.allow()
+    assert not breaker.allow()
+
+    # a failed trial opens the circuit again
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+    breaker.opened -= 61
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow()
+
+
+@pytest.fixture
+async def flaky_server(aiohttp_server, test_snpseq_data_json):
+    """
+    A snpseq-data test server that responds with a 503 status to every request until it is told
+    to recover
+    """
+    state = {"requests": 0, "healthy": False}
+
+    async def snpseq_data(request):
+        state["requests"] += 1
+        if not state["healthy"]:
+            return aiohttp.web.Response(status=503)
+        return aiohttp.web.json_response(data=test_snpseq_data_json)
+
+    app = aiohttp.web.Application()
+    app.add_routes([
+        aiohttp.web.get("/api/containers", snpseq_data)])
+    server = await aiohttp_server(app)
+    server.state = state
+    yield server
+
+
+async def test_snpseq_data_client_retries(
+        flaky_server,
+        test_runfolder,
+        test_snpseq_data_json):
+    rq = SnpseqDataRequest(
+        external_url=f"http://{flaky_server.host}:{flaky_server.port}",
+        client_config={
+            "retries": 2,
+            "retry_backoff": 0.01,
+            "circuit_breaker_threshold": 4,
+            "circuit_breaker_reset": 60
+        }
+    )
+    session_ctx = rq.external_session(app=None)
+    await session_ctx.__anext__()
+
+    with tempfile.TemporaryDirectory(prefix="test_snpseq_data_client_retries") as outdir:
+        # the request is retried before giving up
+        with pytest.raises(Exception, match="503"):
+            await rq.request_snpseq_data_metadata(test_runfolder, outdir)
+        assert flaky_server.state["requests"] == 3
+
+        # the circuit opens after the threshold has been reached and requests fail fast
+        with pytest.raises(CircuitOpenError):
+            await rq.request_snpseq_data_metadata(test_runfolder, outdir)
+        assert flaky_server.state["requests"] == 4
+        with pytest.raises(CircuitOpenError):
+            await rq.request_snpseq_data_metadata(test_runfolder, outdir)
+        assert flaky_server.state["requests"] == 4
+
+        # once the upstream has recovered and the circuit is reset, requests go through
+        flaky_server.state["healthy"] = True
+        rq.circuit_breaker.opened -= 61
+        jsonfile = await rq.request_snpseq_data_metadata(test_runfolder, outdir)
+        with open(jsonfile) as fh:
+            assert json.load(fh) == test_snpseq_data_json
+        assert rq.circuit_breaker.state == "closed"
+
+    with pytest.raises(StopAsyncIteration):
+        await session_ctx.__anext__()
+
+
+async def test_snpseq_data_client_stream(
+        snpseq_data_server,
+        test_runfolder,
+        test_snpseq_data_json):
+    rq = SnpseqDataRequest(
+        external_url=f"http://{snpseq_data_server.host}:{snpseq_data_server.port}",
+        cache_ttl=60,
+        stream=True
+    )
+    rq.session = aiohttp.ClientSession(rq.external_url)
+    flowcell_id = rq.flowcellid_from_runfolder(test_runfolder)
+    request_urls = (
+        ('/api/containers', {'name': flowcell_id, 'content_type': 'text/html'}),
+        ('/api/containers', {'name': flowcell_id, 'status': 500}),
+        ('/api/containers', {'name': flowcell_id, 'content_type': 'text/html', 'truncate': 100})
+    )
+
+    with mock.patch.object(rq, "data_request_url", side_effect=request_urls), \
+            tempfile.TemporaryDirectory(prefix="test_snpseq_data_client_stream") as outdir:
+        observed_jsonfile = await rq.request_snpseq_data_metadata(test_runfolder, outdir)
+        with open(observed_jsonfile, "r") as fh:
+            assert json.load(fh) == test_snpseq_data_json
+
+        # the response is kept in a spool file rather than in memory
+        entry = rq.cache[flowcell_id]
+        assert entry.body is None
+        assert os.path.exists(entry.path)
+        spoolfile = entry.path
+
+        # error responses are still detected
+        rq.cache.clear()
+        with pytest.raises(expected_exception=Exception, match="500"):
+            await rq.request_snpseq_data_metadata(test_runfolder, outdir)
+
+        # as are truncated responses, which are not cached
+        with pytest.raises(expected_exception=Exception, match="was cut short"):
+            await rq.request_snpseq_data_metadata(test_runfolder, outdir)
+        assert flowcell_id not in rq.cache
+
+    await rq.close()
+    assert not os.path.exists(spoolfile)
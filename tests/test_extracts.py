@@ -0,0 +1,47 @@
+import json
+import pathlib
+
+from metadata_service.extracts import extract_projects, filter_extract, split_extract
+
+
+RUNFOLDER_EXTRACT = pathlib.Path("tests", "test_data", "210415_A00001_0123_BXYZ321XY.ngi.json")
+SNPSEQ_DATA_EXTRACT = pathlib.Path("tests", "test_data", "XYZ321XY.lims.ngi.json")
+
+
+def test_extract_projects():
+    assert extract_projects(RUNFOLDER_EXTRACT) == ["AB-1234", "CD-5678"]
+    assert extract_projects(SNPSEQ_DATA_EXTRACT) == ["AB-1234", "CD-5678", "EF-9012"]
+
+
+def test_filter_extract(tmp_path):
+    for extract, key in (
+            (RUNFOLDER_EXTRACT, "sequencing_runs"),
+            (SNPSEQ_DATA_EXTRACT, "experiments")):
+        filtered = filter_extract(extract, ["CD-5678"], str(tmp_path))
+        assert filtered == str(tmp_path / extract.name)
+        assert extract_projects(filtered) == ["CD-5678"]
+
+        # everything but the entries of the other projects is kept
+        original = json.loads(extract.read_text())
+        pruned = json.loads(pathlib.Path(filtered).read_text())
+        assert {k: v for k, v in pruned.items() if k != key} == \
+            {k: v for k, v in original.items() if k != key}
+        assert 0 < len(pruned[key]) < len(original[key])
+
+
+def test_split_extract(tmp_path):
+    projects = ["AB-1234", "CD-5678", "EF-9012"]
+    for extract, key in (
+            (RUNFOLDER_EXTRACT, "sequencing_runs"),
+            (SNPSEQ_DATA_EXTRACT, "experiments")):
+        shards = split_extract(extract, projects, str(tmp_path))
+        assert shards == {
+            project: str(tmp_path / project / extract.name) for project in projects}
+
+        # every entry ends up in the shard of its project
+        original = json.loads(extract.read_text())
+        entries = 0
+        for project, shard in shards.items():
+            assert extract_projects(shard) in ([project], [])
+            entries += len(json.loads(pathlib.Path(shard).read_text())[key])
+        assert entries == len(original[key])
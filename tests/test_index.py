@@ -0,0 +1,73 @@
+import time
+
+from metadata_service.index import ExportIndex
+
+
+def _record(index, runfolder, finished, **kwargs):
+    entry = {
+        "host": "host1",
+        "runfolder": runfolder,
+        "flowcell_id": runfolder.split("_")[-1][1:],
+        "status": "done",
+        "started": finished - 10,
+        "finished": finished,
+        "projects": ["AB-1234"],
+        "outputs": [f"/data/{runfolder}/metadata/AB-1234-run.xml"],
+        "stages": {"export": 1.5}
+    }
+    entry.update(kwargs)
+    return index.record(**entry)
+
+
+def test_export_index(tmp_path):
+    index = ExportIndex(str(tmp_path / "db" / "exports.sqlite"))
+    now = time.time()
+    _record(index, "210415_A00001_0123_BXYZ321XY", now - 100)
+    latest_id = _record(index, "210415_A00001_0123_BXYZ321XY", now - 50, skipped=True)
+    _record(
+        index,
+        "210415_A00001_0123_BXYZ321XY",
+        now - 10,
+        status="failed",
+        exception="export failed",
+        outputs=None)
+    _record(
+        index,
+        "210416_A00001_0124_BABC123XY",
+        now - 5,
+        host="host2",
+        projects=["CD-5678", "EF-9012"])
+
+    latest = index.latest("host1", "210415_A00001_0123_BXYZ321XY")
+    assert latest["status"] == "failed"
+    assert latest["exception"] == "export failed"
+
+    latest = index.latest("host1", "210415_A00001_0123_BXYZ321XY", status="done")
+    assert latest["export_id"] == latest_id
+    assert latest["skipped"]
+    assert latest["flowcell_id"] == "XYZ321XY"
+    assert latest["projects"] == ["AB-1234"]
+    assert latest["stages"] == {"export": 1.5}
+    assert latest["metadata"] == ["/data/210415_A00001_0123_BXYZ321XY/metadata/AB-1234-run.xml"]
+    assert index.latest("host2", "210415_A00001_0123_BXYZ321XY") is None
+
+    exports, total = index.list()
+    assert total == 4
+    assert [export["finished"] for export in exports] == sorted(
+        [export["finished"] for export in exports], reverse=True)
+
+    exports, total = index.list(project="EF-9012")
+    assert total == 1
+    assert exports[0]["projects"] == ["CD-5678", "EF-9012"]
+
+    exports, total = index.list(host="host1", since=now - 60, limit=1)
+    assert total == 2
+    assert exports[0]["status"] == "failed"
+    exports, _ = index.list(host="host1", since=now - 60, limit=1, offset=1)
+    assert exports[0]["export_id"] == latest_id
+
+    assert index.list(until=now - 60)[1] == 1
+    index.close()
+
+    # the index is persistent
+    assert ExportIndex(index.path).list()[1] == 4
@@ -0,0 +1,106 @@
+import mock
+import os
+import pathlib
+import shutil
+
+from metadata_service.cache import runfolder_fingerprint
+from metadata_service.inventory import InventoryIndex, RunfolderInventory, parse_checksums
+
+from tests.test_app import test_runfolder
+
+
+def copy_runfolder(tmp_path, test_runfolder):
+    runfolder_path = tmp_path / test_runfolder
+    shutil.copytree(
+        pathlib.Path("tests", "test_data", "runfolders", test_runfolder),
+        runfolder_path)
+    return runfolder_path
+
+
+def test_inventory(tmp_path, test_runfolder):
+    runfolder_path = copy_runfolder(tmp_path, test_runfolder)
+    inventory = InventoryIndex().get(runfolder_path)
+    files = {f["path"]: f for f in inventory.files()}
+    assert len(files) == 24
+    assert inventory.to_dict()["projects"] == ["AB-1234", "CD-5678"]
+
+    # both the <project>/Sample_<sample> and the Project_<project>/<sample> layouts are parsed
+    for path, project, sample, lane, read in (
+            ("Unaligned/AB-1234/Sample_AB-1234-SampleA-1/AB-1234-SampleA-1_S1_L002_R1_001.fastq.gz",
+             "AB-1234", "AB-1234-SampleA-1", 2, "R1"),
+            ("Unaligned/Project_CD-5678/CD-5678-SampleB/CD-5678-SampleB_S6_L003_R2_001.fastq.gz",
+             "CD-5678", "CD-5678-SampleB", 3, "R2")):
+        entry = files[os.path.join(*path.split("/"))]
+        assert (entry["project"], entry["sample"], entry["lane"], entry["read"]) == \
+            (project, sample, lane, read)
+
+    # the checksums are keyed on the path relative to the runfolder
+    assert set(inventory.checksums) == set(files)
+
+    # the fingerprint is the same as from walking the runfolder
+    index = InventoryIndex()
+    assert runfolder_fingerprint(runfolder_path, index) == runfolder_fingerprint(runfolder_path)
+
+    # also after a file has been modified in place, without its directory changing
+    fastq = os.path.join(runfolder_path, next(
+        path for path in sorted(files) if path.endswith(".fastq.gz")))
+    dir_stat = os.stat(os.path.dirname(fastq))
+    with open(fastq, "ab") as fh:
+        fh.write(b"\0")
+    os.utime(os.path.dirname(fastq), ns=(dir_stat.st_atime_ns, dir_stat.st_mtime_ns))
+    assert runfolder_fingerprint(runfolder_path, index) == runfolder_fingerprint(runfolder_path)
+
+
+def test_inventory_refresh(tmp_path, test_runfolder):
+    runfolder_path = copy_runfolder(tmp_path, test_runfolder)
+    index = InventoryIndex()
+    with mock.patch.object(RunfolderInventory, "racy_window", 0):
+        inventory = index.get(runfolder_path)
+        directories = inventory.scans
+        assert directories == len(inventory.directories)
+
+        # unchanged directories are not listed again
+        assert index.get(runfolder_path).scans == directories
+
+        # only the directory with a new file is listed again
+        fastq = next((runfolder_path / "Unaligned").rglob("*.fastq.gz"))
+        shutil.copy(fastq, fastq.parent / "Extra_S9_L001_R1_001.fastq.gz")
+        inventory = index.get(runfolder_path)
+        assert inventory.scans == directories + 1
+        assert len(inventory.files()) == 25
+
+        # the checksums are parsed again when the checksum file changes
+        with open(runfolder_path / "MD5" / "checksums.md5", "a") as fh:
+            fh.write(f"0123456789abcdef  {test_runfolder}/Unaligned/extra.fastq.gz\n")
+        inventory = index.get(runfolder_path)
+        assert inventory.checksums[os.path.join("Unaligned", "extra.fastq.gz")] == \
+            "0123456789abcdef"
+
+
+def test_inventory_racy(tmp_path, test_runfolder):
+    # directories modified just before they were listed are listed again
+    runfolder_path = copy_runfolder(tmp_path, test_runfolder)
+    (runfolder_path / "Unaligned" / "new").mkdir()
+    index = InventoryIndex()
+    directories = index.get(runfolder_path).scans
+    assert index.get(runfolder_path).scans > directories
+
+
+def test_inventory_eviction(tmp_path, test_runfolder):
+    index = InventoryIndex(max_entries=1)
+    first = copy_runfolder(tmp_path / "first", test_runfolder)
+    second = copy_runfolder(tmp_path / "second", test_runfolder)
+    index.get(first)
+    index.get(second)
+    assert list(index.inventories) == [str(second)]
+
+
+def test_parse_checksums(tmp_path):
+    checksums = tmp_path / "checksums.md5"
+    checksums.write_text(
+        "0123456789abcdef  runfolder/Unaligned/a.fastq.gz\n"
+        "fedcba9876543210 *Unaligned/b.fastq.gz\n"
+        "\n")
+    assert parse_checksums(checksums, "runfolder") == {
+        os.path.join("Unaligned", "a.fastq.gz"): "0123456789abcdef",
+        os.path.join("Unaligned", "b.fastq.gz"): "fedcba9876543210"}
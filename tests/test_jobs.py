@@ -0,0 +1,96 @@
+import asyncio
+import pytest
+import time
+
+from metadata_service.jobs import ExportScheduler, SchedulerClosedError
+
+
+async def _wait_for(job):
+    await asyncio.gather(job.task, return_exceptions=True)
+
+
+async def test_scheduler_deduplicates_active_jobs():
+    scheduler = ExportScheduler()
+    calls = []
+
+    async def _export(host, runfolder, lims_data):
+        calls.append(runfolder)
+        await asyncio.sleep(0.1)
+        return [runfolder]
+
+    job1 = scheduler.submit(_export, "host", "runfolder")
+    job2 = scheduler.submit(_export, "host", "runfolder")
+    assert job1 is job2
+    await _wait_for(job1)
+    assert job1.status == "done"
+    assert job1.to_dict()["metadata"] == ["runfolder"]
+    assert calls == ["runfolder"]
+
+    # a finished job is not re-used
+    job3 = scheduler.submit(_export, "host", "runfolder")
+    assert job3 is not job1
+    await _wait_for(job3)
+    assert calls == ["runfolder", "runfolder"]
+
+
+async def test_scheduler_limits():
+    scheduler = ExportScheduler(max_exports=3, max_exports_per_host=1)
+    running = {"total": 0, "max": 0, "host1": 0, "host1_max": 0}
+
+    async def _export(host, runfolder, lims_data):
+        running["total"] += 1
+        running["max"] = max(running["max"], running["total"])
+        if host == "host1":
+            running["host1"] += 1
+            running["host1_max"] = max(running["host1_max"], running["host1"])
+        await asyncio.sleep(0.05)
+        running["total"] -= 1
+        if host == "host1":
+            running["host1"] -= 1
+
+    jobs = [
+        scheduler.submit(_export, f"host{i % 4}", f"runfolder{i}")
+        for i in range(12)]
+    await asyncio.gather(*[job.task for job in jobs])
+    assert all(job.status == "done" for job in jobs)
+    assert running["max"] == 3
+    assert running["host1_max"] == 1
+
+
+async def test_scheduler_failure_and_retention():
+    scheduler = ExportScheduler(retention=60)
+
+    async def _export(host, runfolder, lims_data):
+        raise Exception("export failed")
+
+    job = scheduler.submit(_export, "host", "runfolder")
+    await _wait_for(job)
+    assert job.status == "failed"
+    assert job.to_dict()["exception"] == "export failed"
+    assert scheduler.get(job.job_id) is job
+
+    job.finished = time.time() - 61
+    assert scheduler.get(job.job_id) is None
+
+
+async def test_scheduler_drain():
+    scheduler = ExportScheduler(drain_timeout=0.2)
+
+    async def _export(host, runfolder, lims_data):
+        await asyncio.sleep(0.05 if runfolder == "quick" else 10)
+        return [runfolder]
+
+    quick = scheduler.submit(_export, "host", "quick")
+    slow = scheduler.submit(_export, "host", "slow")
+    await scheduler.drain()
+    assert quick.status == "done"
+    assert slow.status == "running"
+    with pytest.raises(SchedulerClosedError):
+        scheduler.submit(_export, "host", "another")
+
+    # the jobs still running after the drain timeout are cancelled at cleanup
+    context = scheduler.scheduler_context(app=None)
+    await context.__anext__()
+    with pytest.raises(StopAsyncIteration):
+        await context.__anext__()
+    assert slow.status == "failed"
@@ -0,0 +1,40 @@
+import os
+
+from metadata_service.manifest import ExportManifest, file_digest
+
+
+def test_export_manifest(tmp_path):
+    extracts = []
+    for name in ("runfolder.ngi.json", "lims.ngi.json"):
+        extracts.append(tmp_path / name)
+        extracts[-1].write_text(name)
+
+    metadatadir = tmp_path / "metadata"
+    metadatadir.mkdir()
+    outputs = []
+    for name in ("AB-1234-run.xml", "AB-1234.metadata.ena.tsv"):
+        outputs.append(str(metadatadir / name))
+        with open(outputs[-1], "w") as fh:
+            fh.write(name)
+
+    manifest = ExportManifest(str(metadatadir))
+    inputs = manifest.input_digests(*extracts)
+    assert inputs["runfolder_extract"] == file_digest(extracts[0])
+    assert manifest.up_to_date(inputs) is None
+
+    manifest.write(inputs, outputs)
+    assert os.path.exists(os.path.join(metadatadir, ExportManifest.filename))
+    assert sorted(manifest.up_to_date(inputs)) == sorted(outputs)
+
+    # changed inputs
+    extracts[1].write_text("modified")
+    assert manifest.up_to_date(manifest.input_digests(*extracts)) is None
+
+    # changed or missing outputs
+    with open(outputs[0], "a") as fh:
+        fh.write("modified")
+    assert manifest.up_to_date(inputs) is None
+    manifest.write(inputs, outputs)
+    assert manifest.up_to_date(inputs) is not None
+    os.unlink(outputs[1])
+    assert manifest.up_to_date(inputs) is None
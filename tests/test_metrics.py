@@ -0,0 +1,57 @@
+import pytest
+
+from metadata_service.metrics import Counter, Gauge, Histogram, Registry, track_stage
+
+
+def test_render():
+    registry = Registry()
+    counter = Counter(
+        "test_requests_total",
+        "Number of requests",
+        labelnames=("outcome",),
+        registry=registry)
+    gauge = Gauge("test_in_progress", "In progress", registry=registry)
+    histogram = Histogram(
+        "test_duration_seconds",
+        "Duration",
+        registry=registry,
+        buckets=(1.0, 5.0))
+
+    counter.labels(outcome='a "quoted" value').inc()
+    counter.labels(outcome="success").inc(2)
+    gauge.set(3)
+    with gauge.track_inprogress():
+        assert gauge.labels().value == 4
+    for value in (0.5, 2.0, 10.0):
+        histogram.observe(value)
+
+    lines = registry.render().splitlines()
+    assert "# TYPE test_requests_total counter" in lines
+    assert 'test_requests_total{outcome="a \\"quoted\\" value"} 1.0' in lines
+    assert 'test_requests_total{outcome="success"} 2.0' in lines
+    assert "# TYPE test_in_progress gauge" in lines
+    assert "test_in_progress 3" in lines
+    assert "# TYPE test_duration_seconds histogram" in lines
+    assert 'test_duration_seconds_bucket{le="1.0"} 1' in lines
+    assert 'test_duration_seconds_bucket{le="5.0"} 2' in lines
+    assert 'test_duration_seconds_bucket{le="+Inf"} 3' in lines
+    assert "test_duration_seconds_sum 12.5" in lines
+    assert "test_duration_seconds_count 3" in lines
+
+
+def test_track_stage():
+    from metadata_service.metrics import STAGE_DURATION, STAGE_RESULTS
+
+    success = STAGE_RESULTS.labels(stage="test_stage", outcome="success").value
+    failure = STAGE_RESULTS.labels(stage="test_stage", outcome="failure").value
+    count = STAGE_DURATION.labels(stage="test_stage").count
+
+    with track_stage("test_stage"):
+        pass
+    with pytest.raises(ValueError):
+        with track_stage("test_stage"):
+            raise ValueError()
+
+    assert STAGE_RESULTS.labels(stage="test_stage", outcome="success").value == success + 1
+    assert STAGE_RESULTS.labels(stage="test_stage", outcome="failure").value == failure + 1
+    assert STAGE_DURATION.labels(stage="test_stage").count == count + 2
@@ -0,0 +1,114 @@
+import asyncio
+import mock
+import pytest
+import sys
+import time
+
+from metadata_service import process
+from metadata_service.process import MetadataLibraryRunner, ProcessRunner
+
+
+async def test_run_process():
+    runner = ProcessRunner()
+    proc = await runner.run_process("echo 'hello world'")
+    assert proc.returncode == 0
+    assert proc.stdout == "hello world\n"
+
+
+async def test_run_process_error():
+    runner = ProcessRunner()
+    with pytest.raises(Exception, match="some output"):
+        await runner.run_process("sh -c 'echo some output; echo some error 1>&2; exit 3'")
+
+
+async def test_run_process_does_not_block():
+    runner = ProcessRunner()
+    ticks = []
+
+    async def _tick():
+        for _ in range(5):
+            ticks.append(time.monotonic())
+            await asyncio.sleep(0.05)
+
+    await asyncio.gather(
+        runner.run_process("sleep 0.5"),
+        _tick())
+    assert len(ticks) == 5
+    assert ticks[-1] - ticks[0] < 0.5
+
+
+async def test_run_process_max_processes():
+    runner = ProcessRunner(max_processes=1)
+    start = time.monotonic()
+    await asyncio.gather(
+        runner.run_process("sleep 0.3"),
+        runner.run_process("sleep 0.3"))
+    assert time.monotonic() - start >= 0.6
+
+    runner = ProcessRunner(max_processes=2)
+    start = time.monotonic()
+    await asyncio.gather(
+        runner.run_process("sleep 0.3"),
+        runner.run_process("sleep 0.3"))
+    assert time.monotonic() - start < 0.6
+
+
+def test_run_entry_point():
+    def _main():
+        print(" ".join(sys.argv[1:]))
+        print("an error", file=sys.stderr)
+        sys.exit(2)
+
+    with mock.patch.object(process, "_load_entry_point", return_value=_main) as load, \
+            mock.patch.dict(process._ENTRY_POINTS, clear=True):
+        returncode, stdout, stderr = process._run_entry_point("snpseq_metadata", ["a", "b"])
+        assert returncode == 2
+        assert stdout == "a b\n"
+        assert stderr == "an error\n"
+
+        # the entry point is only loaded once per process
+        process._run_entry_point("snpseq_metadata", ["c"])
+        load.assert_called_once_with("snpseq_metadata")
+
+
+def test_run_click_entry_point():
+    # a click command in standalone mode exits with the exit code of the command
+    command = mock.Mock()
+    command.main.side_effect = SystemExit(3)
+    with mock.patch.object(process, "_load_entry_point", return_value=command), \
+            mock.patch.dict(process._ENTRY_POINTS, clear=True):
+        returncode, _, _ = process._run_entry_point("snpseq_metadata", ["extract"])
+        assert returncode == 3
+        command.main.assert_called_once_with(
+            args=["extract"], prog_name="snpseq_metadata", standalone_mode=True)
+
+        command.main.side_effect = None
+        command.main.return_value = 4
+        returncode, _, _ = process._run_entry_point("snpseq_metadata", ["extract"])
+        assert returncode == 4
+
+
+async def test_library_runner_pool():
+    # run a console script of this package as a library in the worker pool
+    runner = MetadataLibraryRunner(metadata_executable="metadata-service", max_processes=1)
+    context = runner.process_context(app=None)
+    await context.__anext__()
+    try:
+        assert runner.pool is not None
+        proc = await runner.run_process("metadata-service --help")
+        assert proc.returncode == 0
+        assert "--configroot" in proc.stdout
+    finally:
+        with pytest.raises(StopAsyncIteration):
+            await context.__anext__()
+
+
+async def test_library_runner_fallback():
+    runner = MetadataLibraryRunner(metadata_executable="echo", max_processes=2)
+    context = runner.process_context(app=None)
+    await context.__anext__()
+    assert runner.pool is None
+    proc = await runner.run_process("echo fallback")
+    assert proc.stdout == "fallback\n"
+    with pytest.raises(StopAsyncIteration):
+        await context.__anext__()
@@ -0,0 +1,58 @@
+import asyncio
+import json
+import logging
+
+from metadata_service.metrics import track_stage
+from metadata_service.process import ProcessRunner
+from metadata_service.tracing import REQUEST_ID, REQUEST_ID_ENV, RequestIdFilter, span
+
+
+def test_spans(caplog):
+    token = REQUEST_ID.set("abc123")
+    try:
+        with caplog.at_level(logging.INFO, logger="metadata_service.trace"):
+            with track_stage("total"):
+                with span("lims_fetch", flowcell="XYZ321XY"):
+                    pass
+    finally:
+        REQUEST_ID.reset(token)
+
+    records = [
+        json.loads(record.getMessage()) for record in caplog.records
+        if record.name == "metadata_service.trace"]
+    inner, outer = records
+    assert inner["span"] == "lims_fetch"
+    assert inner["flowcell"] == "XYZ321XY"
+    assert outer["span"] == "total"
+    assert inner["parent_id"] == outer["span_id"]
+    assert outer["parent_id"] is None
+    assert inner["request_id"] == outer["request_id"] == "abc123"
+    assert outer["outcome"] == "success"
+    assert outer["duration"] >= inner["duration"]
+
+
+def test_request_id_filter():
+    record = logging.LogRecord("test", logging.INFO, __file__, 1, "message", None, None)
+    RequestIdFilter().filter(record)
+    assert record.request_id == "-"
+
+    token = REQUEST_ID.set("abc123")
+    try:
+        RequestIdFilter().filter(record)
+        assert record.request_id == "abc123"
+    finally:
+        REQUEST_ID.reset(token)
+
+
+async def test_request_id_in_process_env():
+    runner = ProcessRunner()
+
+    async def _run(request_id):
+        REQUEST_ID.set(request_id)
+        proc = await runner.run_process(f"sh -c 'echo ${REQUEST_ID_ENV}'")
+        return proc.stdout.strip()
+
+    # each task has its own copy of the context
+    assert await asyncio.gather(
+        asyncio.ensure_future(_run("first")),
+        asyncio.ensure_future(_run("second"))) == ["first", "second"]
@@ -0,0 +1,30 @@
+import asyncio
+import pytest
+
+from metadata_service.utils import gather_or_cancel
+
+
+async def test_gather_or_cancel():
+    async def _value(value, delay):
+        await asyncio.sleep(delay)
+        return value
+
+    assert await gather_or_cancel(_value(1, 0.1), _value(2, 0.0)) == [1, 2]
+
+
+async def test_gather_or_cancel_failure():
+    cancelled = []
+
+    async def _slow():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def _fail():
+        raise ValueError("failed")
+
+    with pytest.raises(ValueError):
+        await gather_or_cancel(_slow(), _fail())
+    assert cancelled == [True]
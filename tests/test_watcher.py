@@ -0,0 +1,124 @@
+import asyncio
+import mock
+import os
+import pytest
+import shutil
+import time
+
+from metadata_service.cache import ExtractCache
+from metadata_service.watcher import RunfolderWatcher
+from metadata_service.workspace import Workspace
+
+
+TEST_RUNFOLDER = os.path.join(
+    os.path.dirname(__file__), "test_data", "runfolders", "210415_A00001_0123_BXYZ321XY")
+
+
+def _make_runfolder(datadir, host, runfolder, complete=True):
+    runfolder_path = os.path.join(datadir, host, "runfolders", runfolder)
+    shutil.copytree(TEST_RUNFOLDER, runfolder_path, ignore=shutil.ignore_patterns("metadata"))
+    for marker in RunfolderWatcher.completion_markers:
+        os.utime(os.path.join(runfolder_path, marker))
+    if not complete:
+        os.unlink(os.path.join(runfolder_path, "MD5", "checksums.md5"))
+    return runfolder_path
+
+
+def _watcher(tmp_path, **kwargs):
+    export_handler = mock.Mock(
+        extract_cache=ExtractCache(str(tmp_path / "cache")),
+        workspace=Workspace(root=str(tmp_path / "scratch")),
+        runfolder_extract=mock.AsyncMock(),
+        snpseq_data_extract=mock.AsyncMock())
+    session = mock.Mock(
+        cache_ttl=60,
+        snpseq_data=mock.AsyncMock(),
+        flowcellid_from_runfolder=lambda path: os.path.basename(path).split("_")[-1][1:])
+    return RunfolderWatcher(
+        str(tmp_path / "data" / "{host}" / "runfolders" / "{runfolder}"),
+        export_handler,
+        session,
+        **kwargs)
+
+
+def test_watcher_scan(tmp_path):
+    datadir = str(tmp_path / "data")
+    complete = _make_runfolder(datadir, "host1", "210415_A00001_0123_BXYZ321XY")
+    incomplete = _make_runfolder(
+        datadir, "host2", "210416_A00001_0124_BABC123XY", complete=False)
+    exported = _make_runfolder(datadir, "host2", "210417_A00001_0125_BDEF456XY")
+    os.makedirs(os.path.join(exported, "metadata"))
+    with open(os.path.join(exported, "metadata", ".export_manifest.json"), "w") as fh:
+        fh.write("{}")
+    old = _make_runfolder(datadir, "host2", "200101_A00001_0001_BOLD001XY")
+    past = time.time() - 7200
+    os.utime(os.path.join(old, "MD5", "checksums.md5"), (past, past))
+    os.utime(os.path.join(old, "Unaligned"), (past, past))
+
+    watcher = _watcher(tmp_path, max_age=3600)
+    assert watcher.parse(complete) == ("host1", "210415_A00001_0123_BXYZ321XY")
+    assert watcher.scan() == [("host1", "210415_A00001_0123_BXYZ321XY", complete)]
+
+    # a runfolder is only picked up again once it has changed or completed
+    assert watcher.scan() == []
+    shutil.copy(
+        os.path.join(complete, "MD5", "checksums.md5"),
+        os.path.join(incomplete, "MD5", "checksums.md5"))
+    assert watcher.scan() == [("host2", "210416_A00001_0124_BABC123XY", incomplete)]
+
+
+async def test_watcher_prewarm(tmp_path):
+    runfolder_path = _make_runfolder(
+        str(tmp_path / "data"), "host1", "210415_A00001_0123_BXYZ321XY")
+    watcher = _watcher(tmp_path, interval=0.05, lockfile=str(tmp_path / "scratch" / "watcher.lock"))
+
+    context = watcher.watcher_context(app=None)
+    await context.__anext__()
+
+    # only one watcher can hold the lock
+    other = _watcher(tmp_path, lockfile=watcher.lockfile)
+    assert not other.acquire_lock()
+
+    for _ in range(50):
+        if watcher.export_handler.snpseq_data_extract.await_count:
+            break
+        await asyncio.sleep(0.05)
+    with pytest.raises(StopAsyncIteration):
+        await context.__anext__()
+
+    watcher.export_handler.runfolder_extract.assert_awaited_once()
+    assert watcher.export_handler.runfolder_extract.await_args.args[0] == runfolder_path
+    # the snpseq-data extract is added to the extract cache rather than only fetching the LIMS data
+    watcher.export_handler.snpseq_data_extract.assert_awaited_once()
+    assert watcher.export_handler.snpseq_data_extract.await_args.args[0:2] == \
+        (watcher.session, runfolder_path)
+    watcher.session.snpseq_data.assert_not_awaited()
+    assert other.acquire_lock()
+    other.release_lock()
+
+
+async def test_watcher_prewarm_outdirs(tmp_path):
+    runfolder_path = _make_runfolder(
+        str(tmp_path / "data"), "host1", "210415_A00001_0123_BXYZ321XY")
+    watcher = _watcher(tmp_path)
+    outdirs = []
+    watcher.export_handler.runfolder_extract.side_effect = \
+        lambda runfolder_path, outdir: outdirs.append(os.path.isdir(outdir))
+    watcher.export_handler.snpseq_data_extract.side_effect = \
+        lambda *args: outdirs.append(os.path.isdir(args[-1]))
+
+    # the extracts are looked up in the cache with directories to copy them into
+    await watcher.prewarm(runfolder_path)
+    assert outdirs == [True, True]
+
+
+async def test_watcher_prewarm_without_extract_cache(tmp_path):
+    runfolder_path = _make_runfolder(
+        str(tmp_path / "data"), "host1", "210415_A00001_0123_BXYZ321XY")
+    watcher = _watcher(tmp_path)
+    watcher.export_handler.extract_cache = None
+
+    await watcher.prewarm(runfolder_path)
+    watcher.export_handler.runfolder_extract.assert_not_awaited()
+    watcher.export_handler.snpseq_data_extract.assert_not_awaited()
+    watcher.session.snpseq_data.assert_awaited_once_with("XYZ321XY")
@@ -0,0 +1,88 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+import urllib.request
+
+import pytest
+
+
+SERVER = textwrap.dedent("""
+    import asyncio
+    import os
+    import sys
+
+    import aiohttp.web
+
+    from metadata_service.workers import WorkerSupervisor
+
+
+    async def pid(request):
+        return aiohttp.web.Response(text=str(os.getpid()))
+
+
+    async def slow(request):
+        await asyncio.sleep(1)
+        return aiohttp.web.Response(text="done")
+
+
+    def app_factory():
+        app = aiohttp.web.Application()
+        app.router.add_get("/pid", pid)
+        app.router.add_get("/slow", slow)
+        return app
+
+
+    WorkerSupervisor(app_factory, port=int(sys.argv[1]), workers=2, shutdown_timeout=10).run()
+""")
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _get(url, timeout=10):
+    with urllib.request.urlopen(url, timeout=timeout) as resp:
+        return resp.read().decode()
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork")
+def test_worker_supervisor():
+    port = _free_port()
+    url = f"http://127.0.0.1:{port}"
+    proc = subprocess.Popen([sys.executable, "-c", SERVER, str(port)])
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                _get(f"{url}/pid", timeout=1)
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+
+        pids = {_get(f"{url}/pid") for _ in range(50)}
+        assert str(proc.pid) not in pids
+
+        # a request in flight when SIGTERM is received is allowed to finish
+        result = {}
+        request = threading.Thread(target=lambda: result.update(slow=_get(f"{url}/slow")))
+        request.start()
+        time.sleep(0.3)
+        proc.send_signal(signal.SIGTERM)
+        request.join()
+        assert result["slow"] == "done"
+        assert proc.wait(timeout=15) == 0
+        with pytest.raises(OSError):
+            _get(f"{url}/pid", timeout=1)
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
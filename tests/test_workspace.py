@@ -0,0 +1,138 @@
+import asyncio
+import errno
+import mock
+import os
+import pytest
+import tempfile
+
+from metadata_service.workspace import Workspace, link_or_copy, publish_file
+
+
+async def test_workspace_directory(tmp_path):
+    workspace = Workspace(root=str(tmp_path / "scratch"), max_idle=1)
+    async with workspace.directory() as outdir:
+        assert os.path.isdir(outdir)
+        assert os.listdir(outdir) == []
+        assert outdir in workspace.in_use
+        os.makedirs(os.path.join(outdir, "export"))
+        with open(os.path.join(outdir, "export", "AB-1234-run.xml"), "w") as fh:
+            fh.write("data")
+
+    # the released directory is emptied and re-used
+    assert workspace.idle == [outdir]
+    async with workspace.directory() as reused:
+        assert reused == outdir
+        assert os.listdir(reused) == []
+        async with workspace.directory() as other:
+            assert other != reused
+
+    # only max_idle directories are kept
+    assert workspace.idle == [other]
+    assert not os.path.exists(reused)
+
+    workspace.cleanup()
+    assert not os.path.exists(os.path.dirname(outdir))
+
+
+async def test_workspace_remove_stale(tmp_path):
+    root = tmp_path / "scratch"
+    stale = root / f"{Workspace.prefix}99999999"
+    stale.mkdir(parents=True)
+    workspace = Workspace(root=str(root))
+    active = workspace.procdir
+
+    context = workspace.workspace_context(app=None)
+    await context.__anext__()
+    assert not stale.exists()
+    assert os.path.exists(active)
+    with pytest.raises(StopAsyncIteration):
+        await context.__anext__()
+    assert not os.path.exists(active)
+
+
+async def test_workspace_max_size(tmp_path):
+    workspace = Workspace(root=str(tmp_path / "scratch"), max_size=10, wait_timeout=5)
+    events = []
+
+    async def _first():
+        async with workspace.directory() as outdir:
+            with open(os.path.join(outdir, "data"), "w") as fh:
+                fh.write("x" * 20)
+            events.append("first acquired")
+            await asyncio.sleep(0.2)
+            events.append("first released")
+
+    async def _second():
+        await asyncio.sleep(0.05)
+        async with workspace.directory():
+            events.append("second acquired")
+
+    await asyncio.gather(_first(), _second())
+    assert events == ["first acquired", "first released", "second acquired"]
+
+    workspace.wait_timeout = 0
+    async with workspace.directory() as outdir:
+        with open(os.path.join(outdir, "data"), "w") as fh:
+            fh.write("x" * 20)
+        with pytest.raises(Exception, match="scratch space"):
+            async with workspace.directory():
+                pass
+    workspace.cleanup()
+
+
+def test_publish_file(tmp_path):
+    destdir = tmp_path / "metadata"
+    destdir.mkdir()
+    (destdir / "AB-1234-run.xml").write_text("old")
+    src = tmp_path / "AB-1234-run.xml"
+    src.write_text("new")
+
+    dest = publish_file(str(src), str(destdir))
+    assert dest == str(destdir / "AB-1234-run.xml")
+    assert (destdir / "AB-1234-run.xml").read_text() == "new"
+    assert os.listdir(destdir) == ["AB-1234-run.xml"]
+
+
+@pytest.mark.skipif(
+    not os.path.isdir("/dev/shm") or
+    os.stat("/dev/shm").st_dev == os.stat(tempfile.gettempdir()).st_dev,
+    reason="needs a separate file system for scratch space")
+def test_publish_file_across_file_systems(tmp_path):
+    destdir = tmp_path / "metadata"
+    destdir.mkdir()
+    with tempfile.TemporaryDirectory(dir="/dev/shm") as scratch:
+        src = os.path.join(scratch, "AB-1234-run.xml")
+        with open(src, "w") as fh:
+            fh.write("new")
+        dest = publish_file(src, str(destdir))
+        assert (destdir / "AB-1234-run.xml").read_text() == "new"
+        assert os.listdir(destdir) == ["AB-1234-run.xml"]
+        assert dest == str(destdir / "AB-1234-run.xml")
+
+
+def test_link_or_copy(tmp_path):
+    src = tmp_path / "XYZ321XY.lims.json"
+    src.write_text("{}")
+
+    assert link_or_copy(src, tmp_path / "hardlink.json") == "hardlink"
+    assert os.path.samefile(src, tmp_path / "hardlink.json")
+
+    with mock.patch("os.link", side_effect=OSError(errno.EXDEV, "cross-device link")), \
+            mock.patch(
+                "metadata_service.workspace.reflink",
+                side_effect=OSError(errno.EOPNOTSUPP, "operation not supported")):
+        assert link_or_copy(src, tmp_path / "symlink.json") == "symlink"
+        assert os.readlink(tmp_path / "symlink.json") == str(src)
+
+        with mock.patch("os.symlink", side_effect=OSError(errno.EPERM, "operation not permitted")):
+            assert link_or_copy(src, tmp_path / "copy.json") == "copy"
+            assert not os.path.islink(tmp_path / "copy.json")
+            assert (tmp_path / "copy.json").read_text() == "{}"
+
+    # other errors are not hidden by falling back, nor is a missing file linked to
+    with mock.patch("os.link", side_effect=OSError(errno.EACCES, "permission denied")):
+        with pytest.raises(PermissionError):
+            link_or_copy(src, tmp_path / "denied.json")
+    with pytest.raises(FileNotFoundError):
+        link_or_copy(tmp_path / "missing.json", tmp_path / "missing-link.json")
+    assert not os.path.lexists(tmp_path / "missing-link.json")